@@ -0,0 +1,292 @@
+"""
+Synthetic data and local servers for the benchmarks.
+
+The generated trees mimic the station structure of aws-l3 with one sub-directory per station. Trees and repositories
+are reused between runs when their parameters are unchanged, so only the first run pays for generating them.
+"""
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import attr
+
+__all__ = [
+    'TreeSpec',
+    'make_station_tree',
+    'make_git_repository',
+    'ftp_server',
+    'smtp_server',
+]
+
+logger = logging.getLogger(__name__)
+
+_MARKER_NAME = '.benchmark.json'
+
+
+@attr.s(frozen=True)
+class TreeSpec:
+    """
+    Parameters of a synthetic station tree.
+
+    `age_distribution` is one of `uniform` (ages uniform within `max_age_days`), `exponential` (most files recent with
+    mean age `max_age_days` / 10) or `stale` (all files older than one day, so no early exit is possible).
+    """
+    stations: int = attr.ib(default=300)
+    files_per_station: int = attr.ib(default=100)
+    subdirectories: int = attr.ib(default=1)
+    age_distribution: str = attr.ib(default='uniform')
+    max_age_days: float = attr.ib(default=365)
+    seed: int = attr.ib(default=0)
+
+    @property
+    def file_count(self) -> int:
+        return self.stations * self.files_per_station
+
+
+def _file_age(spec: TreeSpec, rng: random.Random) -> float:
+    max_age = spec.max_age_days * 86400
+    if spec.age_distribution == 'uniform':
+        return rng.uniform(0, max_age)
+    if spec.age_distribution == 'exponential':
+        return min(rng.expovariate(10 / max_age), max_age)
+    if spec.age_distribution == 'stale':
+        return rng.uniform(86400, max(max_age, 2 * 86400))
+    raise ValueError(f"Unknown age distribution: {spec.age_distribution}")
+
+
+def _is_current(path: Path, parameters: Dict) -> bool:
+    try:
+        return json.loads((path / _MARKER_NAME).read_text()) == parameters
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def make_station_tree(root: Path, spec: TreeSpec, reference_time: Optional[datetime] = None) -> Path:
+    """
+    Create `spec.stations` station directories below `root` with `spec.files_per_station` files each.
+
+    File modification times are set relative to `reference_time` according to `spec.age_distribution`. An existing
+    tree with the same parameters is reused.
+    """
+    root = Path(root)
+    reference_time = reference_time or datetime.now(tz=timezone.utc)
+    parameters = dict(attr.asdict(spec), reference_time=reference_time.replace(microsecond=0).isoformat())
+    if _is_current(root, parameters):
+        return root
+    if root.exists():
+        shutil.rmtree(root)
+
+    logger.info(f"Generating {spec.file_count} files in {root}")
+    rng = random.Random(spec.seed)
+    reference_timestamp = reference_time.timestamp()
+    for station_number in range(spec.stations):
+        station = f'STATION_{station_number:04d}'
+        directories = [root / station / f'part_{i:02d}' for i in range(spec.subdirectories)]
+        for directory in directories:
+            directory.mkdir(parents=True)
+        directory_mtimes = [0.] * len(directories)
+        for file_number in range(spec.files_per_station):
+            directory_number = file_number % len(directories)
+            path = directories[directory_number] / f'{station}_{file_number:06d}.csv'
+            path.touch()
+            mtime = reference_timestamp - _file_age(spec, rng)
+            os.utime(path, (mtime, mtime))
+            directory_mtimes[directory_number] = max(directory_mtimes[directory_number], mtime)
+        # Directories are modified when their newest file was created
+        for directory, mtime in zip(directories, directory_mtimes):
+            os.utime(directory, (mtime, mtime))
+        os.utime(root / station, (max(directory_mtimes), max(directory_mtimes)))
+    (root / _MARKER_NAME).write_text(json.dumps(parameters))
+    return root
+
+
+def make_git_repository(
+        path: Path,
+        commits: int = 10000,
+        stations: int = 300,
+        reference_time: Optional[datetime] = None,
+        commit_interval: timedelta = timedelta(minutes=10),
+) -> Path:
+    """
+    Create a git repository with `commits` commits, each touching a file of one station sub-directory.
+
+    The history is written with `git fast-import`, which is orders of magnitude faster than committing one by one.
+    The newest commit is at `reference_time`. An existing repository with the same parameters is reused.
+    """
+    path = Path(path)
+    reference_time = reference_time or datetime.now(tz=timezone.utc)
+    parameters = dict(
+        commits=commits,
+        stations=stations,
+        reference_time=reference_time.replace(microsecond=0).isoformat(),
+        commit_interval=commit_interval.total_seconds(),
+    )
+    if _is_current(path, parameters):
+        return path
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+
+    logger.info(f"Generating a git repository with {commits} commits in {path}")
+    subprocess.run(['git', 'init', '-q', '-b', 'main', os.fspath(path)], check=True)
+    stream = []
+    rng = random.Random(0)
+    first_timestamp = int(reference_time.timestamp() - (commits - 1) * commit_interval.total_seconds())
+    for i in range(commits):
+        station = f'STATION_{rng.randrange(stations):04d}'
+        content = f'{i}\n'.encode()
+        timestamp = first_timestamp + int(i * commit_interval.total_seconds())
+        message = f'Update {station}'.encode()
+        stream.append(b'commit refs/heads/main\n')
+        stream.append(f'author Benchmark <benchmark@example.com> {timestamp} +0000\n'.encode())
+        stream.append(f'committer Benchmark <benchmark@example.com> {timestamp} +0000\n'.encode())
+        stream.append(f'data {len(message)}\n'.encode() + message + b'\n')
+        stream.append(f'M 644 inline {station}/{station}.txt\n'.encode())
+        stream.append(f'data {len(content)}\n'.encode() + content + b'\n')
+    subprocess.run(
+        ['git', '-C', os.fspath(path), 'fast-import', '--quiet'],
+        input=b''.join(stream),
+        check=True,
+    )
+    subprocess.run(['git', '-C', os.fspath(path), 'checkout', '-q', 'main'], check=True)
+    (path / '.git' / 'info' / 'exclude').write_text(_MARKER_NAME + '\n')
+    (path / _MARKER_NAME).write_text(json.dumps(parameters))
+    return path
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def ftp_server(
+        directory: Path,
+        file_count: int = 10000,
+        reference_time: Optional[datetime] = None,
+        interval: timedelta = timedelta(minutes=5),
+        handler_attributes: Optional[Dict] = None,
+) -> Iterator[Dict]:
+    """
+    Run a local pyftpdlib server with `file_count` concatenated BUFR files in its `upload` directory.
+
+    `handler_attributes` override attributes of the pyftpdlib handler, e.g. `proto_cmds` or `ftp_*` command methods.
+    Yields the settings for `get_latest_dmi_bufr`.
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+
+    upload_path = Path(directory) / 'upload'
+    reference_time = reference_time or datetime.now(tz=timezone.utc)
+    parameters = dict(
+        file_count=file_count,
+        reference_time=reference_time.replace(second=0, microsecond=0).isoformat(),
+        interval=interval.total_seconds(),
+    )
+    if not _is_current(upload_path, parameters):
+        if upload_path.exists():
+            shutil.rmtree(upload_path)
+        upload_path.mkdir(parents=True)
+        timestamp = reference_time.timestamp()
+        timestamp -= timestamp % interval.total_seconds()
+        for i in range(file_count):
+            file_time = datetime.fromtimestamp(timestamp - i * interval.total_seconds(), tz=timezone.utc)
+            (upload_path / file_time.strftime('geus_%Y%m%dT%H%M.bufr')).write_bytes(b'BUFR')
+        (upload_path / _MARKER_NAME).write_text(json.dumps(parameters))
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('benchmark', 'benchmark', os.fspath(directory))
+    handler = type('BenchmarkFTPHandler', (FTPHandler,), dict(authorizer=authorizer, **(handler_attributes or dict())))
+    server = FTPServer(('127.0.0.1', _free_port()), handler)
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(timeout=0.1), daemon=True)
+    thread.start()
+    try:
+        yield dict(
+            user='benchmark',
+            passwd='benchmark',
+            host='127.0.0.1',
+            port=server.address[1],
+            retries=0,
+        )
+    finally:
+        server.close_all()
+        thread.join()
+
+
+def _self_signed_context(directory: Path) -> Tuple[ssl.SSLContext, ssl.SSLContext]:
+    """Server and client context for a new self-signed certificate"""
+    certificate_path = directory / 'smtp.pem'
+    key_path = directory / 'smtp.key'
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=localhost',
+            '-keyout', os.fspath(key_path),
+            '-out', os.fspath(certificate_path),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certificate_path, key_path)
+    return context, ssl.create_default_context(cafile=certificate_path)
+
+
+@contextlib.contextmanager
+def smtp_server() -> Iterator[Dict]:
+    """
+    Run a local aiosmtpd server with implicit TLS accepting any login.
+
+    Yields the keyword arguments for `EmailNotificationClient` and the list of received messages. A self-signed
+    certificate is generated with openssl and trusted by the yielded client context only.
+    """
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+
+    received: List = []
+
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            received.append(envelope.content)
+            return '250 OK'
+
+    with tempfile.TemporaryDirectory() as directory:
+        server_context, client_context = _self_signed_context(Path(directory))
+        port = _free_port()
+        controller = Controller(
+            Handler(),
+            hostname='127.0.0.1',
+            port=port,
+            ssl_context=server_context,
+            authenticator=lambda *args: AuthResult(success=True),
+            auth_require_tls=False,
+        )
+        controller.start()
+        try:
+            yield dict(
+                client_settings=dict(
+                    receiver_emails=['receiver@example.com'],
+                    account='benchmark@example.com',
+                    smtp_server='localhost',
+                    port=port,
+                    password='benchmark',
+                    ssl_context=client_context,
+                ),
+                received=received,
+            )
+        finally:
+            controller.stop()
@@ -0,0 +1,400 @@
+"""
+Benchmarks of the checks against synthetic data and local servers.
+
+    python -m benchmarks.run --work-dir /tmp/aws-benchmarks --output results.json
+    python -m benchmarks.run --work-dir /tmp/aws-benchmarks --compare results.json
+
+Every benchmark is run `--repeat` times after one warm-up run and reports the median, minimum and maximum wall time,
+the throughput in items per second and the peak Python memory allocated, measured in a separate run with tracemalloc
+so that tracing does not affect the timings. Note that all runs after generating the data hit a warm page cache.
+
+With `--compare` the medians are compared to a previous result file and the exit code is 1 if any benchmark is more
+than `--threshold` times slower.
+"""
+import contextlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+import attr
+
+from alert_processing.directory_index import DirectoryIndex
+from alert_processing.dmi_bufr import get_dmi_bufr_stats, get_latest_dmi_bufr, predict_bufr_filenames
+from alert_processing.email_notification import EmailNotificationClient
+from alert_processing.file_system_status import (
+    check_update_time,
+    get_latest_modified_time,
+    get_modified_time,
+    get_station_modified_time,
+)
+from alert_processing.git_repositories import CommitTimeCache, check_last_commit, get_last_commit_datetimes
+from alert_processing.manifest import ManifestStore, diff_manifests, hash_paths, manifest_dtype, scan_manifest
+from alert_processing.outbox import Outbox
+from alert_processing.sharded_scan import ShardedScanner
+from benchmarks.fixtures import TreeSpec, ftp_server, make_git_repository, make_station_tree, smtp_server
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE = timedelta(hours=1)
+
+
+@attr.s(frozen=True)
+class Benchmark:
+    name: str = attr.ib()
+    function: Callable[[], object] = attr.ib()
+    items: int = attr.ib(default=1)
+
+
+@attr.s(frozen=True)
+class BenchmarkResult:
+    name: str = attr.ib()
+    items: int = attr.ib()
+    median: float = attr.ib()
+    minimum: float = attr.ib()
+    maximum: float = attr.ib()
+    peak_memory: int = attr.ib()
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.median if self.median > 0 else float('inf')
+
+
+def measure(benchmark: Benchmark, repeat: int) -> BenchmarkResult:
+    benchmark.function()
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        benchmark.function()
+        durations.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    try:
+        benchmark.function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(
+        name=benchmark.name,
+        items=benchmark.items,
+        median=statistics.median(durations),
+        minimum=min(durations),
+        maximum=max(durations),
+        peak_memory=peak_memory,
+    )
+
+
+def file_system_benchmarks(
+        work_dir: Path,
+        spec: TreeSpec,
+        reference_time: datetime,
+        scanners: Optional[Dict[str, ShardedScanner]] = None,
+) -> Iterator[Benchmark]:
+    trees = {
+        distribution: make_station_tree(
+            work_dir / f'tree_{distribution}',
+            attr.evolve(spec, age_distribution=distribution),
+            reference_time=reference_time,
+        )
+        for distribution in ('exponential', 'stale')
+    }
+    stale_tree = trees['stale']
+    yield Benchmark(
+        name='latest_modified_time_full_scan',
+        function=lambda: get_latest_modified_time(stale_tree),
+        items=spec.file_count,
+    )
+    yield Benchmark(
+        name='check_update_time_fresh',
+        function=lambda: check_update_time(trees['exponential'], reference_time, MAX_AGE),
+        items=spec.file_count,
+    )
+    yield Benchmark(
+        name='check_update_time_stale',
+        function=lambda: check_update_time(stale_tree, reference_time, MAX_AGE),
+        items=spec.file_count,
+    )
+    directory_index = DirectoryIndex(work_dir / 'index.sqlite')
+    directory_index.rebuild()
+    yield Benchmark(
+        name='check_update_time_stale_indexed',
+        function=lambda: check_update_time(stale_tree, reference_time, MAX_AGE, directory_index=directory_index),
+        items=spec.file_count,
+    )
+    yield Benchmark(
+        name='get_modified_time_rglob',
+        function=lambda: get_modified_time(stale_tree.rglob('*')),
+        items=spec.file_count,
+    )
+    yield Benchmark(
+        name='station_modified_time',
+        function=lambda: get_station_modified_time(stale_tree),
+        items=spec.file_count,
+    )
+    yield Benchmark(
+        name='manifest_scan',
+        function=lambda: scan_manifest(stale_tree),
+        items=spec.file_count,
+    )
+    for name, scanner in (scanners or dict()).items():
+        yield Benchmark(
+            name=f'latest_modified_time_full_scan_{name}',
+            function=lambda scanner=scanner: scanner.get_latest_modified_time(stale_tree),
+            items=spec.file_count,
+        )
+        yield Benchmark(
+            name=f'station_modified_time_{name}',
+            function=lambda scanner=scanner: scanner.get_station_modified_time(stale_tree),
+            items=spec.file_count,
+        )
+
+
+def manifest_benchmarks(work_dir: Path, entries: int) -> Iterator[Benchmark]:
+    """Snapshot and diff of a manifest of `entries` synthetic paths without the directory walk"""
+    import numpy as np
+
+    paths = [f'{work_dir}/aws-l3/tx/STATION_{i % 300:03d}/{i // 300:06d}_hour.csv' for i in range(entries)]
+    store = ManifestStore(work_dir / 'manifests')
+
+    def make_snapshot(path_hashes):
+        manifest = np.zeros(len(path_hashes), dtype=manifest_dtype())
+        manifest['path_hash'] = np.sort(path_hashes)
+        return manifest
+
+    path_hashes = hash_paths(paths)
+    store.save(Path('previous'), make_snapshot(path_hashes))
+    # 1 % of the files vanished and as many are new
+    new_hashes = hash_paths([f'{path}.new' for path in paths[:entries // 100]])
+    current = make_snapshot(np.concatenate([path_hashes[entries // 100:], new_hashes]))
+    yield Benchmark(
+        name='manifest_snapshot',
+        function=lambda: make_snapshot(hash_paths(paths)),
+        items=entries,
+    )
+    yield Benchmark(
+        name='manifest_save',
+        function=lambda: store.save(Path('current'), current),
+        items=entries,
+    )
+    yield Benchmark(
+        name='manifest_load_diff',
+        function=lambda: diff_manifests(store.load(Path('previous')), current),
+        items=entries,
+    )
+
+
+def git_benchmarks(work_dir: Path, commits: int, stations: int, reference_time: datetime) -> Iterator[Benchmark]:
+    repository = make_git_repository(
+        work_dir / 'git',
+        commits=commits,
+        stations=stations,
+        reference_time=reference_time,
+    )
+    station_paths = [f'STATION_{i:04d}' for i in range(stations)]
+    commit_time_cache = CommitTimeCache(repository)
+    yield Benchmark(
+        name='check_last_commit',
+        function=lambda: check_last_commit(repository, reference_time, MAX_AGE),
+    )
+    yield Benchmark(
+        name='check_last_commit_cached',
+        function=lambda: check_last_commit(
+            repository, reference_time, MAX_AGE, commit_time_cache=commit_time_cache,
+        ),
+    )
+    yield Benchmark(
+        name='last_commit_datetimes_all_stations',
+        function=lambda: get_last_commit_datetimes(repository, station_paths),
+        items=stations,
+    )
+
+
+def ftp_benchmarks(ftp_settings: Dict, file_count: int, reference_time: datetime) -> Iterator[Benchmark]:
+    probe_filenames = predict_bufr_filenames(reference_time, MAX_AGE, 'geus_%Y%m%dT%H%M.bufr')
+    yield Benchmark(
+        name='dmi_latest_listing',
+        function=lambda: get_latest_dmi_bufr(**ftp_settings),
+        items=file_count,
+    )
+    yield Benchmark(
+        name='dmi_latest_probe',
+        function=lambda: get_latest_dmi_bufr(probe_filenames=probe_filenames, **ftp_settings),
+    )
+    yield Benchmark(
+        name='dmi_bufr_stats',
+        function=lambda: get_dmi_bufr_stats(**{k: v for k, v in ftp_settings.items() if k != 'retries'}),
+        items=file_count,
+    )
+
+
+def smtp_benchmarks(client: EmailNotificationClient, batch_size: int = 10) -> Iterator[Benchmark]:
+    messages = [(f'ALERT: benchmark {i}', 'Benchmark body text') for i in range(batch_size)]
+    yield Benchmark(
+        name='smtp_single',
+        function=lambda: client.send_alert_email('ALERT: benchmark', 'Benchmark body text'),
+    )
+    yield Benchmark(
+        name=f'smtp_batch_{batch_size}',
+        function=lambda: client.send_alert_emails(messages),
+        items=batch_size,
+    )
+
+
+def outbox_benchmarks(work_dir: Path, batch_size: int = 10) -> Iterator[Benchmark]:
+    """Time for a check run to hand its notifications to the outbox, which is all the checks wait for"""
+    outbox = Outbox(work_dir / 'outbox' / 'outbox.jsonl')
+    messages = [(f'ALERT: benchmark {i}', 'Benchmark body text') for i in range(batch_size)]
+    yield Benchmark(
+        name=f'outbox_put_{batch_size}',
+        function=lambda: outbox.put(messages),
+        items=batch_size,
+    )
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', '-C', os.fspath(Path(__file__).parent), 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_bytes(value: float) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(value) < 1024:
+            return f'{value:.0f} {unit}'
+        value /= 1024
+    return f'{value:.1f} GiB'
+
+
+def print_results(results: List[BenchmarkResult]):
+    print(f"{'benchmark':40} {'median':>10} {'min':>10} {'max':>10} {'items/s':>12} {'peak mem':>10}")
+    for result in results:
+        print(
+            f"{result.name:40} {result.median * 1e3:8.1f}ms {result.minimum * 1e3:8.1f}ms "
+            f"{result.maximum * 1e3:8.1f}ms {result.throughput:12.0f} {_format_bytes(result.peak_memory):>10}"
+        )
+
+
+def compare_results(results: List[BenchmarkResult], baseline: Dict, threshold: float) -> bool:
+    """Print the ratio of the medians to `baseline` and return whether any benchmark regressed"""
+    baseline_results = baseline['results']
+    regressed = False
+    print(f"\nCompared to {baseline['metadata'].get('revision')} from {baseline['metadata'].get('time')}")
+    print(f"{'benchmark':40} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for result in results:
+        if result.name not in baseline_results:
+            continue
+        baseline_median = baseline_results[result.name]['median']
+        ratio = result.median / baseline_median if baseline_median > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print(
+            f"{result.name:40} {baseline_median * 1e3:8.1f}ms {result.median * 1e3:8.1f}ms {ratio:7.2f}{flag}"
+        )
+    return regressed
+
+
+def parse_arguments():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--work-dir', type=Path, required=True, help='Directory for the generated data')
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--files-per-station', type=int, default=100)
+    parser.add_argument('--subdirectories', type=int, default=4, help='Sub-directories per station')
+    parser.add_argument('--scan-workers', type=int, default=os.cpu_count(), help='Pool size of the sharded scans')
+    parser.add_argument('--manifest-entries', type=int, default=1000000, help='Synthetic files of the manifest diff')
+    parser.add_argument('--git-commits', type=int, default=10000)
+    parser.add_argument('--ftp-files', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--groups',
+        nargs='+',
+        default=['files', 'manifest', 'git', 'ftp', 'smtp'],
+        choices=['files', 'manifest', 'git', 'ftp', 'smtp'],
+    )
+    parser.add_argument('--output', type=Path, help='Write the results as json')
+    parser.add_argument('--compare', type=Path, help='Result file of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio reported as regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s; %(levelname)s; %(name)s; %(message)s')
+    # Keep the generated data reusable within a day
+    reference_time = datetime.now(tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    work_dir = args.work_dir
+    work_dir.mkdir(parents=True, exist_ok=True)
+    for name in ('alert_processing', 'mail.log', 'root'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+    logging.getLogger('benchmarks').setLevel(logging.INFO)
+
+    results = []
+    with contextlib.ExitStack() as stack:
+        benchmarks = []
+        if 'files' in args.groups:
+            spec = TreeSpec(
+                stations=args.stations,
+                files_per_station=args.files_per_station,
+                subdirectories=args.subdirectories,
+            )
+            scanners = {
+                f'sharded_{kind}': ShardedScanner(max_workers=args.scan_workers, use_processes=kind == 'processes')
+                for kind in ('threads', 'processes')
+            }
+            for scanner in scanners.values():
+                stack.callback(scanner.close)
+            benchmarks.extend(file_system_benchmarks(work_dir, spec, reference_time, scanners))
+        if 'manifest' in args.groups:
+            benchmarks.extend(manifest_benchmarks(work_dir, args.manifest_entries))
+        if 'git' in args.groups:
+            benchmarks.extend(git_benchmarks(work_dir, args.git_commits, args.stations, reference_time))
+        if 'ftp' in args.groups:
+            ftp_settings = stack.enter_context(
+                ftp_server(work_dir / 'ftp', file_count=args.ftp_files, reference_time=reference_time)
+            )
+            benchmarks.extend(ftp_benchmarks(ftp_settings, args.ftp_files, reference_time))
+        if 'smtp' in args.groups:
+            smtp = stack.enter_context(smtp_server())
+            benchmarks.extend(smtp_benchmarks(EmailNotificationClient(**smtp['client_settings'])))
+            benchmarks.extend(outbox_benchmarks(work_dir))
+
+        for benchmark in benchmarks:
+            logger.info(f"Running {benchmark.name}")
+            results.append(measure(benchmark, args.repeat))
+
+    print_results(results)
+    if args.output:
+        args.output.write_text(json.dumps(
+            dict(
+                metadata=dict(
+                    revision=_git_revision(),
+                    time=datetime.now(tz=timezone.utc).isoformat(),
+                    python=sys.version.split()[0],
+                    platform=platform.platform(),
+                    arguments={key: str(value) for key, value in vars(args).items()},
+                ),
+                results={result.name: attr.asdict(result) for result in results},
+            ),
+            indent=2,
+        ))
+    if args.compare:
+        if compare_results(results, json.loads(args.compare.read_text()), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
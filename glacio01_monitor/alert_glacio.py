@@ -9,20 +9,26 @@ This script is intended to work with the following routine:
   Azure (ssh_to_azure.sh). This updates the last-updated time on the file.
 - alert_glacio.py (this script) runs at 2 min after the hour on Azure VM,
   and checks the update time of the file.
-- If time is older than an hour ago (and younger than two hours ago),
-  we send out email alerts that glacio01 may be down. Checking two hours
-  ago is to prevent repeated emails if the server is down for an extended time.
+- If time is older than an hour ago, we send out email alerts that glacio01
+  may be down. The alert state is kept in a local state store to prevent
+  repeated emails if the server is down for an extended time, and a recovery
+  email is sent when glacio01 is back.
 
 Patrick Wright, GEUS
 Jan 11, 2023
+
+This script is replaced by the heartbeat check of the aws-monitor-alert daemon
+(see send_heartbeat.sh and the heartbeat section of the README).
 '''
 
 from argparse import ArgumentParser
 from configparser import ConfigParser
-import smtplib, ssl
 import glob
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.email_notification import EmailNotificationClient, StatefulNotificationClient
 
 # from IPython import embed
 
@@ -35,6 +41,10 @@ def parse_arguments():
         type=str, required=False, help='Email credentials .ini file')
     parser.add_argument('--glacio01-path', default='/home/aws/aws-monitor-alert/glacio01_monitor/glacio01_monitor.txt',
         type=str, required=False, help='Path to the file being updated from glacio01')
+    parser.add_argument('--state-path', default='/home/aws/aws-monitor-alert/glacio01_monitor/glacio01_monitor_state.sqlite',
+        type=str, required=False, help='Path to the alert state store')
+    parser.add_argument('--renotify-hours', default=24, type=float, required=False,
+        help='Hours between repeated alerts while glacio01 is down')
     args = parser.parse_args()
     return args
 
@@ -59,28 +69,27 @@ def check_glacio_update_time(filepath):
 
     now = datetime.now().timestamp()
     one_hour_ago = now - (60 * 60)
-    two_hours_ago = now - (60 * 60 * 2)
 
-    if (update_time < one_hour_ago) and (update_time > two_hours_ago):
+    if update_time < one_hour_ago:
         status = True
     return status
 
-def send_alert_email(receiver_emails, subject_text, body_text):
-    ''' Use smtp to login to gmail and send an alert email
-    See: https://realpython.com/python-send-email/
+def create_notification_client(receiver_emails, state_path, renotify_hours):
+    ''' Create an email notification client which suppresses repeated alerts
+    using the alert state store at state_path
 
     Parameters
     ----------
     receiver_emails : list
         List of email addresses to send alerts to
-    subject_text : str
-        The email subject
-    body_text : str
-        Message for the email body
+    state_path : str
+        Path to the alert state store
+    renotify_hours : float
+        Hours between repeated alerts
 
     Returns
     -------
-    None
+    StatefulNotificationClient
     '''
     # Set credential paths
     accounts_file = args.account
@@ -98,43 +107,34 @@ def send_alert_email(receiver_emails, subject_text, body_text):
     password = accounts_ini.get('aws', 'password')
     if not password:
         password = input('password for AWS email account: ')
-    print('Logging into server %s, account %s' %(smtp_server, account))
-
-    #----------------------------------
-
-    headers = f"From: {account}\r\n"
-    headers += f"To: {', '.join(receiver_emails)}\r\n" 
-    headers += f"Subject: {subject_text}\r\n"
-    email_message = headers + "\r\n" + body_text  # Blank line needed between headers and body
-
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-        server.login(account, password)
-        # server.set_debuglevel(1)  # Show SMTP server interactions
-        server.sendmail(account, receiver_emails, email_message)
-        server.quit() # may not be necessary?
-    print('Alert email sent!')
-    return
-
-if __name__ == '__main__':
-    """Executed from the command line"""
-    args = parse_arguments()
-
-    glacio_file = args.glacio01_path
-
-    receiver_emails = [
-        "pajwr@geus.dk",
-        "pho@geus.dk",
-        "rsf@geus.dk",
-        "rabni@geus.dk",
-        "syhsv@geus.dk",
-        "aso@geus.dk",
-        "shl@geus.dk",
-        "bav@geus.dk",
-        "maclu@geus.dk",
-        ]
+    print('Using server %s, account %s' %(smtp_server, account))
+
+    email_client = EmailNotificationClient(
+        receiver_emails=receiver_emails,
+        account=account,
+        smtp_server=smtp_server,
+        port=port,
+        password=password,
+    )
+    return StatefulNotificationClient(
+        email_client,
+        state_store=AlertStateStore(state_path),
+        renotify_interval=timedelta(hours=renotify_hours),
+    )
+
+def run_glacio_checks(glacio_file, notification_client):
+    '''Check the glacio01 monitor file and notify about the result
 
+    Parameters
+    ----------
+    glacio_file : str
+        path to the file being updated from glacio01
+    notification_client : StatefulNotificationClient
+        client sending the alerts. It is flushed at the end, which sends
+        pending notifications and records them in the alert state store
+    '''
     if os.path.isfile(glacio_file):
+        notification_client.notify_ok('glacio01_monitor_file')
         glacio_alert = check_glacio_update_time(glacio_file)
 
         if glacio_alert is True:
@@ -147,8 +147,9 @@ if __name__ == '__main__':
             If glacio01 is inaccessible, then email GEUS IT at geusithjaelp@geus.dk
             '''
 
-            send_alert_email(receiver_emails, subject_text, body_text)
+            notification_client.send_alert_email(subject_text, body_text, check_name='glacio01')
         else:
+            notification_client.notify_ok('glacio01')
             print('{} is current. No alert issued.'.format(glacio_file.split('/')[-1]))
     else:
         print('No monitor file found!')
@@ -162,7 +163,30 @@ if __name__ == '__main__':
         by the cron job on glacio01. Perhaps the cron for aws user at glacio01 is not running.
         '''
 
-        send_alert_email(receiver_emails, subject_text, body_text)
+        notification_client.send_alert_email(subject_text, body_text, check_name='glacio01_monitor_file')
+
+    notification_client.flush()
+
+if __name__ == '__main__':
+    """Executed from the command line"""
+    args = parse_arguments()
+
+    glacio_file = args.glacio01_path
+
+    receiver_emails = [
+        "pajwr@geus.dk",
+        "pho@geus.dk",
+        "rsf@geus.dk",
+        "rabni@geus.dk",
+        "syhsv@geus.dk",
+        "aso@geus.dk",
+        "shl@geus.dk",
+        "bav@geus.dk",
+        "maclu@geus.dk",
+        ]
+    notification_client = create_notification_client(receiver_emails, args.state_path, args.renotify_hours)
+
+    run_glacio_checks(glacio_file, notification_client)
 
 else:
     """Executed on import"""
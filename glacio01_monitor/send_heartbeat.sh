@@ -0,0 +1,22 @@
+#!/usr/bin/env bash
+
+# Intended to be run as cron job from glacio01, e.g. every 5 minutes
+
+# Send a heartbeat to the aws-monitor-alert daemon at Azure, which alerts
+# when no heartbeat has been received within max-age-minutes of the
+# heartbeat section of its configuration. This replaces ssh_to_azure.sh.
+
+# Only bash is needed: the UDP datagram is sent with the /dev/udp redirection.
+# Set HEARTBEAT_URL to use the HTTP receiver with curl instead, which reports
+# delivery failures in stderr.
+
+server="${HEARTBEAT_SERVER:-azure-aws}"
+port="${HEARTBEAT_PORT:-9478}"
+token="${HEARTBEAT_TOKEN:-}"
+host="glacio01"
+
+if [ -n "$HEARTBEAT_URL" ]; then
+    curl -fsS -X POST ${token:+-H "X-Heartbeat-Token: $token"} "$HEARTBEAT_URL/heartbeat/$host"
+else
+    echo "$host $token" > "/dev/udp/$server/$port"
+fi
@@ -1,6 +1,7 @@
 #!/usr/bin/env bash
 
 # Intended to be run as hourly cron job from glacio01
+# Replaced by send_heartbeat.sh once the aws-monitor-alert daemon runs on Azure
 
 # ssh to the Azure aws server (using ssh config), then
 # (optionally) rename the glacio01_* file with current datetime.
@@ -0,0 +1,142 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import attr
+
+__all__ = [
+    'CheckState',
+    'AlertStateStore',
+]
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS check_states (
+    name TEXT PRIMARY KEY,
+    alerting INTEGER NOT NULL,
+    changed_at TEXT,
+    last_notified_at TEXT,
+    last_success_at TEXT
+)
+"""
+
+
+def _to_string(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _from_string(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+@attr.s(frozen=True)
+class CheckState:
+    name: str = attr.ib()
+    alerting: bool = attr.ib(default=False)
+    changed_at: Optional[datetime] = attr.ib(default=None)
+    last_notified_at: Optional[datetime] = attr.ib(default=None)
+    last_success_at: Optional[datetime] = attr.ib(default=None)
+
+
+@attr.s
+class AlertStateStore:
+    """
+    Persistent state of each check between runs, stored in a small sqlite file.
+
+    The store remembers whether a check is in alert condition, when that started, when a notification was last sent
+    and when the check last passed.
+    """
+    path: Path = attr.ib(converter=Path)
+    connection: sqlite3.Connection = attr.ib(init=False, repr=False, default=None)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, name: str) -> CheckState:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT alerting, changed_at, last_notified_at, last_success_at FROM check_states WHERE name = ?",
+                (name,),
+            ).fetchone()
+        if row is None:
+            return CheckState(name=name)
+        alerting, changed_at, last_notified_at, last_success_at = row
+        return CheckState(
+            name=name,
+            alerting=bool(alerting),
+            changed_at=_from_string(changed_at),
+            last_notified_at=_from_string(last_notified_at),
+            last_success_at=_from_string(last_success_at),
+        )
+
+    def put(self, state: CheckState):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO check_states VALUES (?, ?, ?, ?, ?)",
+                (
+                    state.name,
+                    int(state.alerting),
+                    _to_string(state.changed_at),
+                    _to_string(state.last_notified_at),
+                    _to_string(state.last_success_at),
+                ),
+            )
+
+    def record_alert(self, name: str, notified: bool, time: Optional[datetime] = None) -> CheckState:
+        """Record that `name` is in alert condition and optionally that a notification has been sent"""
+        time = time or datetime.now(tz=timezone.utc)
+        state = self.get(name)
+        state = attr.evolve(
+            state,
+            alerting=True,
+            changed_at=state.changed_at if state.alerting else time,
+            last_notified_at=time if notified else state.last_notified_at,
+        )
+        self.put(state)
+        return state
+
+    def record_success(self, name: str, time: Optional[datetime] = None) -> CheckState:
+        """Record that `name` passed and return the previous state"""
+        time = time or datetime.now(tz=timezone.utc)
+        previous_state = self.get(name)
+        self.put(attr.evolve(
+            previous_state,
+            alerting=False,
+            changed_at=time if previous_state.alerting else previous_state.changed_at,
+            last_success_at=time,
+        ))
+        return previous_state
+
+    def should_notify(self, name: str, renotify_interval: Optional[timedelta], time: Optional[datetime] = None) -> bool:
+        """
+        Whether an alert for `name` should be sent. Repeated alerts are suppressed until `renotify_interval` has passed
+        since the last notification. With `renotify_interval` None, an alert is only sent once per alert period.
+        """
+        time = time or datetime.now(tz=timezone.utc)
+        state = self.get(name)
+        if not state.alerting or state.last_notified_at is None:
+            return True
+        if renotify_interval is None:
+            return False
+        return time - state.last_notified_at >= renotify_interval
+
+    def passed_within(self, name: str, interval: timedelta, time: Optional[datetime] = None) -> bool:
+        """Whether `name` is not alerting and passed within `interval`"""
+        time = time or datetime.now(tz=timezone.utc)
+        state = self.get(name)
+        return (
+                not state.alerting
+                and state.last_success_at is not None
+                and time - state.last_success_at < interval
+        )
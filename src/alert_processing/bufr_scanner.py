@@ -0,0 +1,274 @@
+"""
+Lightweight scanner of BUFR message headers without eccodes.
+
+Files are memory mapped and the `BUFR ... 7777` message boundaries are walked using the total length in section 0.
+Only the few header bytes needed are read: the edition, the reference time of section 1 and the number of subsets in
+section 3. The data section is never decoded or copied, so a concatenated file of hundreds of messages is scanned in
+microseconds per message.
+"""
+import logging
+import mmap
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.dmi_bufr import parse_filename_datetime
+from alert_processing.metrics import registry
+
+__all__ = [
+    'BufrMessage',
+    'BufrFileSummary',
+    'iter_bufr_messages',
+    'scan_bufr_file',
+    'scan_bufr_directory',
+    'check_bufr_content',
+]
+
+logger = logging.getLogger(__name__)
+
+_START = b'BUFR'
+_END = b'7777'
+
+
+@attr.s(frozen=True)
+class BufrMessage:
+    offset: int = attr.ib()
+    length: int = attr.ib()
+    edition: int = attr.ib()
+    data_category: int = attr.ib()
+    reference_time: Optional[datetime] = attr.ib()
+    subset_count: int = attr.ib()
+
+
+@attr.s(frozen=True)
+class BufrFileSummary:
+    path: Path = attr.ib()
+    modified_time: datetime = attr.ib()
+    message_count: int = attr.ib(default=0)
+    subset_count: int = attr.ib(default=0)
+    earliest_time: Optional[datetime] = attr.ib(default=None)
+    latest_time: Optional[datetime] = attr.ib(default=None)
+    # Bytes which are not part of a valid message, e.g. a truncated message at the end of the file
+    invalid_bytes: int = attr.ib(default=0)
+
+
+def _uint(buffer, offset: int, size: int) -> int:
+    return int.from_bytes(buffer[offset:offset + size], 'big')
+
+
+def _reference_time(buffer, section1: int, edition: int) -> Optional[datetime]:
+    try:
+        if edition >= 4:
+            year = _uint(buffer, section1 + 15, 2)
+            month, day, hour, minute, second = (buffer[section1 + i] for i in range(17, 22))
+        else:
+            year_of_century = buffer[section1 + 12]
+            # Edition 2 and 3 store the year of the century, with 100 used by some centres for 2000
+            year = 1900 + year_of_century if year_of_century >= 70 else 2000 + year_of_century
+            month, day, hour, minute = (buffer[section1 + i] for i in range(13, 17))
+            second = 0
+        return datetime(year, month, day, hour, minute, second, tzinfo=timezone.utc)
+    except (ValueError, IndexError):
+        return None
+
+
+def _parse_message(buffer, offset: int, length: int) -> BufrMessage:
+    edition = buffer[offset + 7]
+    # Edition 0 and 1 have no total length in section 0 and are not supported
+    section1 = offset + 8
+    section1_length = _uint(buffer, section1, 3)
+    if edition >= 4:
+        data_category = buffer[section1 + 10]
+        has_section2 = buffer[section1 + 9] & 0x80
+    else:
+        data_category = buffer[section1 + 8]
+        has_section2 = buffer[section1 + 7] & 0x80
+    section = section1 + section1_length
+    if has_section2:
+        section += _uint(buffer, section, 3)
+    # Section 3: length (3 bytes), reserved (1 byte), number of subsets (2 bytes)
+    subset_count = _uint(buffer, section + 4, 2)
+    return BufrMessage(
+        offset=offset,
+        length=length,
+        edition=edition,
+        data_category=data_category,
+        reference_time=_reference_time(buffer, section1, edition),
+        subset_count=subset_count,
+    )
+
+
+def _gap_size(buffer, start: int, end: int) -> int:
+    """Size of the bytes between messages, ignoring line breaks and padding"""
+    if start == end:
+        return 0
+    return len(buffer[start:end].strip(b' \t\r\n\0'))
+
+
+def iter_bufr_messages(buffer: Union[bytes, mmap.mmap]) -> Iterator[Tuple[int, Optional[BufrMessage]]]:
+    """
+    Walk the BUFR messages of `buffer` and yield (bytes skipped before the message, message).
+
+    Bytes between messages, such as line breaks or transmission headers, are skipped by searching for the next
+    `BUFR`. Whitespace and null padding around messages is not counted as skipped. A message whose end marker is not
+    at the position given by its length is treated as invalid and the search continues after its start. The final
+    element has message None and the number of trailing bytes skipped.
+    """
+    size = len(buffer)
+    # End of the last valid message
+    last_end = 0
+    position = 0
+    while True:
+        start = buffer.find(_START, position)
+        if start < 0 or start + 8 > size:
+            yield _gap_size(buffer, last_end, size), None
+            return
+        length = _uint(buffer, start + 4, 3)
+        end = start + length
+        if length < 8 + 4 or end > size or buffer[end - 4:end] != _END:
+            position = start + 1
+            continue
+        try:
+            message = _parse_message(buffer, start, length)
+        except IndexError:
+            position = start + 1
+            continue
+        yield _gap_size(buffer, last_end, start), message
+        position = last_end = end
+
+
+def scan_bufr_file(path: Path) -> BufrFileSummary:
+    """Summarize the messages of a BUFR file using a memory map of the file"""
+    path = Path(path)
+    stat_result = path.stat()
+    modified_time = datetime.fromtimestamp(stat_result.st_mtime, tz=timezone.utc)
+    if stat_result.st_size == 0:
+        return BufrFileSummary(path=path, modified_time=modified_time)
+
+    message_count = 0
+    subset_count = 0
+    invalid_bytes = 0
+    earliest_time = None
+    latest_time = None
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for skipped, message in iter_bufr_messages(buffer):
+            invalid_bytes += skipped
+            if message is None:
+                break
+            message_count += 1
+            subset_count += message.subset_count
+            if message.reference_time is not None:
+                if earliest_time is None or message.reference_time < earliest_time:
+                    earliest_time = message.reference_time
+                if latest_time is None or message.reference_time > latest_time:
+                    latest_time = message.reference_time
+    return BufrFileSummary(
+        path=path,
+        modified_time=modified_time,
+        message_count=message_count,
+        subset_count=subset_count,
+        earliest_time=earliest_time,
+        latest_time=latest_time,
+        invalid_bytes=invalid_bytes,
+    )
+
+
+def scan_bufr_directory(
+        dir_path: Path,
+        pattern: str = 'geus_*.bufr',
+        max_files: Optional[int] = None,
+) -> List[BufrFileSummary]:
+    """
+    Summarize the concatenated BUFR files matching `pattern` in `dir_path`, newest first.
+
+    Only files with a timestamped name such as geus_20230117T1303.bufr are concatenated files, other matches like
+    single station files are ignored. The files are ordered by the timestamp of their names and only the newest
+    `max_files` are read.
+    """
+    with profiling.span('bufr_scan', path=os.fspath(dir_path)) as scan_span:
+        timestamped_paths = []
+        for path in Path(dir_path).glob(pattern):
+            file_datetime = parse_filename_datetime(path.name)
+            if file_datetime is not None:
+                timestamped_paths.append((file_datetime, path))
+        timestamped_paths.sort(key=lambda item: item[0], reverse=True)
+        summaries = []
+        for _, path in timestamped_paths[:max_files]:
+            try:
+                summaries.append(scan_bufr_file(path))
+            except (FileNotFoundError, ValueError, OSError) as e:
+                logger.warning(f"Unable to scan {path}: {e}")
+        scan_span.set(files=len(summaries), messages=sum(s.message_count for s in summaries))
+    return summaries
+
+
+def check_bufr_content(
+        dir_path: Path,
+        current_time: datetime,
+        max_observation_lag: timedelta,
+        min_stations: int = 0,
+        pattern: str = 'geus_*.bufr',
+        max_invalid_bytes: int = 0,
+        max_files: int = 1,
+) -> List[str]:
+    '''Inspect the BUFR messages of the concatenated BUFR files in dir_path
+    and return a description of each problem found.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Directory containing concatenated BUFR files
+    current_time : datetime
+        Current datetime used for determine the observation lag
+    max_observation_lag : timedelta
+        Maximum allowed age of the latest observation time of the newest file
+    min_stations : int
+        Minimum number of station subsets expected in the newest file
+    pattern : str
+        Glob pattern of the concatenated BUFR files. Only names with a timestamp are read.
+    max_invalid_bytes : int
+        Number of bytes outside of valid messages tolerated per file, not counting line breaks between messages
+    max_files : int
+        Number of the newest files read
+
+    Returns
+    -------
+    problems : List[str]
+        Empty if passing
+    '''
+    summaries = scan_bufr_directory(dir_path, pattern=pattern, max_files=max_files)
+    if not summaries:
+        return [f'No timestamped BUFR files matching {pattern} in {dir_path}']
+
+    problems = []
+    newest = summaries[0]
+    registry.set_gauge(
+        'aws_monitor_bufr_stations',
+        newest.subset_count,
+        help='Number of station subsets in the newest concatenated BUFR file',
+        path=os.fspath(dir_path),
+    )
+    if newest.subset_count < min_stations:
+        problems.append(
+            f'{newest.path.name} contains {newest.subset_count} stations in {newest.message_count} messages, '
+            f'expected at least {min_stations}'
+        )
+    if newest.latest_time is None:
+        problems.append(f'{newest.path.name} contains no valid BUFR messages')
+    else:
+        observation_lag = current_time - newest.latest_time
+        report_data_age(observation_lag)
+        if observation_lag > max_observation_lag:
+            problems.append(
+                f'The latest observation time in {newest.path.name} is {newest.latest_time:%Y-%m-%d %H:%M}, '
+                f'{observation_lag} ago'
+            )
+    for summary in summaries:
+        if summary.invalid_bytes > max_invalid_bytes:
+            problems.append(f'{summary.path.name} contains {summary.invalid_bytes} bytes outside valid BUFR messages')
+    return problems
@@ -7,164 +7,712 @@ Currently implemented:
 - Check latest BUFR file timestamp at DMI ftp upload directory
 - Check latest BUFR file timestamp bufr out path
 - Check latest BUFR file timestamp bufr backup path
+- Check the BUFR message headers of the concatenated files in bufr out and bufr backup path
 - Check aws-l0/tx file update times
 - Check aws-l3/tx file update times
 - Check aws-l3/level_3 file update times
+- Check the timestamp of the last record per station in aws-l3/tx and aws-l3/level_3
+- Find the pipeline stage where the data of each station stops, from l0 commit to the DMI upload
+- Forecast when the filesystems of the pipeline directories are full
+- Compare per-file manifests between runs to find vanished files and files that stopped updating
+- Check the heartbeats of remote hosts such as glacio01 (daemon mode)
+- Check the summaries of remote agents scanning their local paths (daemon mode)
+
+The checks are run concurrently and notifications are sent when all checks have finished. Email notifications are
+written to a durable outbox first and delivered with retries, so an unreachable SMTP server does not lose alerts.
 
 """
 import logging.handlers
+import re
 import sys
 from argparse import ArgumentParser
 from configparser import ConfigParser
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Mapping, Optional
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List, Mapping, Optional, Set, TypeVar
+
+import attr
 
-from alert_processing import git_repositories
-from alert_processing.dmi_bufr import check_dmi_ftp
+from alert_processing import git_repositories, metrics, profiling
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.check_runner import (
+    DEFAULT_CHECK_TIMEOUT,
+    Alert,
+    CheckResult,
+    PipelineCheck,
+    dispatch_notifications,
+    run_checks,
+)
+from alert_processing.directory_index import DirectoryIndex
+from alert_processing.dmi_bufr import DmiStatusCache, check_dmi_ftp, get_latest_dmi_bufr
 from alert_processing.email_notification import (
+    BatchingNotificationClient,
     EmailNotificationClient,
     NotificationClient,
     LogNotificationClient,
+    OutboxNotificationClient,
+    StatefulNotificationClient,
 )
-from alert_processing.file_system_status import check_update_time
+from alert_processing.file_system_status import check_update_time, check_station_update_time
+
+# The optional subsystems are imported by the checks and modes which use them to keep the startup time low
+if TYPE_CHECKING:
+    from alert_processing.heartbeat import HeartbeatReceiver, HeartbeatRegistry
+    from alert_processing.history import FreshnessHistory
+    from alert_processing.outbox import OutboxDeliveryWorker
+    from alert_processing.remote_agent import SummaryReceiver, SummaryStore
+    from alert_processing.sharded_scan import ShardedScanner
+    from alert_processing.tree_watcher import TreeWatcher
 
 logger = logging.getLogger(__name__)
 
+_T = TypeVar('_T')
 
-def check_all_steps(
-        current_time: datetime,
-        notification_client: NotificationClient,
+
+@attr.s
+class CheckResources:
+    """
+    Caches and state files of the checks which are kept when the daemon configuration is reloaded.
+
+    Objects are keyed by the settings they are created with. After a reload, `release_unused` closes the objects
+    which the new configuration no longer uses.
+    """
+    _objects: Dict[Hashable, object] = attr.ib(init=False, factory=dict)
+    _requested: Set[Hashable] = attr.ib(init=False, factory=set)
+
+    def get(self, key: Hashable, factory: Callable[[], _T]) -> _T:
+        self._requested.add(key)
+        if key not in self._objects:
+            self._objects[key] = factory()
+        return self._objects[key]
+
+    def begin(self):
+        """Start tracking the objects used by the checks about to be built"""
+        self._requested = set()
+
+    def release_unused(self):
+        for key in list(self._objects):
+            if key not in self._requested:
+                self._close(self._objects.pop(key))
+
+    def close(self):
+        while self._objects:
+            self._close(self._objects.popitem()[1])
+
+    @staticmethod
+    def _close(resource: object):
+        close = getattr(resource, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                logger.exception(f"Failed to close {resource!r}")
+
+
+def get_dmi_ftp_settings(dmi_ftp_config: Mapping) -> dict:
+    """Connection settings of the dmi section for `get_latest_dmi_bufr`"""
+    return dict(
+        user=dmi_ftp_config['user'],
+        passwd=dmi_ftp_config['password'],
+        host=dmi_ftp_config['server'],
+        port=int(dmi_ftp_config.get('port', 21)),
+        connect_timeout=float(dmi_ftp_config.get('connect-timeout', 30)),
+        read_timeout=float(dmi_ftp_config.get('read-timeout', 60)),
+        retries=int(dmi_ftp_config.get('retries', 2)),
+    )
+
+
+def get_dmi_time(
+        dmi_ftp_config: Mapping,
+        current_time: Optional[datetime] = None,
+        dmi_status_cache: Optional[DmiStatusCache] = None,
+) -> Optional[datetime]:
+    """
+    Time of the newest upload at the DMI ftp server, None if skipped or unavailable. The status of the run at
+    `current_time` is taken from `dmi_status_cache` if provided.
+    """
+    if 'skip' in dmi_ftp_config:
+        return None
+    try:
+        if dmi_status_cache is not None:
+            return dmi_status_cache.get(current_time).latest_datetime
+        return get_latest_dmi_bufr(**get_dmi_ftp_settings(dmi_ftp_config)).latest_datetime
+    except Exception:
+        logger.exception('Unable to read the DMI ftp upload directory')
+        return None
+
+
+def build_checks(
         bufr_out_path: Optional[Path],
         bufr_backup_path: Optional[Path],
         dmi_ftp_config: Mapping,
         l0_tx_path: Optional[Path],
         l3_tx_path: Optional[Path],
         l3_joined_path: Optional[Path],
-):
-    logger.info("Checking pipeline data status")
+        directory_index: Optional[DirectoryIndex] = None,
+        station_config: Optional[Mapping] = None,
+        git_cache_path: Optional[Path] = None,
+        content_config: Optional[Mapping] = None,
+        content_cache_path: Optional[Path] = None,
+        bufr_config: Optional[Mapping] = None,
+        tree_watcher: Optional['TreeWatcher'] = None,
+        scanner: Optional['ShardedScanner'] = None,
+        heartbeat_config: Optional[Mapping] = None,
+        heartbeat_registry: Optional['HeartbeatRegistry'] = None,
+        aggregator_config: Optional[Mapping] = None,
+        remote_max_age_config: Optional[Mapping] = None,
+        summary_store: Optional['SummaryStore'] = None,
+        filename_patterns: Optional[Mapping] = None,
+        capacity_config: Optional[Mapping] = None,
+        capacity_path: Optional[Path] = None,
+        latency_config: Optional[Mapping] = None,
+        manifest_config: Optional[Mapping] = None,
+        manifest_path: Optional[Path] = None,
+        resources: Optional[CheckResources] = None,
+) -> List[PipelineCheck]:
+    checks = []
+    resources = resources or CheckResources()
+    # Regular expressions with the timestamp in the file names, keyed by check name
+    filename_patterns = {name: re.compile(pattern) for name, pattern in (filename_patterns or dict()).items()}
+    if tree_watcher is not None:
+        for dir_path in (bufr_out_path, bufr_backup_path, l3_tx_path, l3_joined_path):
+            if dir_path:
+                tree_watcher.watch(dir_path)
 
     # ==============================================================
     # DMI FTP
     # ==============================================================
-    logger.info('Checking DMI FTP')
+    dmi_status_cache = None
     if 'skip' in dmi_ftp_config:
         logger.info('DMI Alert: Skipping')
     else:
-        dmi_alert = check_dmi_ftp(
-            current_time=current_time,
+        # Shared with the pipeline latency check, so that the ftp server is read once per run
+        dmi_status_cache = DmiStatusCache(
             max_age=timedelta(hours=2),
-            user=dmi_ftp_config['user'],
-            passwd=dmi_ftp_config['password'],
-            host=dmi_ftp_config['server'],
+            probe_format=dmi_ftp_config.get('probe-format'),
+            probe_step=timedelta(minutes=float(dmi_ftp_config.get('probe-step-minutes', 1))),
+            max_probes=int(dmi_ftp_config.get('max-probes', 5)),
+            dmi_ftp_settings=get_dmi_ftp_settings(dmi_ftp_config),
         )
-        logger.info(f'DMI Alert: {dmi_alert}')
-        if dmi_alert:
-            notification_client.send_alert_email(
-                subject_text="ALERT: BUFR ftp server is not updated!",
-                body_text='''The most recent concatenated BUFR file at the DMI ftp upload directory is >1 hr old (should be ~3 minutes old).
-                There could be a problem with pypromice processing or the ftp upload itself.
-                '''
+
+        def dmi_ftp_check(current_time):
+            dmi_alert = check_dmi_ftp(
+                current_time=current_time,
+                max_age=dmi_status_cache.max_age,
+                status=dmi_status_cache.get(current_time),
+                **dmi_status_cache.dmi_ftp_settings,
             )
+            logger.info(f'DMI Alert: {dmi_alert}')
+            if dmi_alert:
+                return Alert(
+                    subject_text="ALERT: BUFR ftp server is not updated!",
+                    body_text='''The most recent concatenated BUFR file at the DMI ftp upload directory is >1 hr old (should be ~3 minutes old).
+                    There could be a problem with pypromice processing or the ftp upload itself.
+                    '''
+                )
+
+        checks.append(PipelineCheck(name='dmi_ftp', function=dmi_ftp_check))
 
     # ==============================================================
     # BUFR FILES
     # ==============================================================
     if bufr_out_path:
-        dmi_alert_1 = check_update_time(
-            bufr_out_path,
-            current_time=current_time,
-            max_age=timedelta(hours=2),
-        )
-        if dmi_alert_1:
-            notification_client.send_alert_email(
-                subject_text="ALERT: BUFR_out files are not updating!",
-                body_text='''
-                The individual station BUFR files and/or the concatenated BUFR file are not updating.
-                Expected behavior is for the BUFR_out directory to be emptied and re-populated every hour.
-                ''',
-            )
-        else:
-            logger.info('BUFR_out files are current. No alert issued.')
+        def bufr_out_check(current_time):
+            if check_update_time(
+                    bufr_out_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=2),
+                    directory_index=directory_index,
+                    tree_watcher=tree_watcher,
+                    scanner=scanner,
+                    filename_pattern=filename_patterns.get('bufr_out'),
+            ):
+                return Alert(
+                    subject_text="ALERT: BUFR_out files are not updating!",
+                    body_text='''
+                    The individual station BUFR files and/or the concatenated BUFR file are not updating.
+                    Expected behavior is for the BUFR_out directory to be emptied and re-populated every hour.
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='bufr_out',
+            function=bufr_out_check,
+            ok_message='BUFR_out files are current. No alert issued.',
+        ))
     if bufr_backup_path:
-        dmi_alert_2 = check_update_time(
-            bufr_backup_path,
-            current_time=current_time,
-            max_age=timedelta(hours=2),
-        )
+        def bufr_backup_check(current_time):
+            if check_update_time(
+                    bufr_backup_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=2),
+                    directory_index=directory_index,
+                    tree_watcher=tree_watcher,
+                    scanner=scanner,
+                    filename_pattern=filename_patterns.get('bufr_backup'),
+            ):
+                return Alert(
+                    subject_text="ALERT: BUFR_backup files are not updating!",
+                    body_text='''
+                    The concatenated BUFR files in the BUFR_backup directory are not updating.
+                    We expect to have one file per hour, for the last 48 hrs.
+                    ''',
+                )
 
-        if dmi_alert_2:
-            notification_client.send_alert_email(
-                subject_text="ALERT: BUFR_backup files are not updating!",
-                body_text='''
-                The concatenated BUFR files in the BUFR_backup directory are not updating.
-                We expect to have one file per hour, for the last 48 hrs.
-                ''',
-            )
-        else:
-            logger.info('BUFR_backup files are current. No alert issued.')
+        checks.append(PipelineCheck(
+            name='bufr_backup',
+            function=bufr_backup_check,
+            ok_message='BUFR_backup files are current. No alert issued.',
+        ))
+
+    # ==============================================================
+    # BUFR content
+    # ==============================================================
+    if bufr_config is not None:
+        from alert_processing.bufr_scanner import check_bufr_content
+
+        for check_name, name, dir_path in (
+                ('bufr_out_content', 'BUFR_out', bufr_out_path),
+                ('bufr_backup_content', 'BUFR_backup', bufr_backup_path),
+        ):
+            if not dir_path:
+                continue
+
+            def bufr_content_check(current_time, name=name, dir_path=dir_path):
+                problems = check_bufr_content(
+                    dir_path,
+                    current_time=current_time,
+                    max_observation_lag=timedelta(hours=bufr_config.getfloat('max-observation-lag-hours', fallback=3)),
+                    min_stations=bufr_config.getint('min-stations', fallback=1),
+                    pattern=bufr_config.get('pattern', fallback='geus_*.bufr'),
+                    max_files=bufr_config.getint('max-files', fallback=1),
+                )
+                if problems:
+                    problems_text = '\n'.join(problems)
+                    return Alert(
+                        subject_text=f"ALERT: {name} BUFR content is not as expected!",
+                        body_text=f'''
+                        The concatenated BUFR files in {name} on Azure have the following problems:
+                        {problems_text}
+                        ''',
+                    )
+
+            checks.append(PipelineCheck(
+                name=check_name,
+                function=bufr_content_check,
+                ok_message=f'{name} BUFR content is as expected. No alert issued.',
+            ))
 
     # ==============================================================
     # L0 TX
     # ==============================================================
     if l0_tx_path:
-        l0tx_alert = git_repositories.check_last_commit(
-            repository_path=l0_tx_path,
-            current_time=current_time,
-            max_age=timedelta(hours=1),
+        commit_time_cache = resources.get(
+            ('commit_time_cache', l0_tx_path, git_cache_path),
+            lambda: git_repositories.CommitTimeCache(l0_tx_path, cache_path=git_cache_path),
         )
 
-        if l0tx_alert:
-            notification_client.send_alert_email(
-                subject_text="ALERT: aws-l0/tx files are not updating!",
-                body_text='''
-                    The most recently updated file at aws-l0/tx on Azure is >1 hr old.
-                    There could be a problem with pypromice processing.
-                    '''
-            )
-        else:
-            logger.info('aws-l0/tx files are current. No alert issued.')
+        def l0_tx_check(current_time):
+            if git_repositories.check_last_commit(
+                    repository_path=l0_tx_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=1),
+                    commit_time_cache=commit_time_cache,
+            ):
+                return Alert(
+                    subject_text="ALERT: aws-l0/tx files are not updating!",
+                    body_text='''
+                        The most recently updated file at aws-l0/tx on Azure is >1 hr old.
+                        There could be a problem with pypromice processing.
+                        '''
+                )
+
+        checks.append(PipelineCheck(
+            name='l0_tx',
+            function=l0_tx_check,
+            ok_message='aws-l0/tx files are current. No alert issued.',
+        ))
 
     # ==============================================================
     # L3 TX
     # ==============================================================
     if l3_tx_path:
-        l3tx_alert = check_update_time(
-            l3_tx_path,
-            current_time=current_time,
-            max_age=timedelta(hours=1),
-        )
-        if l3tx_alert:
-            notification_client.send_alert_email(
-                subject_text="ALERT: aws-l3/tx files are not updating!",
-                body_text='''
-                The most recently updated file at aws-l3/tx on Azure is >1 hr old.
-                There could be a problem with pypromice processing.
-                ''',
-            )
-        else:
-            logger.info('aws-l3/tx files are current. No alert issued.')
+        def l3_tx_check(current_time):
+            if check_update_time(
+                    l3_tx_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=1),
+                    directory_index=directory_index,
+                    tree_watcher=tree_watcher,
+                    scanner=scanner,
+                    filename_pattern=filename_patterns.get('l3_tx'),
+            ):
+                return Alert(
+                    subject_text="ALERT: aws-l3/tx files are not updating!",
+                    body_text='''
+                    The most recently updated file at aws-l3/tx on Azure is >1 hr old.
+                    There could be a problem with pypromice processing.
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='l3_tx',
+            function=l3_tx_check,
+            ok_message='aws-l3/tx files are current. No alert issued.',
+        ))
 
     # ==============================================================
     # L3 level_3 (joined)
     # ==============================================================
     if l3_joined_path:
-        l3joined_alert = check_update_time(
-            l3_joined_path,
-            current_time=current_time,
-            max_age=timedelta(hours=1),
+        def l3_joined_check(current_time):
+            if check_update_time(
+                    l3_joined_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=1),
+                    directory_index=directory_index,
+                    tree_watcher=tree_watcher,
+                    scanner=scanner,
+                    filename_pattern=filename_patterns.get('l3_joined'),
+            ):
+                return Alert(
+                    subject_text="ALERT: aws-l3/level_3 joined files are not updating!",
+                    body_text='''
+                    The most recently updated file at aws-l3/level_3 on Azure is >1 hr old.
+                    There could be a problem with pypromice processing.
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='l3_joined',
+            function=l3_joined_check,
+            ok_message='aws-l3/level_3 files are current. No alert issued.',
+        ))
+
+    # ==============================================================
+    # L3 per station
+    # ==============================================================
+    if station_config is not None:
+        for check_name, name, dir_path in (
+                ('l3_tx_stations', 'aws-l3/tx', l3_tx_path),
+                ('l3_joined_stations', 'aws-l3/level_3', l3_joined_path),
+        ):
+            if not dir_path:
+                continue
+
+            def station_check(current_time, name=name, dir_path=dir_path):
+                stale_stations = check_station_update_time(
+                    dir_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=station_config.getfloat('max-age-hours', fallback=6)),
+                    stations=station_config.getlist('stations', fallback=None) or None,
+                    tree_watcher=tree_watcher,
+                    scanner=scanner,
+                )
+                logger.info(f'{name} stale stations: {list(stale_stations.index)}')
+                if len(stale_stations) > station_config.getint('max-stale-stations', fallback=0):
+                    return Alert(
+                        subject_text=f"ALERT: {len(stale_stations)} stations in {name} are not updating!",
+                        body_text=f'''
+                        The following stations in {name} on Azure have not been updated within the expected time:
+                        {stale_stations.to_string()}
+                        ''',
+                    )
+
+            checks.append(PipelineCheck(
+                name=check_name,
+                function=station_check,
+                ok_message=f'{name} stations are current. No alert issued.',
+            ))
+
+    # ==============================================================
+    # L3 per station content
+    # ==============================================================
+    if content_config is not None:
+        from alert_processing.content_freshness import ContentTimestampCache, check_station_content_time
+
+        content_cache = resources.get(
+            ('content_cache', content_cache_path),
+            lambda: ContentTimestampCache(cache_path=content_cache_path),
         )
+        for check_name, name, dir_path in (
+                ('l3_tx_content', 'aws-l3/tx', l3_tx_path),
+                ('l3_joined_content', 'aws-l3/level_3', l3_joined_path),
+        ):
+            if not dir_path:
+                continue
+
+            def content_check(current_time, name=name, dir_path=dir_path):
+                stale_stations = check_station_content_time(
+                    dir_path,
+                    current_time=current_time,
+                    max_age=timedelta(hours=content_config.getfloat('max-age-hours', fallback=6)),
+                    stations=content_config.getlist('stations', fallback=None) or None,
+                    cache=content_cache,
+                    max_workers=content_config.getint('max-workers', fallback=8),
+                )
+                logger.info(f'{name} stations with old records: {list(stale_stations)}')
+                if len(stale_stations) > content_config.getint('max-stale-stations', fallback=0):
+                    stale_lines = '\n'.join(
+                        f'{station}: {age if age is not None else "no records"}'
+                        for station, age in stale_stations.items()
+                    )
+                    return Alert(
+                        subject_text=f"ALERT: {len(stale_stations)} stations in {name} have no new observations!",
+                        body_text=f'''
+                        The last records of the following stations in {name} on Azure are older than expected:
+                        {stale_lines}
+                        ''',
+                    )
+
+            checks.append(PipelineCheck(
+                name=check_name,
+                function=content_check,
+                ok_message=f'{name} station records are current. No alert issued.',
+            ))
+
+    # ==============================================================
+    # Pipeline latency
+    # ==============================================================
+    if latency_config is not None:
+        from alert_processing.pipeline_latency import DEFAULT_BUFR_STATION_PATTERN, check_pipeline_latency
+
+        stage_settings = dict(
+            l0_tx_path=l0_tx_path,
+            l3_tx_path=l3_tx_path,
+            l3_joined_path=l3_joined_path,
+            bufr_out_path=bufr_out_path,
+            # Share the commit times read by the l0_tx check
+            commit_time_cache=commit_time_cache if l0_tx_path else None,
+            bufr_station_pattern=latency_config.get('bufr-station-pattern', DEFAULT_BUFR_STATION_PATTERN),
+            scanner=scanner,
+        )
+        max_source_age_hours = latency_config.getfloat('max-source-age-hours', fallback=24)
+
+        def latency_check(current_time):
+            stuck_stations = check_pipeline_latency(
+                current_time=current_time,
+                max_stage_lag=timedelta(hours=latency_config.getfloat('max-stage-lag-hours', fallback=2)),
+                max_source_age=timedelta(hours=max_source_age_hours) if max_source_age_hours else None,
+                stations=latency_config.getlist('stations', fallback=None) or None,
+                dmi_time=get_dmi_time(dmi_ftp_config, current_time, dmi_status_cache=dmi_status_cache),
+                **stage_settings,
+            )
+            logger.info(f'Stations stuck in the pipeline: {dict(stuck_stations["stuck_stage"])}')
+            if len(stuck_stations) > latency_config.getint('max-stuck-stations', fallback=0):
+                stuck_lines = '\n'.join(
+                    f'{station}: stops at {row.stuck_stage}, {row.stage_lag} behind'
+                    for station, row in stuck_stations.iterrows()
+                )
+                return Alert(
+                    subject_text=f"ALERT: data of {len(stuck_stations)} stations is stuck in the pipeline!",
+                    body_text=f'''
+                    The newest data of the following stations does not reach the next processing stage on Azure:
+                    {stuck_lines}
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='pipeline_latency',
+            function=latency_check,
+            ok_message='Data of all stations passes through the pipeline. No alert issued.',
+        ))
 
-        if l3joined_alert:
-            notification_client.send_alert_email(
-                subject_text="ALERT: aws-l3/level_3 joined files are not updating!",
-                body_text='''
-                The most recently updated file at aws-l3/level_3 on Azure is >1 hr old.
-                There could be a problem with pypromice processing.
-                ''',
+    # ==============================================================
+    # Disk capacity
+    # ==============================================================
+    if capacity_config is not None and capacity_path is not None:
+        from alert_processing.disk_usage import DiskUsageTracker, check_disk_capacity
+
+        disk_usage_tracker = resources.get(('disk_usage', capacity_path), lambda: DiskUsageTracker(capacity_path))
+        capacity_paths = [Path(path) for path in capacity_config.getlist('paths', fallback=[])] or [
+            path for path in (bufr_out_path, bufr_backup_path, l0_tx_path, l3_tx_path, l3_joined_path) if path
+        ]
+
+        def capacity_check(current_time):
+            problems = check_disk_capacity(
+                disk_usage_tracker,
+                capacity_paths,
+                current_time=current_time,
+                min_time_to_full=timedelta(days=capacity_config.getfloat('min-days-to-full', fallback=14)),
+                window=timedelta(days=capacity_config.getfloat('window-days', fallback=7)),
+                min_samples=capacity_config.getint('min-samples', fallback=3),
             )
-        else:
-            logger.info('aws-l3/level_3 files are current. No alert issued.')
+            if problems:
+                problems_text = '\n'.join(problems)
+                return Alert(
+                    subject_text="ALERT: disk on Azure is filling up!",
+                    body_text=f'''
+                    The following filesystems on Azure are projected to be full soon:
+                    {problems_text}
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='disk_capacity',
+            function=capacity_check,
+            ok_message='Disk capacity is sufficient. No alert issued.',
+        ))
+
+    # ==============================================================
+    # File manifests
+    # ==============================================================
+    if manifest_config is not None and manifest_path is not None:
+        from alert_processing.manifest import ManifestStore, check_manifest_changes
+
+        manifest_store = resources.get(('manifest_store', manifest_path), lambda: ManifestStore(manifest_path))
+        # BUFR_out is not a default, its files are replaced every hour and would all be reported as vanished
+        manifest_paths = [Path(path) for path in manifest_config.getlist('paths', fallback=[])] or [
+            path for path in (l3_tx_path, l3_joined_path) if path
+        ]
+
+        def manifest_check(current_time):
+            problems = []
+            for dir_path in manifest_paths:
+                changes = check_manifest_changes(
+                    dir_path,
+                    manifest_store,
+                    current_time=current_time,
+                    max_age=timedelta(hours=manifest_config.getfloat('max-age-hours', fallback=2)),
+                    pattern=manifest_config.getlist('pattern', fallback=None) or None,
+                )
+                logger.info(f'{dir_path} changes since {changes.previous_time}: {changes.counts}')
+                vanished_count = changes.counts['vanished']
+                if vanished_count > manifest_config.getint('max-vanished-files', fallback=0):
+                    problems.append(f'{vanished_count} files vanished from {dir_path}')
+                if len(changes.stopped_paths) > manifest_config.getint('max-stopped-files', fallback=0):
+                    stopped_lines = '\n'.join(changes.stopped_paths[:50])
+                    problems.append(
+                        f'{len(changes.stopped_paths)} files in {dir_path} stopped updating:\n{stopped_lines}'
+                    )
+            if problems:
+                problems_text = '\n'.join(problems)
+                return Alert(
+                    subject_text="ALERT: files on Azure vanished or stopped updating!",
+                    body_text=f'''
+                    The following changes were found since the previous run:
+                    {problems_text}
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='file_manifest',
+            function=manifest_check,
+            ok_message='No files vanished or stopped updating. No alert issued.',
+        ))
+
+    # ==============================================================
+    # Heartbeats
+    # ==============================================================
+    if heartbeat_config is not None and heartbeat_registry is not None:
+        from alert_processing.heartbeat import check_heartbeats
+
+        def heartbeat_check(current_time):
+            stale_hosts = check_heartbeats(
+                heartbeat_registry,
+                current_time=current_time,
+                max_age=timedelta(minutes=heartbeat_config.getfloat('max-age-minutes', fallback=70)),
+                hosts=heartbeat_config.getlist('hosts', fallback=None) or None,
+            )
+            logger.info(f'Hosts without recent heartbeat: {list(stale_hosts)}')
+            if stale_hosts:
+                stale_lines = '\n'.join(
+                    f'{host}: last heartbeat {age} ago' if seen else f'{host}: no heartbeat since {age} ago'
+                    for host, (age, seen) in stale_hosts.items()
+                )
+                return Alert(
+                    subject_text=f"ALERT: {', '.join(stale_hosts)} down!",
+                    body_text=f'''
+                    The following hosts have not sent a heartbeat to Azure within the expected time:
+                    {stale_lines}
+
+                    If a host is inaccessible, then email GEUS IT at geusithjaelp@geus.dk
+                    ''',
+                )
+
+        checks.append(PipelineCheck(
+            name='heartbeat',
+            function=heartbeat_check,
+            ok_message='All hosts sent a recent heartbeat. No alert issued.',
+        ))
+
+    # ==============================================================
+    # Remote agents
+    # ==============================================================
+    if aggregator_config is not None and summary_store is not None:
+        from alert_processing.remote_agent import check_remote_summary
+
+        remote_max_age_config = remote_max_age_config or dict()
+        default_max_age_hours = float(remote_max_age_config.get('default', 1))
+        max_ages = {
+            name: timedelta(hours=float(value))
+            for name, value in remote_max_age_config.items() if name != 'default'
+        }
+        station_max_age_hours = aggregator_config.getfloat('station-max-age-hours', fallback=None)
+        for agent in aggregator_config.getlist('agents', fallback=[]):
+            def remote_check(current_time, agent=agent):
+                problems = check_remote_summary(
+                    summary_store,
+                    agent,
+                    current_time=current_time,
+                    max_summary_age=timedelta(
+                        minutes=aggregator_config.getfloat('max-summary-age-minutes', fallback=90),
+                    ),
+                    max_ages=max_ages,
+                    default_max_age=timedelta(hours=default_max_age_hours),
+                    station_max_age=timedelta(hours=station_max_age_hours) if station_max_age_hours else None,
+                    max_stale_stations=aggregator_config.getint('max-stale-stations', fallback=0),
+                )
+                if problems:
+                    problems_text = '\n'.join(problems)
+                    return Alert(
+                        subject_text=f"ALERT: data at {agent} is not updating!",
+                        body_text=f'''
+                        The summary sent by the agent at {agent} has the following problems:
+                        {problems_text}
+                        ''',
+                    )
+
+            checks.append(PipelineCheck(
+                name=f'remote_{agent}',
+                function=remote_check,
+                ok_message=f'Data at {agent} is current. No alert issued.',
+            ))
+
+    return checks
+
+
+def check_all_steps(
+        current_time: datetime,
+        notification_client: NotificationClient,
+        bufr_out_path: Optional[Path],
+        bufr_backup_path: Optional[Path],
+        dmi_ftp_config: Mapping,
+        l0_tx_path: Optional[Path],
+        l3_tx_path: Optional[Path],
+        l3_joined_path: Optional[Path],
+        directory_index: Optional[DirectoryIndex] = None,
+        station_config: Optional[Mapping] = None,
+        content_config: Optional[Mapping] = None,
+        max_workers: Optional[int] = None,
+        timeout: Optional[float] = DEFAULT_CHECK_TIMEOUT,
+        state_store: Optional[AlertStateStore] = None,
+) -> List[CheckResult]:
+    logger.info("Checking pipeline data status")
+    checks = build_checks(
+        bufr_out_path=bufr_out_path,
+        bufr_backup_path=bufr_backup_path,
+        dmi_ftp_config=dmi_ftp_config,
+        l0_tx_path=l0_tx_path,
+        l3_tx_path=l3_tx_path,
+        l3_joined_path=l3_joined_path,
+        directory_index=directory_index,
+        station_config=station_config,
+        content_config=content_config,
+    )
+    results = run_checks(checks, current_time, max_workers=max_workers, timeout=timeout, state_store=state_store)
+    dispatch_notifications(results, notification_client)
+    return results
 
 
 def parse_arguments():
@@ -178,14 +726,23 @@ def parse_arguments():
     parser.add_argument('--bufr-out-path', help='Path to BUFR_out directory')
     parser.add_argument('--bufr-backup-path', help='Path to BUFR_backup directory')
     parser.add_argument("--receiver_emails")
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='Discard the directory index and rescan all directories')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and schedule the checks at the intervals in the schedule section')
+    parser.add_argument('--agent', action='store_true',
+                        help='Send a summary of the local paths to the aggregator instead of running the checks')
+    parser.add_argument('--latency-report', action='store_true',
+                        help='Print the age of the data of each station in each pipeline stage instead of the checks')
+    parser.add_argument('--profile', action='store_true',
+                        help='Log the duration of each check and its phases as JSON records')
+    parser.add_argument('--profile-output', type=Path,
+                        help='Directory for cProfile statistics of each run. Implies --profile')
     args = parser.parse_args()
     return args
 
 
-if __name__ == '__main__':
-    """Executed from the command line"""
-    args = parse_arguments()
-
+def read_config(args) -> ConfigParser:
     # Set credential paths
     config_parser = ConfigParser(
         converters={
@@ -207,8 +764,10 @@ if __name__ == '__main__':
         config_parser.set('local', 'l3-joined-path', args.l3_joined_path),
     if args.receiver_emails:
         config_parser.set('monitoring', 'receiver_emails', args.receiver_emails),
+    return config_parser
+
 
-    # Setup logging
+def setup_logging(config_parser: ConfigParser):
     handlers = [
         logging.StreamHandler(stream=sys.stdout)
     ]
@@ -230,6 +789,12 @@ if __name__ == '__main__':
         handlers=handlers,
     )
 
+
+def create_notification_client(
+        config_parser: ConfigParser,
+        state_store: Optional[AlertStateStore] = None,
+        delivery_worker: Optional['OutboxDeliveryWorker'] = None,
+) -> NotificationClient:
     # Define accounts and credentials ini file paths
     receiver_emails = config_parser.getlist('monitoring', 'receiver_emails')
     if any(receiver_emails):
@@ -239,19 +804,382 @@ if __name__ == '__main__':
             smtp_server=config_parser.get('aws', 'server'),
             port=config_parser.getint('aws', 'port'),
             password=config_parser.get('aws', 'password'),
+            timeout=config_parser.getfloat('aws', 'timeout', fallback=60),
         )
+        if delivery_worker is not None:
+            # The worker is kept across reloads and delivers with the settings of the latest configuration
+            delivery_worker.client = notification_client
+            delivery_worker.wake()
+            notification_client = OutboxNotificationClient(delivery_worker)
     else:
         logger.info("Not receiver")
         notification_client = LogNotificationClient()
 
-    current_time = datetime.now(tz=timezone.utc)
-    check_all_steps(
-        current_time=current_time,
-        notification_client=notification_client,
+    # digest: one email with all alerts, separate: one email per alert over a single connection
+    notification_mode = config_parser.get('monitoring', 'notification-mode', fallback='digest')
+    if notification_mode in ('digest', 'separate'):
+        notification_client = BatchingNotificationClient(notification_client, digest=notification_mode == 'digest')
+    elif notification_mode != 'immediate':
+        raise ValueError(f"Unknown notification-mode: {notification_mode}")
+
+    if state_store is not None:
+        # Repeated alerts are sent every renotify-hours, or only once if renotify-hours is 0
+        renotify_hours = config_parser.getfloat('monitoring', 'renotify-hours', fallback=24)
+        notification_client = StatefulNotificationClient(
+            notification_client,
+            state_store=state_store,
+            renotify_interval=timedelta(hours=renotify_hours) if renotify_hours > 0 else None,
+        )
+    return notification_client
+
+
+def get_state_path(config_parser: ConfigParser, option: str, suffix: str) -> Optional[Path]:
+    """Path of a state file. State files are stored next to the log file unless configured explicitly."""
+    state_path = config_parser.getpath('local', option, fallback=None)
+    log_path = config_parser.getpath('logging', 'log_path', fallback=None)
+    if state_path is None and isinstance(log_path, Path):
+        state_path = log_path.with_suffix(suffix)
+    return state_path
+
+
+def create_directory_index(config_parser: ConfigParser) -> Optional[DirectoryIndex]:
+    index_path = get_state_path(config_parser, 'index-path', '.index.sqlite')
+    if index_path is None:
+        return None
+    return DirectoryIndex(index_path)
+
+
+def create_state_store(config_parser: ConfigParser) -> Optional[AlertStateStore]:
+    state_path = get_state_path(config_parser, 'state-path', '.state.sqlite')
+    if state_path is None:
+        return None
+    return AlertStateStore(state_path)
+
+
+def create_delivery_worker(config_parser: ConfigParser) -> Optional['OutboxDeliveryWorker']:
+    """Outbox for the email notifications. The email client is set by create_notification_client."""
+    outbox_path = get_state_path(config_parser, 'outbox-path', '.outbox.jsonl')
+    if outbox_path is None or not config_parser.getboolean('outbox', 'enabled', fallback=True):
+        return None
+    from alert_processing.outbox import Outbox, OutboxDeliveryWorker
+
+    max_per_hour = config_parser.getfloat('outbox', 'max-per-hour', fallback=20)
+    return OutboxDeliveryWorker(
+        outbox=Outbox(outbox_path),
+        min_retry_delay=timedelta(minutes=config_parser.getfloat('outbox', 'min-retry-minutes', fallback=1)),
+        max_retry_delay=timedelta(minutes=config_parser.getfloat('outbox', 'max-retry-minutes', fallback=60)),
+        max_per_hour=max_per_hour if max_per_hour > 0 else None,
+        max_batch=config_parser.getint('outbox', 'max-batch', fallback=10),
+    )
+
+
+def create_history(config_parser: ConfigParser) -> Optional['FreshnessHistory']:
+    history_path = get_state_path(config_parser, 'history-path', '.history')
+    if history_path is None:
+        return None
+    from alert_processing.history import FreshnessHistory
+
+    return FreshnessHistory(history_path)
+
+
+def create_tree_watcher(config_parser: ConfigParser) -> Optional['TreeWatcher']:
+    """Start an inotify watcher of the local paths for daemon mode. Returns None if disabled or unavailable"""
+    if not config_parser.getboolean('monitoring', 'inotify', fallback=True):
+        return None
+    from alert_processing.tree_watcher import TreeWatcher
+
+    tree_watcher = TreeWatcher(
+        resync_interval=timedelta(hours=config_parser.getfloat('monitoring', 'inotify-resync-hours', fallback=24)),
+    )
+    try:
+        tree_watcher.start()
+    except OSError as e:
+        logger.warning(f"inotify is not available, scanning the directories instead: {e}")
+        return None
+    return tree_watcher
+
+
+def create_sharded_scanner(config_parser: ConfigParser) -> Optional['ShardedScanner']:
+    """Pool for full scans of the station directories, None if scan-workers is not configured"""
+    scan_workers = config_parser.getint('monitoring', 'scan-workers', fallback=0)
+    if scan_workers <= 0:
+        return None
+    from alert_processing.sharded_scan import ShardedScanner
+
+    return ShardedScanner(
+        max_workers=scan_workers,
+        use_processes=config_parser.getboolean('monitoring', 'scan-processes', fallback=False),
+    )
+
+
+def create_heartbeat_receiver(config_parser: ConfigParser) -> Optional['HeartbeatReceiver']:
+    """Start receiving heartbeats for daemon mode if the heartbeat section is configured"""
+    if not config_parser.has_section('heartbeat'):
+        return None
+    from alert_processing.heartbeat import HeartbeatReceiver, HeartbeatRegistry
+
+    receiver = HeartbeatReceiver(
+        heartbeat_registry=HeartbeatRegistry(token=config_parser.get('heartbeat', 'token', fallback=None) or None),
+        bind=config_parser.get('heartbeat', 'bind', fallback=''),
+        udp_port=config_parser.getint('heartbeat', 'udp-port', fallback=None),
+        http_port=config_parser.getint('heartbeat', 'http-port', fallback=None),
+    )
+    receiver.start()
+    return receiver
+
+
+def create_summary_receiver(config_parser: ConfigParser) -> Optional['SummaryReceiver']:
+    """Start receiving agent summaries for daemon mode if the aggregator section is configured"""
+    if not config_parser.has_section('aggregator'):
+        return None
+    from alert_processing.remote_agent import SummaryReceiver, SummaryStore
+
+    receiver = SummaryReceiver(
+        store=SummaryStore(get_state_path(config_parser, 'summaries-path', '.summaries.json')),
+        port=config_parser.getint('aggregator', 'http-port', fallback=9480),
+        bind=config_parser.get('aggregator', 'bind', fallback=''),
+        token=config_parser.get('aggregator', 'token', fallback=None) or None,
+    )
+    receiver.start()
+    return receiver
+
+
+def run_agent(config_parser: ConfigParser) -> bool:
+    """Summarize the local paths and send the summary to the aggregator. Returns False if it could not be sent."""
+    from alert_processing.remote_agent import build_summary, default_agent_name, send_summary
+
+    local_paths = {
+        name: config_parser.getpath('local', option, fallback=None)
+        for name, option in (
+            ('bufr_out', 'bufr-out-path'),
+            ('bufr_backup', 'bufr-backup-path'),
+            ('l3_tx', 'l3-tx-path'),
+            ('l3_joined', 'l3-joined-path'),
+        )
+    }
+    l0_tx_path = config_parser.getpath('local', 'l0-tx-path', fallback=None)
+    repository_paths = {'l0_tx': l0_tx_path} if l0_tx_path else dict()
+    summary = build_summary(
+        agent=config_parser.get('agent', 'name', fallback=None) or default_agent_name(),
+        tree_paths={name: path for name, path in local_paths.items() if path},
+        repository_paths=repository_paths,
+        commit_time_caches={
+            name: git_repositories.CommitTimeCache(
+                path,
+                cache_path=get_state_path(config_parser, 'git-cache-path', '.git-cache.json'),
+            )
+            for name, path in repository_paths.items()
+        },
+    )
+    aggregator_url = config_parser.get('agent', 'aggregator-url')
+    try:
+        send_summary(
+            aggregator_url,
+            summary,
+            token=config_parser.get('agent', 'token', fallback=None) or None,
+            timeout=config_parser.getfloat('agent', 'timeout', fallback=30),
+        )
+    except OSError as e:
+        # URLError, HTTPError and timeouts are all OSErrors
+        logger.error(f"Unable to send the summary to {aggregator_url}: {e}")
+        return False
+    return True
+
+
+def print_latency_report(config_parser: ConfigParser, scanner: Optional['ShardedScanner'] = None):
+    """Print the station x stage latency matrix of the local paths"""
+    import pandas as pd
+
+    from alert_processing.pipeline_latency import (
+        DEFAULT_BUFR_STATION_PATTERN,
+        collect_stage_times,
+        compute_latency_matrix,
+    )
+
+    latency_config = config_parser['latency'] if config_parser.has_section('latency') else dict()
+    l0_tx_path = config_parser.getpath('local', 'l0-tx-path', fallback=None)
+    stage_times = collect_stage_times(
+        l0_tx_path=l0_tx_path,
+        l3_tx_path=config_parser.getpath('local', 'l3-tx-path', fallback=None),
+        l3_joined_path=config_parser.getpath('local', 'l3-joined-path', fallback=None),
+        bufr_out_path=config_parser.getpath('local', 'bufr-out-path', fallback=None),
+        dmi_time=get_dmi_time(config_parser['dmi']),
+        commit_time_cache=git_repositories.CommitTimeCache(
+            l0_tx_path,
+            cache_path=get_state_path(config_parser, 'git-cache-path', '.git-cache.json'),
+        ) if l0_tx_path else None,
+        bufr_station_pattern=latency_config.get('bufr-station-pattern', DEFAULT_BUFR_STATION_PATTERN),
+        scanner=scanner,
+    )
+    max_source_age_hours = float(latency_config.get('max-source-age-hours', 24))
+    latency = compute_latency_matrix(
+        stage_times,
+        current_time=datetime.now(tz=timezone.utc),
+        max_stage_lag=timedelta(hours=float(latency_config.get('max-stage-lag-hours', 2))),
+        max_source_age=timedelta(hours=max_source_age_hours) if max_source_age_hours else None,
+    )
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(latency.to_string())
+
+
+def build_checks_from_config(
+        config_parser: ConfigParser,
+        directory_index: Optional[DirectoryIndex] = None,
+        tree_watcher: Optional['TreeWatcher'] = None,
+        heartbeat_registry: Optional['HeartbeatRegistry'] = None,
+        summary_store: Optional['SummaryStore'] = None,
+        scanner: Optional['ShardedScanner'] = None,
+        resources: Optional[CheckResources] = None,
+) -> List[PipelineCheck]:
+    checks = build_checks(
         dmi_ftp_config=config_parser['dmi'],
         bufr_out_path=config_parser.getpath('local', 'bufr-out-path', fallback=None),
         bufr_backup_path=config_parser.getpath('local', 'bufr-backup-path', fallback=None),
         l0_tx_path=config_parser.getpath('local', 'l0-tx-path', fallback=None),
         l3_tx_path=config_parser.getpath('local', 'l3-tx-path', fallback=None),
         l3_joined_path=config_parser.getpath('local', 'l3-joined-path', fallback=None),
+        directory_index=directory_index,
+        station_config=config_parser['stations'] if config_parser.has_section('stations') else None,
+        git_cache_path=get_state_path(config_parser, 'git-cache-path', '.git-cache.json'),
+        content_config=config_parser['content'] if config_parser.has_section('content') else None,
+        content_cache_path=get_state_path(config_parser, 'content-cache-path', '.content-cache.json'),
+        bufr_config=config_parser['bufr'] if config_parser.has_section('bufr') else None,
+        tree_watcher=tree_watcher,
+        scanner=scanner,
+        heartbeat_config=config_parser['heartbeat'] if config_parser.has_section('heartbeat') else None,
+        heartbeat_registry=heartbeat_registry,
+        aggregator_config=config_parser['aggregator'] if config_parser.has_section('aggregator') else None,
+        remote_max_age_config=(
+            config_parser['remote-max-age-hours'] if config_parser.has_section('remote-max-age-hours') else None
+        ),
+        summary_store=summary_store,
+        filename_patterns=(
+            config_parser['filename-patterns'] if config_parser.has_section('filename-patterns') else None
+        ),
+        capacity_config=config_parser['capacity'] if config_parser.has_section('capacity') else None,
+        capacity_path=get_state_path(config_parser, 'capacity-path', '.capacity.sqlite'),
+        latency_config=config_parser['latency'] if config_parser.has_section('latency') else None,
+        manifest_config=config_parser['manifest'] if config_parser.has_section('manifest') else None,
+        manifest_path=get_state_path(config_parser, 'manifest-path', '.manifests'),
+        resources=resources,
     )
+    # Check intervals in minutes for daemon mode
+    default_interval = config_parser.getfloat('schedule', 'default', fallback=60)
+    # Minutes after a success during which a check is not rerun
+    default_rescan = config_parser.getfloat('rescan', 'default', fallback=None)
+    return [
+        attr.evolve(
+            check,
+            interval=timedelta(minutes=config_parser.getfloat('schedule', check.name, fallback=default_interval)),
+            skip_if_passed_within=_minutes(config_parser.getfloat('rescan', check.name, fallback=default_rescan)),
+        )
+        for check in checks
+    ]
+
+
+def _minutes(value: Optional[float]) -> Optional[timedelta]:
+    return timedelta(minutes=value) if value is not None else None
+
+
+if __name__ == '__main__':
+    """Executed from the command line"""
+    args = parse_arguments()
+    config_parser = read_config(args)
+    setup_logging(config_parser)
+    if args.profile or args.profile_output:
+        profiling.enable(profile_directory=args.profile_output)
+
+    directory_index = create_directory_index(config_parser)
+    if directory_index is not None and args.rebuild_index:
+        directory_index.rebuild()
+    state_store = create_state_store(config_parser)
+    delivery_worker = create_delivery_worker(config_parser)
+    history = create_history(config_parser)
+    scanner = create_sharded_scanner(config_parser)
+
+    if args.agent:
+        sent = run_agent(config_parser)
+        profiling.dump_stats()
+        if not sent:
+            sys.exit(1)
+    elif args.latency_report:
+        print_latency_report(config_parser, scanner=scanner)
+    elif args.daemon:
+        from alert_processing.daemon import Schedule, run_daemon
+
+        tree_watcher = create_tree_watcher(config_parser)
+        # The receiver keeps its ports across reloads, only the checked hosts and maximum age are reloaded
+        heartbeat_receiver = create_heartbeat_receiver(config_parser)
+        summary_receiver = create_summary_receiver(config_parser)
+        # Caches of the checks are reused across reloads as long as their settings are unchanged
+        resources = CheckResources()
+
+        def load_daemon_config():
+            reloaded_config = read_config(args)
+            resources.begin()
+            checks = build_checks_from_config(
+                reloaded_config,
+                directory_index=directory_index,
+                tree_watcher=tree_watcher,
+                heartbeat_registry=heartbeat_receiver.heartbeat_registry if heartbeat_receiver else None,
+                summary_store=summary_receiver.store if summary_receiver else None,
+                scanner=scanner,
+                resources=resources,
+            )
+            resources.release_unused()
+            return Schedule(
+                checks=checks,
+                notification_client=create_notification_client(
+                    reloaded_config,
+                    state_store=state_store,
+                    delivery_worker=delivery_worker,
+                ),
+                max_workers=reloaded_config.getint('monitoring', 'max-workers', fallback=None),
+                timeout=reloaded_config.getfloat('monitoring', 'check-timeout', fallback=DEFAULT_CHECK_TIMEOUT),
+                state_store=state_store,
+                metrics_textfile_path=reloaded_config.getpath('metrics', 'textfile-path', fallback=None),
+                metrics_port=reloaded_config.getint('metrics', 'http-port', fallback=None),
+                history=history,
+            )
+
+        if delivery_worker is not None:
+            delivery_worker.start()
+        try:
+            run_daemon(load_daemon_config)
+        finally:
+            resources.close()
+        if delivery_worker is not None:
+            delivery_worker.close(timeout=10)
+    else:
+        current_time = datetime.now(tz=timezone.utc)
+        resources = CheckResources()
+        try:
+            results = run_checks(
+                build_checks_from_config(
+                    config_parser, directory_index=directory_index, scanner=scanner, resources=resources,
+                ),
+                current_time,
+                max_workers=config_parser.getint('monitoring', 'max-workers', fallback=None),
+                timeout=config_parser.getfloat('monitoring', 'check-timeout', fallback=DEFAULT_CHECK_TIMEOUT),
+                state_store=state_store,
+            )
+        finally:
+            resources.close()
+        dispatch_notifications(
+            results,
+            create_notification_client(config_parser, state_store=state_store, delivery_worker=delivery_worker),
+        )
+        if history is not None:
+            try:
+                history.append_results(results, time=current_time)
+            except Exception:
+                logger.exception("Failed to append to the history")
+        if delivery_worker is not None:
+            # Undelivered notifications stay in the outbox and are retried by the next run
+            delivery_worker.deliver_pending()
+        profiling.dump_stats()
+        metrics_textfile_path = config_parser.getpath('metrics', 'textfile-path', fallback=None)
+        if metrics_textfile_path is not None:
+            metrics.write_textfile(metrics_textfile_path)
+    if scanner is not None:
+        scanner.close()
@@ -0,0 +1,373 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.email_notification import NotificationClient
+from alert_processing.metrics import registry
+
+__all__ = [
+    'DEFAULT_CHECK_TIMEOUT',
+    'Alert',
+    'PipelineCheck',
+    'CheckResult',
+    'report_data_age',
+    'CheckBatch',
+    'start_checks',
+    'run_checks',
+    'dispatch_notifications',
+]
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which a check that has not finished is reported as failed
+DEFAULT_CHECK_TIMEOUT = 600.
+
+_observations = threading.local()
+# Checks whose thread has not finished, including checks that timed out in a previous run
+_running: Dict[str, Future] = dict()
+_running_lock = threading.Lock()
+# Seconds between looking for checks that got a worker slot after the collector started waiting
+_SLOT_POLL_INTERVAL = 1.
+
+
+@attr.s(frozen=True)
+class Alert:
+    subject_text: str = attr.ib()
+    body_text: str = attr.ib()
+
+
+@attr.s(frozen=True)
+class PipelineCheck:
+    """
+    A single named check of the pipeline.
+
+    `function` is called with the current time and returns an Alert if the check is in alert condition and None if
+    it passes. `interval` is how often the check is run in daemon mode. If `skip_if_passed_within` is set, the check is
+    skipped while its last success recorded in the state store is more recent than that.
+    """
+    name: str = attr.ib()
+    function: Callable[[datetime], Optional[Alert]] = attr.ib()
+    ok_message: Optional[str] = attr.ib(default=None)
+    interval: timedelta = attr.ib(default=timedelta(hours=1))
+    skip_if_passed_within: Optional[timedelta] = attr.ib(default=None)
+
+
+@attr.s
+class CheckResult:
+    name: str = attr.ib()
+    alert: Optional[Alert] = attr.ib(default=None)
+    duration: Optional[float] = attr.ib(default=None)
+    error: Optional[BaseException] = attr.ib(default=None)
+    ok_message: Optional[str] = attr.ib(default=None)
+    skipped: bool = attr.ib(default=False)
+    # Age in seconds of the newest data seen by the check, keyed by station or None for the check as a whole
+    data_ages: Dict[Optional[str], float] = attr.ib(factory=dict)
+    # Keys of the data ages which are upper bounds, because the scan stopped at the first fresh file
+    upper_bound_ages: Set[Optional[str]] = attr.ib(factory=set)
+
+
+def report_data_age(age: timedelta, station: Optional[str] = None, upper_bound: bool = False):
+    """
+    Record the age of the newest data seen by the check running in the current thread.
+
+    With `upper_bound` the newest data may be younger than `age`, e.g. if the scan stopped at the first fresh file.
+    """
+    data_ages = getattr(_observations, 'data_ages', None)
+    if data_ages is not None:
+        data_ages[station] = age.total_seconds()
+        if upper_bound:
+            _observations.upper_bound_ages.add(station)
+        else:
+            _observations.upper_bound_ages.discard(station)
+
+
+def _run_check(check: PipelineCheck, current_time: datetime) -> CheckResult:
+    start_time = time.perf_counter()
+    _observations.data_ages = data_ages = dict()
+    _observations.upper_bound_ages = upper_bound_ages = set()
+    with profiling.profile_thread(), profiling.span('check', check=check.name) as check_span:
+        try:
+            alert = check.function(current_time)
+            error = None
+        except Exception as e:
+            logger.exception(f"Check {check.name} failed")
+            alert = None
+            error = e
+        finally:
+            _observations.data_ages = None
+            _observations.upper_bound_ages = None
+        check_span.set(alert=alert is not None, failed=error is not None)
+    duration = time.perf_counter() - start_time
+    logger.info(f"Check {check.name} finished in {duration:.3f} s")
+    registry.observe('aws_monitor_check_duration_seconds', duration, help='Duration of each check', check=check.name)
+    registry.set_gauge(
+        'aws_monitor_check_status',
+        2 if error is not None else int(alert is not None),
+        help='Result of the last run of each check. 0 passing, 1 alert, 2 failed',
+        check=check.name,
+    )
+    registry.set_gauge(
+        'aws_monitor_check_last_run_timestamp_seconds',
+        time.time(),
+        help='Unix time of the last run of each check',
+        check=check.name,
+    )
+    return CheckResult(
+        name=check.name,
+        alert=alert,
+        duration=duration,
+        error=error,
+        ok_message=check.ok_message,
+        data_ages=data_ages,
+        upper_bound_ages=upper_bound_ages,
+    )
+
+
+@attr.s(eq=False)
+class _CheckRun:
+    future: Future = attr.ib(factory=Future)
+    # Monotonic time the check got a worker slot, None while it waits for one
+    started_at: Optional[float] = attr.ib(default=None)
+    _slot_held: bool = attr.ib(default=False)
+    _lock: threading.Lock = attr.ib(factory=threading.Lock)
+
+    def acquire_slot(self, slots: threading.Semaphore):
+        slots.acquire()
+        with self._lock:
+            self._slot_held = True
+            self.started_at = time.monotonic()
+
+    def release_slot(self, slots: threading.Semaphore):
+        """Give the slot back, either when the check finished or when it timed out and is left running"""
+        with self._lock:
+            if self._slot_held:
+                self._slot_held = False
+                slots.release()
+
+
+def _start_check(check: PipelineCheck, current_time: datetime, slots: threading.Semaphore) -> _CheckRun:
+    """Run the check in a daemon thread, so that a hanging check does not keep the process alive at exit"""
+    check_run = _CheckRun()
+    future = check_run.future
+    future.set_running_or_notify_cancel()
+
+    def run():
+        try:
+            check_run.acquire_slot(slots)
+            try:
+                result = _run_check(check, current_time)
+            finally:
+                check_run.release_slot(slots)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with _running_lock:
+                if _running.get(check.name) is future:
+                    del _running[check.name]
+
+    with _running_lock:
+        _running[check.name] = future
+    threading.Thread(target=run, name=f'check-{check.name}', daemon=True).start()
+    return check_run
+
+
+@attr.s(eq=False)
+class CheckBatch:
+    """
+    Checks started together by `start_checks`, whose results are collected as they finish or time out.
+
+    The timeout of each check counts from when it got a worker slot, so checks waiting for a slot are not reported as
+    timed out. A check that timed out gives its slot back to the waiting checks, but keeps running in the background
+    since Python threads cannot be cancelled.
+    """
+    checks: Sequence[PipelineCheck] = attr.ib()
+    timeout: Optional[float] = attr.ib()
+    _slots: threading.Semaphore = attr.ib(repr=False)
+    _runs: Dict[str, _CheckRun] = attr.ib(factory=dict, repr=False)
+    # Results ready but not collected yet
+    _results: Dict[str, CheckResult] = attr.ib(factory=dict, repr=False)
+
+    @property
+    def in_flight(self) -> Set[str]:
+        """Names of the checks whose result has not been collected"""
+        return set(self._runs) | set(self._results)
+
+    @property
+    def done(self) -> bool:
+        return not self._runs and not self._results
+
+    def collect(self) -> List[CheckResult]:
+        """Results of the checks that finished or timed out since the previous call, in the order of `checks`"""
+        now = time.monotonic()
+        for name, check_run in list(self._runs.items()):
+            if check_run.future.done():
+                self._results[name] = check_run.future.result()
+            elif self.timeout is not None and check_run.started_at is not None \
+                    and now - check_run.started_at >= self.timeout:
+                logger.error(f"Check {name} did not finish within {self.timeout} s")
+                registry.set_gauge('aws_monitor_check_status', 2, check=name)
+                check_run.release_slot(self._slots)
+                ok_message = next(check.ok_message for check in self.checks if check.name == name)
+                self._results[name] = CheckResult(name=name, error=TimeoutError(), ok_message=ok_message)
+            else:
+                continue
+            del self._runs[name]
+        return [self._results.pop(check.name) for check in self.checks if check.name in self._results]
+
+    def get_wait_time(self) -> Optional[float]:
+        """Seconds until a running check times out, None if no running check can time out"""
+        if not self._runs or self.timeout is None:
+            return None
+        now = time.monotonic()
+        wait_times = [
+            check_run.started_at + self.timeout - now if check_run.started_at is not None else _SLOT_POLL_INTERVAL
+            for check_run in self._runs.values()
+        ]
+        return max(min(wait_times), 0.)
+
+    def wait(self):
+        """Wait until a check finishes or times out"""
+        if self._results or not self._runs:
+            return
+        wait([check_run.future for check_run in self._runs.values()], self.get_wait_time(), FIRST_COMPLETED)
+
+
+def start_checks(
+        checks: Sequence[PipelineCheck],
+        current_time: datetime,
+        max_workers: Optional[int] = None,
+        timeout: Optional[float] = DEFAULT_CHECK_TIMEOUT,
+        state_store: Optional[AlertStateStore] = None,
+        slots: Optional[threading.Semaphore] = None,
+        on_done: Optional[Callable[[], None]] = None,
+) -> CheckBatch:
+    """
+    Start all checks concurrently in threads without waiting for them, see `run_checks`.
+
+    At most `max_workers` checks run at once, or as many as `slots` allows if a semaphore shared between batches is
+    provided. `on_done` is called from the thread of each check when it finishes.
+    """
+    skipped_checks = set()
+    if state_store is not None:
+        skipped_checks = {
+            check.name for check in checks
+            if check.skip_if_passed_within is not None
+            and state_store.passed_within(check.name, check.skip_if_passed_within, current_time)
+        }
+        for name in sorted(skipped_checks):
+            logger.info(f"Skipping check {name} which passed recently")
+    results = {name: CheckResult(name=name, skipped=True) for name in skipped_checks}
+    with _running_lock:
+        still_running = {check.name for check in checks if check.name in _running} - skipped_checks
+    for check in checks:
+        if check.name in still_running:
+            logger.error(f"Check {check.name} is still running since a previous run, not starting it again")
+            registry.set_gauge('aws_monitor_check_status', 2, check=check.name)
+            results[check.name] = CheckResult(
+                name=check.name,
+                error=TimeoutError('The previous run of the check has not finished'),
+                ok_message=check.ok_message,
+            )
+    checks_to_run = [check for check in checks if check.name not in results]
+    if slots is None:
+        slots = threading.Semaphore(max_workers or max(len(checks_to_run), 1))
+    runs = dict()
+    for check in checks_to_run:
+        runs[check.name] = check_run = _start_check(check, current_time, slots)
+        if on_done is not None:
+            check_run.future.add_done_callback(lambda future: on_done())
+    return CheckBatch(checks=checks, timeout=timeout, slots=slots, runs=runs, results=results)
+
+
+def run_checks(
+        checks: Sequence[PipelineCheck],
+        current_time: datetime,
+        max_workers: Optional[int] = None,
+        timeout: Optional[float] = DEFAULT_CHECK_TIMEOUT,
+        state_store: Optional[AlertStateStore] = None,
+) -> List[CheckResult]:
+    """
+    Run all checks concurrently in threads and collect their results in the order of `checks`.
+
+    Checks which passed recently according to `state_store` are skipped, see `PipelineCheck.skip_if_passed_within`.
+
+    Checks which have not finished within `timeout` seconds of getting one of the `max_workers` slots are reported
+    with a TimeoutError. Python threads cannot be cancelled, so a hanging check keeps running in the background. It
+    is not started again while it is still running, and is reported as failed instead.
+    """
+    start_time = time.perf_counter()
+    results = dict()
+    with profiling.span('run_checks', checks=len(checks)):
+        batch = start_checks(checks, current_time, max_workers=max_workers, timeout=timeout, state_store=state_store)
+        while not batch.done:
+            batch.wait()
+            results.update((result.name, result) for result in batch.collect())
+    logger.info(f"Ran {len(checks)} checks in {time.perf_counter() - start_time:.3f} s")
+    return [results[check.name] for check in checks]
+
+
+def dispatch_notifications(
+        results: Sequence[CheckResult],
+        notification_client: NotificationClient,
+):
+    """
+    Send a notification for each check result in alert condition or which failed to run and flush the notification
+    client afterwards.
+    """
+    with profiling.span('dispatch', results=len(results)):
+        _dispatch_notifications(results, notification_client)
+
+
+def _dispatch_notifications(
+        results: Sequence[CheckResult],
+        notification_client: NotificationClient,
+):
+    for result in results:
+        if result.alert is not None:
+            alert = result.alert
+        elif result.error is not None:
+            alert = Alert(
+                subject_text=f"ALERT: {result.name} check failed!",
+                body_text=f'''
+                The {result.name} check could not be completed: {result.error!r}
+                ''',
+            )
+        elif result.skipped:
+            continue
+        else:
+            if result.ok_message:
+                logger.info(result.ok_message)
+            try:
+                notification_client.notify_ok(result.name)
+            except Exception:
+                logger.exception(f"Failed to record passing check {result.name}")
+            continue
+
+        start_time = time.perf_counter()
+        try:
+            notification_client.send_alert_email(
+                subject_text=alert.subject_text,
+                body_text=alert.body_text,
+                check_name=result.name,
+            )
+        except Exception:
+            logger.exception(f"Failed to send notification for {result.name}")
+            continue
+        logger.info(f"Notification for {result.name} sent in {time.perf_counter() - start_time:.3f} s")
+
+    start_time = time.perf_counter()
+    try:
+        notification_client.flush()
+    except Exception:
+        logger.exception("Failed to send pending notifications")
+        return
+    logger.debug(f"Notification client flushed in {time.perf_counter() - start_time:.3f} s")
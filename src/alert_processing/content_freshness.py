@@ -0,0 +1,332 @@
+"""
+Freshness of the L3 data based on the timestamps of the last records instead of the file modification times.
+
+pypromice may rewrite a file without adding observations, which updates the modification time but not the content.
+The last timestamp of a CSV file is read by seeking backwards from the end of the file. NetCDF files are opened
+lazily with xarray and only the last element of the time variable is read, which needs the `netcdf` extra. Without
+it NetCDF files are skipped. Timestamps are cached by file size and modification time, so only files that changed
+since the previous run are read.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.file_system_status import scan_tree
+from alert_processing.metrics import registry
+
+__all__ = [
+    'read_last_csv_timestamp',
+    'read_last_netcdf_timestamp',
+    'is_netcdf_readable',
+    'read_last_timestamp',
+    'ContentTimestampCache',
+    'get_station_content_times',
+    'check_station_content_time',
+]
+
+logger = logging.getLogger(__name__)
+
+CSV_SUFFIXES = ('.csv',)
+NETCDF_SUFFIXES = ('.nc',)
+# Number of lines from the end of a CSV file tried before giving up, e.g. if the last line is being written
+_MAX_TAIL_LINES = 5
+# Whether xarray and a NetCDF4 backend are installed, None until the first NetCDF file is found
+_netcdf_readable: Optional[bool] = None
+_netcdf_readable_lock = threading.Lock()
+
+
+def _iter_lines_reversed(path: Path, block_size: int = 4096) -> Iterator[bytes]:
+    """Yield the non-empty lines of a file from the last to the first, reading blocks from the end"""
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        remainder = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            # The first part may be incomplete unless the start of the file has been reached
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if remainder.strip():
+            yield remainder
+
+
+def _parse_timestamp(value: str) -> Optional[datetime]:
+    value = value.strip().strip('"\'')
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def read_last_csv_timestamp(path: Path, delimiter: bytes = b',', column: int = 0) -> Optional[datetime]:
+    """
+    Read the timestamp in `column` of the last record of a CSV file without reading the whole file.
+
+    Returns None if none of the last lines starts with a timestamp, e.g. for a file with only a header.
+    """
+    for line_number, line in enumerate(_iter_lines_reversed(path)):
+        if line_number >= _MAX_TAIL_LINES:
+            break
+        fields = line.split(delimiter)
+        if len(fields) <= column:
+            continue
+        timestamp = _parse_timestamp(fields[column].decode('utf-8', errors='replace'))
+        if timestamp is not None:
+            return timestamp
+    return None
+
+
+def read_last_netcdf_timestamp(path: Path, variable: str = 'time') -> Optional[datetime]:
+    """Read the last element of the time variable of a NetCDF file. Only that element is loaded."""
+    import pandas as pd
+    import xarray as xr
+
+    with xr.open_dataset(path, cache=False, decode_times=True) as dataset:
+        if variable not in dataset.variables or dataset[variable].size == 0:
+            return None
+        value = dataset[variable][-1].values
+    timestamp = pd.Timestamp(value)
+    if pd.isna(timestamp):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.to_pydatetime()
+
+
+def is_netcdf_readable() -> bool:
+    """Whether NetCDF files can be read. A warning is logged once if they cannot."""
+    global _netcdf_readable
+    with _netcdf_readable_lock:
+        if _netcdf_readable is None:
+            try:
+                import xarray as xr
+            except ImportError as e:
+                logger.warning(f"NetCDF files are skipped. Install the netcdf extra to read them: {e}")
+                _netcdf_readable = False
+            else:
+                _netcdf_readable = bool({'netcdf4', 'h5netcdf'}.intersection(xr.backends.list_engines()))
+                if not _netcdf_readable:
+                    logger.warning("NetCDF files are skipped, xarray has no NetCDF4 backend. Install the netcdf extra")
+        return _netcdf_readable
+
+
+def read_last_timestamp(path: Path) -> Optional[datetime]:
+    suffix = Path(path).suffix.lower()
+    if suffix in CSV_SUFFIXES:
+        return read_last_csv_timestamp(path)
+    if suffix in NETCDF_SUFFIXES:
+        return read_last_netcdf_timestamp(path)
+    raise ValueError(f"Unsupported file type: {path}")
+
+
+@attr.s
+class ContentTimestampCache:
+    """
+    Last record timestamps of files keyed by path and validated by size and modification time.
+
+    The cache is optionally persisted in `cache_path` as json. Entries of files that were not seen in a scan are
+    dropped when the cache is saved.
+    """
+    cache_path: Optional[Path] = attr.ib(default=None)
+    entries: Dict[str, Tuple[int, int, Optional[str]]] = attr.ib(init=False, factory=dict)
+    _seen: set = attr.ib(init=False, repr=False, factory=set)
+    _modified: bool = attr.ib(init=False, repr=False, default=False)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path) as f:
+                    self.entries = {path: tuple(entry) for path, entry in json.load(f).items()}
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get(self, path: str, size: int, mtime_ns: int) -> Tuple[bool, Optional[datetime]]:
+        """Return whether the cached entry is valid and the cached timestamp"""
+        with self._lock:
+            self._seen.add(path)
+            entry = self.entries.get(path)
+        if entry is None or entry[0] != size or entry[1] != mtime_ns:
+            return False, None
+        return True, datetime.fromisoformat(entry[2]) if entry[2] else None
+
+    def put(self, path: str, size: int, mtime_ns: int, timestamp: Optional[datetime]):
+        with self._lock:
+            self.entries[path] = (size, mtime_ns, timestamp.isoformat() if timestamp else None)
+            self._modified = True
+
+    def save(self, prefix: Optional[str] = None):
+        """Persist the cache, dropping entries below `prefix` that were not seen since the last save"""
+        if self.cache_path is None:
+            return
+        with self._lock:
+            if prefix is not None:
+                vanished = [
+                    path for path in self.entries
+                    if path.startswith(prefix) and path not in self._seen
+                ]
+                for path in vanished:
+                    del self.entries[path]
+                self._modified = self._modified or bool(vanished)
+                self._seen = {path for path in self._seen if not path.startswith(prefix)}
+            if not self._modified:
+                return
+            temporary_path = Path(f'{self.cache_path}.{threading.get_ident()}.tmp')
+            with open(temporary_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temporary_path, self.cache_path)
+            self._modified = False
+
+
+def _read_cached(
+        entry_path: str,
+        size: int,
+        mtime_ns: int,
+        cache: Optional[ContentTimestampCache],
+) -> Tuple[Optional[datetime], bool]:
+    if cache is not None:
+        valid, timestamp = cache.get(entry_path, size, mtime_ns)
+        if valid:
+            return timestamp, True
+    try:
+        timestamp = read_last_timestamp(Path(entry_path))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unable to read the last timestamp of {entry_path}: {e}")
+        return None, False
+    if cache is not None:
+        cache.put(entry_path, size, mtime_ns, timestamp)
+    return timestamp, False
+
+
+def get_station_content_times(
+        dir_path: Path,
+        cache: Optional[ContentTimestampCache] = None,
+        max_workers: int = 8,
+        suffixes: Sequence[str] = CSV_SUFFIXES + NETCDF_SUFFIXES,
+) -> Dict[str, Optional[datetime]]:
+    """
+    Latest record timestamp per station sub-directory of `dir_path` over all CSV and NetCDF files of the station.
+
+    Files which are not in the cache or have changed are read in a thread pool. Stations without any readable
+    timestamps are None. NetCDF files are skipped if they cannot be read, see `is_netcdf_readable`.
+    """
+    root = os.fspath(dir_path).rstrip(os.sep) + os.sep
+    files = []
+    station_times: Dict[str, Optional[datetime]] = dict()
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_dir=True):
+            station, separator, _ = entry.path[len(root):].partition(os.sep)
+            if not separator or not entry.name.lower().endswith(tuple(suffixes)):
+                continue
+            if entry.name.lower().endswith(NETCDF_SUFFIXES) and not is_netcdf_readable():
+                continue
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            station_times.setdefault(station, None)
+            files.append((station, entry.path, stat_result.st_size, stat_result.st_mtime_ns))
+        walk_span.set(files=len(files), stations=len(station_times))
+
+    with profiling.span('read_timestamps', files=len(files)) as read_span, \
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='content') as executor:
+        timestamps = list(executor.map(
+            lambda file_info: _read_cached(file_info[1], file_info[2], file_info[3], cache),
+            files,
+        ))
+        read_span.set(cached=sum(cached for _, cached in timestamps))
+    registry.inc(
+        'aws_monitor_content_files_read_total',
+        sum(not cached for _, cached in timestamps),
+        help='Files read to find the timestamp of the last record',
+        path=os.fspath(dir_path),
+    )
+
+    for (station, _, _, _), (timestamp, _) in zip(files, timestamps):
+        if timestamp is not None and (station_times[station] is None or timestamp > station_times[station]):
+            station_times[station] = timestamp
+    if cache is not None:
+        cache.save(prefix=root)
+    return station_times
+
+
+def check_station_content_time(
+        dir_path: Path,
+        current_time: datetime,
+        max_age: timedelta,
+        stations: Optional[Sequence[str]] = None,
+        cache: Optional[ContentTimestampCache] = None,
+        max_workers: int = 8,
+) -> Dict[str, Optional[timedelta]]:
+    '''Find the timestamp of the last record for each station sub-directory in dir_path
+    and return the stations where it is older than `max_age`.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Directory path to dir containing station sub-directories with CSV or NetCDF files
+    current_time : datetime
+        Current datetime used for determine data age
+    max_age : timedelta
+        Maximum allowed age of the last record per station.
+    stations : Sequence[str], optional
+        Stations to check. All station sub-directories are checked if not provided.
+        Listed stations without a sub-directory are reported as stale with unknown age.
+    cache : ContentTimestampCache, optional
+        Cache of the last timestamps by file size and modification time
+    max_workers : int
+        Number of files read concurrently
+
+    Returns
+    -------
+    stale_stations : Dict[str, Optional[timedelta]]
+        Age of the last record for each stale station, oldest first with unknown ages first
+    '''
+    station_times = get_station_content_times(dir_path, cache=cache, max_workers=max_workers)
+    if stations is not None:
+        station_times = {station: station_times.get(station) for station in stations}
+
+    station_ages = {
+        station: current_time - timestamp if timestamp is not None else None
+        for station, timestamp in station_times.items()
+    }
+    known_ages = [age for age in station_ages.values() if age is not None]
+    if known_ages:
+        report_data_age(max(known_ages))
+    for station, age in station_ages.items():
+        if age is None:
+            continue
+        report_data_age(age, station=station)
+        registry.set_gauge(
+            'aws_monitor_station_content_age_seconds',
+            age.total_seconds(),
+            help='Age of the last record per station',
+            path=os.fspath(dir_path),
+            station=station,
+        )
+    stale_stations = {
+        station: age for station, age in station_ages.items()
+        if age is None or age > max_age
+    }
+    return dict(sorted(
+        stale_stations.items(),
+        key=lambda item: (item[1] is not None, -(item[1] or timedelta()).total_seconds()),
+    ))
@@ -0,0 +1,205 @@
+"""
+Long-running mode of check_alerts.
+
+Each check is scheduled at its own interval and the process stays resident between ticks, keeping imports, the
+directory index and other caches warm. SIGHUP reloads the configuration, SIGTERM and SIGINT stop the daemon after
+the current tick.
+"""
+import logging
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Set
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.check_runner import (
+    DEFAULT_CHECK_TIMEOUT,
+    CheckBatch,
+    PipelineCheck,
+    dispatch_notifications,
+    start_checks,
+)
+from alert_processing.email_notification import NotificationClient
+from alert_processing.history import FreshnessHistory
+from alert_processing.metrics import start_http_server, write_textfile
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+__all__ = [
+    'Schedule',
+    'CheckScheduler',
+    'run_daemon',
+]
+
+logger = logging.getLogger(__name__)
+
+# Checks due within this many seconds of each other are run in the same tick
+_SCHEDULE_TOLERANCE = 1.
+
+
+@attr.s
+class Schedule:
+    checks: Sequence[PipelineCheck] = attr.ib()
+    notification_client: NotificationClient = attr.ib()
+    max_workers: Optional[int] = attr.ib(default=None)
+    timeout: Optional[float] = attr.ib(default=DEFAULT_CHECK_TIMEOUT)
+    state_store: Optional[AlertStateStore] = attr.ib(default=None)
+    metrics_textfile_path: Optional[Path] = attr.ib(default=None)
+    metrics_port: Optional[int] = attr.ib(default=None)
+    history: Optional[FreshnessHistory] = attr.ib(default=None)
+
+
+@attr.s
+class CheckScheduler:
+    """
+    Run checks at their configured intervals.
+
+    `load_schedule` is called on start and whenever a reload is requested. Checks keep their next run time across
+    reloads if their name is unchanged.
+
+    A tick starts the due checks without waiting for the checks of previous ticks, whose results are handled as they
+    finish. A slow check thereby does not delay the other checks. A check is not started again while its previous run
+    is in flight, but once it timed out it is started and reported as failed, see `run_checks`.
+
+    `clock` returns the monotonic time in seconds the check intervals are measured with.
+    """
+    load_schedule: Callable[[], Schedule] = attr.ib()
+    clock: Callable[[], float] = attr.ib(default=time.monotonic, repr=False)
+    schedule: Optional[Schedule] = attr.ib(init=False, default=None)
+    next_run: Dict[str, float] = attr.ib(init=False, factory=dict)
+    _batches: List[CheckBatch] = attr.ib(init=False, factory=list)
+    # Worker slots shared by the checks of all ticks, None if not limited
+    _slots: Optional[threading.Semaphore] = attr.ib(init=False, default=None)
+    _metrics_server: Optional['ThreadingHTTPServer'] = attr.ib(init=False, default=None)
+    _wake_event: threading.Event = attr.ib(init=False, factory=threading.Event)
+    _reload_requested: bool = attr.ib(init=False, default=True)
+    _stop_requested: bool = attr.ib(init=False, default=False)
+
+    def request_reload(self):
+        self._reload_requested = True
+        self._wake_event.set()
+
+    def request_stop(self):
+        self._stop_requested = True
+        self._wake_event.set()
+
+    def reload(self):
+        self._reload_requested = False
+        schedule = self.load_schedule()
+        now = self.clock()
+        self.next_run = {check.name: self.next_run.get(check.name, now) for check in schedule.checks}
+        if self.schedule is None or schedule.max_workers != self.schedule.max_workers:
+            self._slots = threading.Semaphore(schedule.max_workers) if schedule.max_workers else None
+        self.schedule = schedule
+        self._update_metrics_server()
+        logger.info(
+            "Loaded schedule: " + ', '.join(f'{c.name} every {c.interval}' for c in schedule.checks)
+        )
+
+    def _update_metrics_server(self):
+        port = self.schedule.metrics_port
+        if self._metrics_server is not None and self._metrics_server.server_address[1] != port:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+        if port is not None and self._metrics_server is None:
+            self._metrics_server = start_http_server(port)
+
+    def tick(self) -> float:
+        """Start all due checks, handle the results of finished checks and return the seconds until the next tick"""
+        if self._reload_requested:
+            try:
+                self.reload()
+            except Exception:
+                if self.schedule is None:
+                    raise
+                logger.exception("Failed to reload configuration. Keeping the previous schedule")
+
+        now = self.clock()
+        in_flight = self._get_in_flight()
+        due_checks = [
+            check for check in self.schedule.checks
+            if self.next_run[check.name] <= now + _SCHEDULE_TOLERANCE and check.name not in in_flight
+        ]
+        if due_checks:
+            self._batches.append(start_checks(
+                due_checks,
+                datetime.now(tz=timezone.utc),
+                max_workers=self.schedule.max_workers,
+                timeout=self.schedule.timeout,
+                state_store=self.schedule.state_store,
+                slots=self._slots,
+                on_done=self._wake_event.set,
+            ))
+            for check in due_checks:
+                self.next_run[check.name] = now + check.interval.total_seconds()
+
+        results = [result for batch in self._batches for result in batch.collect()]
+        self._batches = [batch for batch in self._batches if not batch.done]
+        if results:
+            dispatch_notifications(results, self.schedule.notification_client)
+            if self.schedule.history is not None:
+                try:
+                    self.schedule.history.append_results(results)
+                except OSError:
+                    logger.exception("Failed to append to the history")
+            profiling.dump_stats()
+            if self.schedule.metrics_textfile_path is not None:
+                try:
+                    write_textfile(self.schedule.metrics_textfile_path)
+                except OSError:
+                    logger.exception("Failed to write metrics")
+        return self._get_delay()
+
+    def _get_in_flight(self) -> Set[str]:
+        return {name for batch in self._batches for name in batch.in_flight}
+
+    def _get_delay(self) -> float:
+        # Checks in flight are started again once their result is handled, which wakes the scheduler
+        in_flight = self._get_in_flight()
+        next_runs = [next_run for name, next_run in self.next_run.items() if name not in in_flight]
+        delays = [min(next_runs) - self.clock()] if next_runs else []
+        delays.extend(wait_time for wait_time in map(CheckBatch.get_wait_time, self._batches) if wait_time is not None)
+        if not delays:
+            return 60.
+        return max(min(delays), 0.)
+
+    def run(self):
+        while not self._stop_requested:
+            delay = self.tick()
+            self._wake_event.wait(delay)
+            self._wake_event.clear()
+        in_flight = self._get_in_flight()
+        if in_flight:
+            logger.warning(f"Stopping with checks still running: {', '.join(sorted(in_flight))}")
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+        logger.info("Daemon stopped")
+
+
+def run_daemon(load_schedule: Callable[[], Schedule]):
+    """Run the scheduler until SIGTERM or SIGINT. SIGHUP reloads the schedule."""
+    scheduler = CheckScheduler(load_schedule)
+
+    def handle_stop(signum, frame):
+        logger.info(f"Received signal {signum}, stopping")
+        scheduler.request_stop()
+
+    def handle_reload(signum, frame):
+        logger.info("Received SIGHUP, reloading configuration")
+        scheduler.request_reload()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, handle_reload)
+
+    logger.info("Starting daemon")
+    scheduler.run()
@@ -0,0 +1,226 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+import attr
+
+__all__ = [
+    'DirectoryIndex',
+]
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    newest_name TEXT,
+    newest_ns INTEGER,
+    subdirs TEXT NOT NULL,
+    files TEXT NOT NULL,
+    scanned_at REAL NOT NULL
+)
+"""
+_COLUMNS = ('path', 'mtime_ns', 'newest_name', 'newest_ns', 'subdirs', 'files', 'scanned_at')
+
+
+@attr.s(frozen=True)
+class _DirectoryRecord:
+    mtime_ns: int = attr.ib()
+    newest_name: Optional[str] = attr.ib()
+    newest_ns: Optional[int] = attr.ib()
+    subdirs: Tuple[str, ...] = attr.ib()
+    files: Tuple[str, ...] = attr.ib()
+    scanned_at: float = attr.ib()
+
+
+def _max(*values: Optional[int]) -> Optional[int]:
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+@attr.s
+class DirectoryIndex:
+    """
+    Persistent sqlite index of directory modification times.
+
+    For every directory the index stores its own mtime, the names of its files and subdirectories and the newest
+    file directly inside it. A directory whose mtime is unchanged since the last scan has not had entries added,
+    removed or renamed, so it is not listed again. Files appended or rewritten in place, like the l3 CSV files, do
+    not change the directory mtime, so every file of an unchanged directory is stat'ed by name. The cost of an update
+    is thereby one stat per file and directory plus a listing of the directories that changed.
+
+    Records older than `max_record_age` are rescanned regardless, which bounds how long a change hidden by a
+    restored directory mtime, e.g. from `rsync --times`, can go unnoticed.
+    """
+    path: Path = attr.ib(converter=Path)
+    max_record_age: timedelta = attr.ib(default=timedelta(hours=24))
+    skip_hidden: bool = attr.ib(default=True)
+    connection: sqlite3.Connection = attr.ib(init=False, repr=False, default=None)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            columns = tuple(row[1] for row in self.connection.execute("PRAGMA table_info(directories)"))
+            if columns and columns != _COLUMNS:
+                logger.info(f"Rebuilding directory index {self.path} with a previous schema")
+                self.connection.execute("DROP TABLE directories")
+            self.connection.execute(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def rebuild(self):
+        """Drop all records so the next lookup performs a full scan"""
+        logger.info(f"Rebuilding directory index {self.path}")
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM directories")
+
+    def get_latest_modified_time(self, dir_path: Path) -> Optional[datetime]:
+        """
+        Update the index below `dir_path` and return the latest modification time of any file or subdirectory below
+        it, matching `file_system_status.get_latest_modified_time`. Returns None if no entries were found.
+        """
+        root = os.fspath(dir_path)
+        with self._lock:
+            records = self._load_records(root)
+        updates = dict()
+        visited = set()
+        now = time.time()
+        try:
+            root_mtime_ns = os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            logger.warning(f"Directory does not exist: {dir_path}")
+            return None
+        latest_ns = self._update_directory(root, root_mtime_ns, records, updates, visited, now)
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        path, r.mtime_ns, r.newest_name, r.newest_ns,
+                        '\n'.join(r.subdirs), '\n'.join(r.files), r.scanned_at,
+                    )
+                    for path, r in updates.items()
+                ],
+            )
+            stale_paths = [(path,) for path in records if path not in visited]
+            self.connection.executemany("DELETE FROM directories WHERE path = ?", stale_paths)
+        logger.debug(f"Directory index {dir_path}: {len(updates)} of {len(visited)} directories rescanned")
+
+        if latest_ns is None:
+            return None
+        return datetime.fromtimestamp(latest_ns / 1e9, tz=timezone.utc)
+
+    def _load_records(self, root: str) -> Dict[str, _DirectoryRecord]:
+        prefix = root.rstrip(os.sep) + os.sep
+        rows = self.connection.execute(
+            "SELECT * FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+            (root, len(prefix), prefix),
+        )
+        return {
+            path: _DirectoryRecord(
+                mtime_ns=mtime_ns,
+                newest_name=newest_name,
+                newest_ns=newest_ns,
+                subdirs=tuple(subdirs.split('\n')) if subdirs else (),
+                files=tuple(files.split('\n')) if files else (),
+                scanned_at=scanned_at,
+            )
+            for path, mtime_ns, newest_name, newest_ns, subdirs, files, scanned_at in rows
+        }
+
+    def _update_directory(
+            self,
+            path: str,
+            mtime_ns: int,
+            records: Dict[str, _DirectoryRecord],
+            updates: Dict[str, _DirectoryRecord],
+            visited: Set[str],
+            now: float,
+    ) -> Optional[int]:
+        """Return the latest mtime below `path`, rescanning it only if it has changed"""
+        visited.add(path)
+        record = records.get(path)
+        if (
+                record is None
+                or record.mtime_ns != mtime_ns
+                or now - record.scanned_at > self.max_record_age.total_seconds()
+        ):
+            record = self._scan_directory(path, mtime_ns, now)
+            updates[path] = record
+        else:
+            newest_name = None
+            newest_ns = None
+            for name in record.files:
+                try:
+                    file_ns = os.stat(os.path.join(path, name)).st_mtime_ns
+                except FileNotFoundError:
+                    # Removed behind a preserved directory mtime
+                    record = self._scan_directory(path, mtime_ns, now)
+                    updates[path] = record
+                    break
+                if newest_ns is None or file_ns > newest_ns:
+                    newest_name = name
+                    newest_ns = file_ns
+            else:
+                if newest_ns != record.newest_ns or newest_name != record.newest_name:
+                    # A file was appended or rewritten in place
+                    record = attr.evolve(record, newest_name=newest_name, newest_ns=newest_ns)
+                    updates[path] = record
+
+        latest_ns = record.newest_ns
+        for name in record.subdirs:
+            subdir_path = os.path.join(path, name)
+            try:
+                subdir_mtime_ns = os.stat(subdir_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            latest_ns = _max(
+                latest_ns,
+                subdir_mtime_ns,
+                self._update_directory(subdir_path, subdir_mtime_ns, records, updates, visited, now),
+            )
+        return latest_ns
+
+    def _scan_directory(self, path: str, mtime_ns: int, now: float) -> _DirectoryRecord:
+        newest_name = None
+        newest_ns = None
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    if self.skip_hidden and entry.name[0] == '.':
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            continue
+                        entry_ns = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                    files.append(entry.name)
+                    if newest_ns is None or entry_ns > newest_ns:
+                        newest_name = entry.name
+                        newest_ns = entry_ns
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Unable to list {path}: {e}")
+        return _DirectoryRecord(
+            mtime_ns=mtime_ns,
+            newest_name=newest_name,
+            newest_ns=newest_ns,
+            subdirs=tuple(sorted(subdirs)),
+            files=tuple(sorted(files)),
+            scanned_at=now,
+        )
@@ -0,0 +1,364 @@
+"""
+Disk usage of the pipeline directories and a forecast of when their filesystems will be full.
+
+Directory sizes are kept up to date incrementally in a sqlite cache. A directory is only listed again when its
+modification time changed, i.e. when files were added, removed or renamed. Files that were modified recently when the
+directory was last listed are stat'ed on every update, which catches files growing in place such as logs.
+
+Every update records a sample of the directory sizes and of the used space of their filesystems. The growth rate is
+fitted by least squares over the recent samples of all series at once with numpy.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.metrics import registry
+
+__all__ = [
+    'DiskUsageTracker',
+    'fit_growth_rates',
+    'check_disk_capacity',
+]
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directory_sizes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    cold_bytes INTEGER NOT NULL,
+    hot_files TEXT NOT NULL,
+    subdirs TEXT NOT NULL,
+    scanned_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    time REAL NOT NULL,
+    series TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+"""
+
+
+@attr.s(frozen=True)
+class _SizeRecord:
+    mtime_ns: int = attr.ib()
+    # Total size of the files which were not modified recently when the directory was listed
+    cold_bytes: int = attr.ib()
+    # Names of the recently modified files, which are stat'ed again on every update
+    hot_files: Tuple[str, ...] = attr.ib()
+    subdirs: Tuple[str, ...] = attr.ib()
+    scanned_at: float = attr.ib()
+
+
+def _disk_bytes(stat_result: os.stat_result) -> int:
+    """Space allocated for a file like du, falling back to the apparent size where blocks are not reported"""
+    blocks = getattr(stat_result, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat_result.st_size
+
+
+def fit_growth_rates(times, series_codes, values, series_count: int):
+    """
+    Least squares slope of `values` over `times` for every series at once.
+
+    Returns the slope per series code in units of values per second, NaN for series with fewer than two distinct
+    times.
+    """
+    import numpy as np
+
+    times = np.asarray(times, dtype=float)
+    series_codes = np.asarray(series_codes, dtype=np.intp)
+    values = np.asarray(values, dtype=float)
+    counts = np.bincount(series_codes, minlength=series_count)
+    # Center the times per series to keep the sums well conditioned with epoch seconds
+    mean_times = np.bincount(series_codes, weights=times, minlength=series_count) / np.maximum(counts, 1)
+    mean_values = np.bincount(series_codes, weights=values, minlength=series_count) / np.maximum(counts, 1)
+    dt = times - mean_times[series_codes]
+    dv = values - mean_values[series_codes]
+    covariance = np.bincount(series_codes, weights=dt * dv, minlength=series_count)
+    variance = np.bincount(series_codes, weights=dt * dt, minlength=series_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(variance > 0, covariance / variance, np.nan)
+
+
+@attr.s
+class DiskUsageTracker:
+    """
+    Persistent sqlite cache of directory sizes and samples of the sizes and used filesystem space.
+
+    Records older than `max_record_age` are listed again regardless of the directory modification time, which bounds
+    how long a change of a file that was not recently modified can go unnoticed.
+    """
+    path: Path = attr.ib(converter=Path)
+    max_record_age: timedelta = attr.ib(default=timedelta(hours=24))
+    hot_interval: timedelta = attr.ib(default=timedelta(days=1))
+    connection: sqlite3.Connection = attr.ib(init=False, repr=False, default=None)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_directory_size(self, dir_path: Path) -> Optional[int]:
+        """Update the cache below `dir_path` and return the total size of the files below it"""
+        root = os.fspath(dir_path)
+        if not os.path.isdir(root):
+            logger.warning(f"Directory does not exist: {dir_path}")
+            return None
+        with self._lock:
+            records = self._load_records(root)
+        updates = dict()
+        visited = set()
+        now = time.time()
+        total_bytes = 0
+        stack = [root]
+        with profiling.span('du', path=root) as du_span:
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                visited.add(path)
+                record = records.get(path)
+                hot_bytes = None
+                if (
+                        record is not None
+                        and record.mtime_ns == mtime_ns
+                        and now - record.scanned_at <= self.max_record_age.total_seconds()
+                ):
+                    hot_bytes = self._hot_bytes(path, record)
+                if hot_bytes is None:
+                    record, hot_bytes = self._scan_directory(path, mtime_ns, now)
+                    updates[path] = record
+                total_bytes += record.cold_bytes + hot_bytes
+                stack.extend(os.path.join(path, name) for name in record.subdirs)
+            du_span.set(directories=len(visited), rescanned=len(updates))
+
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directory_sizes VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        path, r.mtime_ns, r.cold_bytes, json.dumps(r.hot_files), json.dumps(r.subdirs),
+                        r.scanned_at,
+                    )
+                    for path, r in updates.items()
+                ],
+            )
+            stale_paths = [(path,) for path in records if path not in visited]
+            self.connection.executemany("DELETE FROM directory_sizes WHERE path = ?", stale_paths)
+        logger.debug(f"Disk usage {dir_path}: {len(updates)} of {len(visited)} directories rescanned")
+        return total_bytes
+
+    def _load_records(self, root: str) -> Dict[str, _SizeRecord]:
+        prefix = root.rstrip(os.sep) + os.sep
+        rows = self.connection.execute(
+            "SELECT * FROM directory_sizes WHERE path = ? OR substr(path, 1, ?) = ?",
+            (root, len(prefix), prefix),
+        )
+        return {
+            path: _SizeRecord(
+                mtime_ns=mtime_ns,
+                cold_bytes=cold_bytes,
+                hot_files=tuple(json.loads(hot_files)),
+                subdirs=tuple(json.loads(subdirs)),
+                scanned_at=scanned_at,
+            )
+            for path, mtime_ns, cold_bytes, hot_files, subdirs, scanned_at in rows
+        }
+
+    def _hot_bytes(self, path: str, record: _SizeRecord) -> Optional[int]:
+        """Current size of the recently modified files, or None if one of them disappeared"""
+        hot_bytes = 0
+        for name in record.hot_files:
+            try:
+                hot_bytes += _disk_bytes(os.stat(os.path.join(path, name), follow_symlinks=False))
+            except FileNotFoundError:
+                return None
+        return hot_bytes
+
+    def _scan_directory(self, path: str, mtime_ns: int, now: float) -> Tuple[_SizeRecord, int]:
+        hot_threshold = now - self.hot_interval.total_seconds()
+        cold_bytes = 0
+        hot_bytes = 0
+        hot_files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as iterator:
+                for entry in iterator:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            continue
+                        stat_result = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if stat_result.st_mtime >= hot_threshold:
+                        hot_files.append(entry.name)
+                        hot_bytes += _disk_bytes(stat_result)
+                    else:
+                        cold_bytes += _disk_bytes(stat_result)
+        except FileNotFoundError:
+            pass
+        record = _SizeRecord(
+            mtime_ns=mtime_ns,
+            cold_bytes=cold_bytes,
+            hot_files=tuple(sorted(hot_files)),
+            subdirs=tuple(sorted(subdirs)),
+            scanned_at=now,
+        )
+        return record, hot_bytes
+
+    def record_samples(self, samples: Dict[str, int], sample_time: Optional[float] = None,
+                       retention: Optional[timedelta] = timedelta(days=30)):
+        """Store the size of each series, e.g. `directory:<path>` or `filesystem:<path>`, and drop old samples"""
+        sample_time = sample_time if sample_time is not None else time.time()
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?)",
+                [(sample_time, series, value) for series, value in samples.items()],
+            )
+            if retention is not None:
+                self.connection.execute(
+                    "DELETE FROM samples WHERE time < ?",
+                    (sample_time - retention.total_seconds(),),
+                )
+
+    def get_growth_rates(self, since: float, min_samples: int = 3) -> Dict[str, float]:
+        """Growth rate in bytes per second of every series with at least `min_samples` samples after `since`"""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT time, series, bytes FROM samples WHERE time >= ?",
+                (since,),
+            ).fetchall()
+        if not rows:
+            return dict()
+        series_codes: Dict[str, int] = dict()
+        codes = [series_codes.setdefault(series, len(series_codes)) for _, series, _ in rows]
+        rates = fit_growth_rates(
+            [row[0] for row in rows],
+            codes,
+            [row[2] for row in rows],
+            series_count=len(series_codes),
+        )
+        counts = [0] * len(series_codes)
+        for code in codes:
+            counts[code] += 1
+        return {
+            series: float(rates[code])
+            for series, code in series_codes.items()
+            if counts[code] >= min_samples and rates[code] == rates[code]
+        }
+
+
+def _format_bytes(value: float) -> str:
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if abs(value) < 1000 or unit == 'TB':
+            return f'{value:.1f} {unit}'
+        value /= 1000
+
+
+def check_disk_capacity(
+        tracker: DiskUsageTracker,
+        dir_paths: Sequence[Path],
+        current_time: datetime,
+        min_time_to_full: timedelta,
+        window: timedelta = timedelta(days=7),
+        min_samples: int = 3,
+) -> List[str]:
+    '''Update the sizes of dir_paths and the used space of their filesystems,
+    and return a description of each filesystem projected to be full within `min_time_to_full`.
+
+    Parameters
+    ----------
+    tracker : DiskUsageTracker
+        Cache of the directory sizes and the size samples
+    dir_paths : Sequence[Path]
+        Directories to track. Their filesystems are forecasted.
+    current_time : datetime
+        Current datetime of the sample
+    min_time_to_full : timedelta
+        Minimum allowed projected time until a filesystem is full
+    window : timedelta
+        Period of the samples used to fit the growth rate
+    min_samples : int
+        Minimum number of samples in the window before a forecast is made
+
+    Returns
+    -------
+    problems : List[str]
+        Empty if passing
+    '''
+    samples = dict()
+    filesystems: Dict[int, Tuple[str, os.statvfs_result]] = dict()
+    for dir_path in dir_paths:
+        size = tracker.get_directory_size(dir_path)
+        if size is None:
+            continue
+        samples[f'directory:{os.fspath(dir_path)}'] = size
+        registry.set_gauge(
+            'aws_monitor_directory_size_bytes',
+            size,
+            help='Disk space used by the files below a directory',
+            path=os.fspath(dir_path),
+        )
+        device = os.stat(dir_path).st_dev
+        if device not in filesystems:
+            filesystems[device] = (os.fspath(dir_path), os.statvfs(dir_path))
+    for path, statvfs in filesystems.values():
+        samples[f'filesystem:{path}'] = (statvfs.f_blocks - statvfs.f_bfree) * statvfs.f_frsize
+
+    sample_time = current_time.timestamp()
+    tracker.record_samples(samples, sample_time=sample_time, retention=max(window * 2, timedelta(days=1)))
+    rates = tracker.get_growth_rates(since=sample_time - window.total_seconds(), min_samples=min_samples)
+
+    problems = []
+    for path, statvfs in filesystems.values():
+        free_bytes = statvfs.f_bavail * statvfs.f_frsize
+        registry.set_gauge(
+            'aws_monitor_filesystem_free_bytes',
+            free_bytes,
+            help='Space available on the filesystem of a tracked directory',
+            path=path,
+        )
+        rate = rates.get(f'filesystem:{path}')
+        if rate is None or rate <= 0:
+            continue
+        time_to_full = timedelta(seconds=free_bytes / rate)
+        registry.set_gauge(
+            'aws_monitor_filesystem_time_to_full_seconds',
+            time_to_full.total_seconds(),
+            help='Projected time until the filesystem of a tracked directory is full',
+            path=path,
+        )
+        if time_to_full >= min_time_to_full:
+            continue
+        growing = sorted(
+            (
+                (rates.get(f'directory:{os.fspath(dir_path)}', 0.), os.fspath(dir_path))
+                for dir_path in dir_paths
+                if os.path.isdir(dir_path) and os.stat(dir_path).st_dev == os.stat(path).st_dev
+            ),
+            reverse=True,
+        )
+        growing_text = ', '.join(f'{dir_path} {_format_bytes(rate * 86400)}/day' for rate, dir_path in growing)
+        problems.append(
+            f'The filesystem of {path} is projected to be full in {time_to_full}: {_format_bytes(free_bytes)} free, '
+            f'growing {_format_bytes(rate * 86400)}/day. Directories: {growing_text}'
+        )
+    return problems
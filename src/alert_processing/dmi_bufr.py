@@ -1,46 +1,395 @@
-import pandas as pd
+import logging
 import re
-from datetime import timedelta, datetime
-from ftplib import FTP
+import threading
+import time
+from datetime import timedelta, datetime, timezone
+from ftplib import FTP, error_perm, error_reply, error_temp
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 __all__ = [
+    "DmiBufrStatus",
+    "connect_ftp",
+    "scan_bufr_entries",
+    "probe_bufr_filenames",
+    "predict_bufr_filenames",
+    "get_latest_dmi_bufr",
+    "list_dmi_bufr_files",
     "get_dmi_bufr_stats",
+    "get_dmi_ftp_status",
+    "DmiStatusCache",
     "check_dmi_ftp",
 ]
 
-_dir_lines = list()
+logger = logging.getLogger(__name__)
+
+_LIST_LINE_PATTERN = re.compile(r"(\d+) +(\w{3} +\d+ +[\d:]+) (\S+\.bufr)\Z")
+_FILENAME_DATETIME_FORMATS = (
+    '%Y%m%dT%H%M',
+    '%Y%m%dT%H%M%S',
+    '%Y%m%d%H%M',
+    '%Y%m%d%H%M%S',
+)
+_RETRY_ERRORS = (OSError, EOFError, error_temp, error_reply)
 
 
-def parse_list_line(line: str):
-    match = re.search(r".+ftp.+?(\d+) (.*) (\S+.bufr)\Z", line)
+@attr.s
+class DmiBufrStatus:
+    latest_datetime: Optional[datetime] = attr.ib(default=None)
+    latest_filename: Optional[str] = attr.ib(default=None)
+    entry_count: int = attr.ib(default=0)
 
+    def update(self, filename: str):
+        self.entry_count += 1
+        file_datetime = parse_filename_datetime(filename)
+        if file_datetime is not None and (self.latest_datetime is None or file_datetime > self.latest_datetime):
+            self.latest_datetime = file_datetime
+            self.latest_filename = filename
+
+
+def parse_list_line(line: str) -> Optional[Dict]:
+    match = _LIST_LINE_PATTERN.search(line)
     if match:
-        _dir_lines.append(
-            dict(
-                size=int(match.group(1)),
-                date_string=match.group(2),
-                filename=match.group(3),
-            )
+        return dict(
+            size=int(match.group(1)),
+            date_string=match.group(2),
+            filename=match.group(3),
         )
+    return None
+
+
+def parse_mlsd_line(line: str) -> Optional[Dict]:
+    """Parse a MLSD line such as `type=file;size=1234;modify=20230117130312; geus_20230117T1303.bufr`"""
+    facts_string, _, filename = line.partition(' ')
+    if not filename.endswith('.bufr'):
+        return None
+    facts = dict(
+        fact.split('=', 1)
+        for fact in facts_string.rstrip(';').split(';')
+        if '=' in fact
+    )
+    if facts.get('type', 'file').lower() != 'file':
+        return None
+    return dict(
+        size=int(facts['size']) if 'size' in facts else None,
+        date_string=facts.get('modify'),
+        filename=filename,
+    )
+
+
+def parse_filename_datetime(filename: str) -> Optional[datetime]:
+    """Parse the timestamp of a concatenated BUFR file name such as geus_20230117T1303.bufr"""
+    datetime_string = filename[5:-5]
+    for datetime_format in _FILENAME_DATETIME_FORMATS:
+        try:
+            return datetime.strptime(datetime_string, datetime_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    try:
+        file_datetime = datetime.fromisoformat(datetime_string)
+    except ValueError:
+        return None
+    if file_datetime.tzinfo is None:
+        file_datetime = file_datetime.replace(tzinfo=timezone.utc)
+    return file_datetime
+
+
+def connect_ftp(
+        user: str,
+        passwd: str,
+        host: str = "ftpserver.dmi.dk",
+        port: int = 21,
+        connect_timeout: float = 30,
+        read_timeout: float = 60,
+) -> FTP:
+    """Connect and login. `read_timeout` applies to every later read on the control and data connections."""
+    ftp = FTP()
+    with profiling.span('ftp_connect', host=host):
+        try:
+            ftp.connect(host=host, port=port, timeout=connect_timeout)
+            ftp.sock.settimeout(read_timeout)
+            ftp.timeout = read_timeout
+            ftp.login(user=user, passwd=passwd)
+        except BaseException:
+            ftp.close()
+            raise
+    return ftp
+
+
+def scan_bufr_entries(
+        ftp: FTP,
+        callback: Callable[[Dict], None],
+        directory: str = 'upload',
+):
+    """
+    Stream the BUFR file entries of `directory` to `callback` one at a time.
+
+    MLSD is used when supported by the server with LIST as fallback. Lines are parsed as they arrive and the listing
+    is never held in memory.
+    """
+    def handle_mlsd_line(line: str):
+        file_info = parse_mlsd_line(line)
+        if file_info is not None:
+            callback(file_info)
+
+    def handle_list_line(line: str):
+        file_info = parse_list_line(line)
+        if file_info is not None:
+            callback(file_info)
+
+    with profiling.span('ftp_list', directory=directory, command='MLSD') as list_span:
+        try:
+            ftp.retrlines(f'MLSD {directory}', handle_mlsd_line)
+        except error_perm as e:
+            if not str(e).startswith(('500', '501', '502', '504')):
+                raise
+            logger.debug(f"MLSD not supported ({e}), falling back to LIST")
+            list_span.set(command='LIST')
+            ftp.retrlines(f'LIST {directory}', handle_list_line)
+
+
+def predict_bufr_filenames(
+        current_time: datetime,
+        max_age: timedelta,
+        filename_format: str,
+        step: timedelta = timedelta(minutes=1),
+        max_count: Optional[int] = None,
+) -> List[str]:
+    """
+    Up to `max_count` file names expected within `max_age` before `current_time`, newest first.
+
+    `filename_format` is a strftime format such as `geus_%Y%m%dT%H%M.bufr`. The candidate times are `current_time`
+    truncated to `step` and going back in steps of `step`, so `step` should be the upload interval.
+    """
+    step_seconds = step.total_seconds()
+    timestamp = current_time.timestamp()
+    candidate_time = datetime.fromtimestamp(timestamp - timestamp % step_seconds, tz=timezone.utc)
+    filenames = []
+    while current_time - candidate_time <= max_age and (max_count is None or len(filenames) < max_count):
+        filename = candidate_time.strftime(filename_format)
+        if not filenames or filenames[-1] != filename:
+            filenames.append(filename)
+        candidate_time -= step
+    return filenames
+
+
+def probe_bufr_filenames(
+        ftp: FTP,
+        filenames: Iterable[str],
+        directory: str = 'upload',
+) -> Optional[str]:
+    """Return the first of `filenames` that exists in `directory` using MDTM, without listing the directory"""
+    with profiling.span('ftp_probe', directory=directory) as probe_span:
+        probe_count = 0
+        for filename in filenames:
+            probe_count += 1
+            try:
+                ftp.sendcmd(f'MDTM {directory}/{filename}')
+            except error_perm:
+                continue
+            probe_span.set(probes=probe_count, found=True)
+            return filename
+        probe_span.set(probes=probe_count, found=False)
+        return None
+
 
+def _with_retries(function: Callable, retries: int, retry_delay: float):
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except _RETRY_ERRORS as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay * 2 ** attempt
+            logger.warning(f"DMI ftp attempt {attempt + 1} failed: {e!r}. Retrying in {delay:.0f} s")
+            time.sleep(delay)
 
-def get_dmi_bufr_stats(user: str, passwd: str, host: str = "ftpserver.dmi.dk") -> pd.DataFrame:
-    """NOTE: THIS MIGHT NOT WORKING. The DMI ftp server is not always responding to list queries on `./upload`."""
-    with FTP(host=host) as ftp:
-        ftp.login(user=user, passwd=passwd)
-        ftp.dir('upload', parse_list_line)
 
-    return pd.DataFrame(_dir_lines).assign(
-        datetime=lambda df: pd.to_datetime(df.filename.str[5:-5], errors='coerce', utc=True)
+def get_latest_dmi_bufr(
+        user: str,
+        passwd: str,
+        host: str = "ftpserver.dmi.dk",
+        port: int = 21,
+        directory: str = 'upload',
+        connect_timeout: float = 30,
+        read_timeout: float = 60,
+        retries: int = 2,
+        retry_delay: float = 5,
+        probe_filenames: Optional[Iterable[str]] = None,
+) -> DmiBufrStatus:
+    """
+    Find the newest concatenated BUFR file at the DMI ftp server keeping only a running maximum.
+
+    If `probe_filenames` is provided, these are probed with MDTM first and the directory is only listed if none of
+    them exists.
+    """
+    probe_filenames = list(probe_filenames) if probe_filenames is not None else []
+
+    def run() -> DmiBufrStatus:
+        status = DmiBufrStatus()
+        with connect_ftp(user, passwd, host, port, connect_timeout, read_timeout) as ftp:
+            if probe_filenames:
+                filename = probe_bufr_filenames(ftp, probe_filenames, directory=directory)
+                if filename is not None:
+                    status.update(filename)
+                    return status
+                logger.info("None of the predicted BUFR files found. Listing the directory")
+            scan_bufr_entries(ftp, lambda file_info: status.update(file_info['filename']), directory=directory)
+        return status
+
+    return _with_retries(run, retries=retries, retry_delay=retry_delay)
+
+
+def list_dmi_bufr_files(
+        user: str,
+        passwd: str,
+        host: str = "ftpserver.dmi.dk",
+        port: int = 21,
+        directory: str = 'upload',
+        connect_timeout: float = 30,
+        read_timeout: float = 60,
+) -> List[Dict]:
+    """List all concatenated BUFR files at the DMI ftp server. Use `get_latest_dmi_bufr` for checks."""
+    dir_lines = list()
+
+    def add_file(file_info: Dict):
+        file_info['datetime'] = parse_filename_datetime(file_info['filename'])
+        dir_lines.append(file_info)
+
+    with connect_ftp(user, passwd, host, port, connect_timeout, read_timeout) as ftp:
+        scan_bufr_entries(ftp, add_file, directory=directory)
+    return dir_lines
+
+
+def get_dmi_bufr_stats(user: str, passwd: str, host: str = "ftpserver.dmi.dk", **kwargs) -> 'pd.DataFrame':
+    import pandas as pd
+
+    dir_lines = list_dmi_bufr_files(user=user, passwd=passwd, host=host, **kwargs)
+    with profiling.span('dataframe', rows=len(dir_lines)):
+        return pd.DataFrame(dir_lines, columns=['size', 'date_string', 'filename']).assign(
+            datetime=lambda df: pd.to_datetime(df.filename.str[5:-5], errors='coerce', utc=True)
+        )
+
+
+def _get_ftp_path(dmi_ftp_settings: Dict) -> str:
+    return f"ftp://{dmi_ftp_settings.get('host', 'ftpserver.dmi.dk')}/{dmi_ftp_settings.get('directory', 'upload')}"
+
+
+def get_dmi_ftp_status(
+        current_time: datetime,
+        max_age: timedelta,
+        probe_format: Optional[str] = None,
+        probe_step: timedelta = timedelta(minutes=1),
+        max_probes: int = 5,
+        **dmi_ftp_settings,
+) -> DmiBufrStatus:
+    """
+    Find the newest concatenated BUFR file at the DMI ftp upload directory.
+
+    If `probe_format` is provided, the latest `max_probes` file names expected every `probe_step` within `max_age`
+    are probed before listing the directory. The number of probes is capped, because the probes are sequential round
+    trips and all of them miss when the upload is late.
+    """
+    probe_filenames = None
+    if probe_format:
+        probe_filenames = predict_bufr_filenames(
+            current_time,
+            max_age,
+            probe_format,
+            step=probe_step,
+            max_count=max_probes,
+        )
+    status = get_latest_dmi_bufr(probe_filenames=probe_filenames, **dmi_ftp_settings)
+    logger.debug(f"DMI ftp: {status}")
+    registry.inc(
+        'aws_monitor_ftp_entries_total',
+        status.entry_count,
+        help='BUFR entries listed or probed at the ftp server',
+        path=_get_ftp_path(dmi_ftp_settings),
     )
+    return status
+
+
+@attr.s
+class DmiStatusCache:
+    """
+    Status of the DMI ftp upload directory read once per run.
+
+    The checks of a run share the current time, so the dmi_ftp check and the pipeline latency check use a single
+    connection to the ftp server. A check of the same run waits while another one reads the status.
+    """
+    max_age: timedelta = attr.ib()
+    probe_format: Optional[str] = attr.ib(default=None)
+    probe_step: timedelta = attr.ib(default=timedelta(minutes=1))
+    max_probes: int = attr.ib(default=5)
+    dmi_ftp_settings: Dict = attr.ib(factory=dict, repr=False)
+    _current_time: Optional[datetime] = attr.ib(init=False, default=None)
+    _status: Optional[DmiBufrStatus] = attr.ib(init=False, default=None)
+    _error: Optional[Exception] = attr.ib(init=False, default=None)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def get(self, current_time: datetime) -> DmiBufrStatus:
+        """Status of the run at `current_time`. A failure to read it is raised again to every check of the run."""
+        with self._lock:
+            if current_time != self._current_time:
+                self._current_time = current_time
+                self._status = self._error = None
+                try:
+                    self._status = get_dmi_ftp_status(
+                        current_time,
+                        self.max_age,
+                        probe_format=self.probe_format,
+                        probe_step=self.probe_step,
+                        max_probes=self.max_probes,
+                        **self.dmi_ftp_settings,
+                    )
+                except Exception as e:
+                    self._error = e
+            if self._error is not None:
+                raise self._error
+            return self._status
 
 
 def check_dmi_ftp(
         current_time: datetime,
         max_age: timedelta,
-        **dmi_credentials,
+        probe_format: Optional[str] = None,
+        probe_step: timedelta = timedelta(minutes=1),
+        max_probes: int = 5,
+        status: Optional[DmiBufrStatus] = None,
+        **dmi_ftp_settings,
 ) -> bool:
-    """NOTE: THIS MIGHT NOT WORKING. The DMI ftp server is not always responding to list queries on `./upload`."""
-    dmi_bufr_stats = get_dmi_bufr_stats(**dmi_credentials)
-    dmi_bufr_age = current_time - dmi_bufr_stats['datetime'].max()
+    """
+    Check the age of the newest concatenated BUFR file at the DMI ftp upload directory.
+
+    The status is read with `get_dmi_ftp_status` unless a `status` already read in the same run is provided.
+    """
+    if status is None:
+        status = get_dmi_ftp_status(
+            current_time,
+            max_age,
+            probe_format=probe_format,
+            probe_step=probe_step,
+            max_probes=max_probes,
+            **dmi_ftp_settings,
+        )
+    if status.latest_datetime is None:
+        logger.warning("Unable to find any BUFR files at the DMI ftp server")
+        return True
+    dmi_bufr_age = current_time - status.latest_datetime
+    report_data_age(dmi_bufr_age)
+    registry.set_gauge(
+        'aws_monitor_data_age_seconds',
+        dmi_bufr_age.total_seconds(),
+        help='Age of the newest data found. An upper bound when the scan stopped at the first fresh file',
+        path=_get_ftp_path(dmi_ftp_settings),
+    )
     return dmi_bufr_age > max_age
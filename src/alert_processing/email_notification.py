@@ -2,14 +2,26 @@ import abc
 import logging
 import smtplib
 import ssl
-from typing import List
+import time
+from datetime import timedelta
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
 
 import attr
 
+from alert_processing import profiling
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    from alert_processing.outbox import OutboxDeliveryWorker
+
 __all__ = [
     'NotificationClient',
     'EmailNotificationClient',
     'LogNotificationClient',
+    'BatchingNotificationClient',
+    'StatefulNotificationClient',
+    'OutboxNotificationClient',
 ]
 
 
@@ -20,9 +32,26 @@ class NotificationClient(abc.ABC):
             self,
             subject_text: str,
             body_text: str,
+            check_name: Optional[str] = None,
     ):
         pass
 
+    def send_alert_emails(
+            self,
+            messages: Sequence[Tuple[str, str]],
+    ):
+        """Send several (subject_text, body_text) messages"""
+        for subject_text, body_text in messages:
+            self.send_alert_email(subject_text=subject_text, body_text=body_text)
+
+    def notify_ok(self, check_name: str):
+        """Report that the check `check_name` passed"""
+        pass
+
+    def flush(self):
+        """Send any pending notifications"""
+        pass
+
 
 @attr.s
 class LogNotificationClient(NotificationClient):
@@ -32,6 +61,7 @@ class LogNotificationClient(NotificationClient):
             self,
             subject_text: str,
             body_text: str,
+            check_name: Optional[str] = None,
     ):
         self.logger.info(f"{subject_text}. {body_text}")
 
@@ -44,22 +74,179 @@ class EmailNotificationClient(NotificationClient):
     port: int = attr.ib()
     password: str = attr.ib(repr=False)
     logger = attr.ib(default=logging.getLogger('EmailNotificationClient'))
+    ssl_context: Optional[ssl.SSLContext] = attr.ib(default=None, repr=False)
+    # Seconds to wait for connecting and each server response
+    timeout: float = attr.ib(default=60.)
 
     def send_alert_email(
             self,
             subject_text: str,
             body_text: str,
+            check_name: Optional[str] = None,
     ):
-        headers = f"From: {self.account}\r\n"
-        headers += f"To: {', '.join(self.receiver_emails)}\r\n"
-        headers += f"Subject: {subject_text}\r\n"
-        email_message = headers + "\r\n" + body_text  # Blank line needed between headers and body
-
-        self.logger.info(f"{subject_text}. {body_text}")
+        self.send_alert_emails([(subject_text, body_text)])
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(self.smtp_server, self.port, context=context) as server:
+    def send_alert_emails(
+            self,
+            messages: Sequence[Tuple[str, str]],
+    ):
+        """Send all messages over a single SMTP connection"""
+        if not messages:
+            return
+        start_time = time.perf_counter()
+        context = self.ssl_context or ssl.create_default_context()
+        with profiling.span('smtp_send', server=self.smtp_server, messages=len(messages)), \
+                smtplib.SMTP_SSL(self.smtp_server, self.port, context=context, timeout=self.timeout) as server:
             server.login(self.account, self.password)
-            server.sendmail(self.account, self.receiver_emails, email_message)
+            for subject_text, body_text in messages:
+                headers = f"From: {self.account}\r\n"
+                headers += f"To: {', '.join(self.receiver_emails)}\r\n"
+                headers += f"Subject: {subject_text}\r\n"
+                email_message = headers + "\r\n" + body_text  # Blank line needed between headers and body
+
+                self.logger.info(f"{subject_text}. {body_text}")
+                server.sendmail(self.account, self.receiver_emails, email_message)
             server.quit()  # may not be necessary?
-        logging.info('Alert email sent!')
+        registry.observe(
+            'aws_monitor_smtp_send_seconds',
+            time.perf_counter() - start_time,
+            help='Duration of sending a batch of emails including connecting and login',
+            server=self.smtp_server,
+        )
+        logging.info(f'{len(messages)} alert email(s) sent!')
+
+
+@attr.s
+class BatchingNotificationClient(NotificationClient):
+    """
+    Collect alerts and send them when `flush` is called.
+
+    With `digest` the alerts are combined into a single email. Otherwise they are sent as separate emails, reusing a
+    single connection if the wrapped client supports it.
+    """
+    client: NotificationClient = attr.ib()
+    digest: bool = attr.ib(default=True)
+    pending: List[Tuple[str, str]] = attr.ib(factory=list)
+
+    def send_alert_email(
+            self,
+            subject_text: str,
+            body_text: str,
+            check_name: Optional[str] = None,
+    ):
+        self.pending.append((subject_text, body_text))
+
+    def notify_ok(self, check_name: str):
+        self.client.notify_ok(check_name)
+
+    def flush(self):
+        messages, self.pending = self.pending, []
+        if not messages:
+            return
+        if self.digest and len(messages) > 1:
+            alert_count = sum(subject.startswith('ALERT') for subject, _ in messages)
+            if alert_count:
+                subject_text = f"ALERT: {alert_count} pipeline alerts!"
+            else:
+                subject_text = f"RECOVERED: {len(messages)} pipeline checks are passing again"
+            body_text = '\n\n'.join(
+                subject + '\n' + '\n'.join('    ' + line.strip() for line in body.strip().splitlines())
+                for subject, body in messages
+            )
+            messages = [(subject_text, body_text)]
+        self.client.send_alert_emails(messages)
+        self.client.flush()
+
+
+@attr.s
+class OutboxNotificationClient(NotificationClient):
+    """
+    Write alerts to the durable outbox of `worker` instead of sending them.
+
+    The worker delivers them in its background thread if it is running. Otherwise `deliver_pending` of the worker
+    has to be called, e.g. once at the end of a run.
+    """
+    worker: 'OutboxDeliveryWorker' = attr.ib()
+
+    def send_alert_email(
+            self,
+            subject_text: str,
+            body_text: str,
+            check_name: Optional[str] = None,
+    ):
+        self.send_alert_emails([(subject_text, body_text)])
+
+    def send_alert_emails(
+            self,
+            messages: Sequence[Tuple[str, str]],
+    ):
+        self.worker.outbox.put(messages)
+
+    def flush(self):
+        self.worker.wake()
+
+
+@attr.s
+class StatefulNotificationClient(NotificationClient):
+    """
+    Deduplicate alerts using a persistent AlertStateStore.
+
+    An alert is forwarded when a check enters alert condition and then at most once per `renotify_interval` while
+    it stays in alert condition. With `renotify_interval` None it is sent only once. A single recovery message is
+    sent when an alerting check passes again. Alerts without a check name are keyed by their subject.
+
+    Notifications and recoveries are only recorded once `flush` of the wrapped client succeeded, i.e. once they have
+    been sent or written to the outbox, so a failed delivery is retried on the next run.
+    """
+    client: NotificationClient = attr.ib()
+    state_store: AlertStateStore = attr.ib()
+    renotify_interval: Optional[timedelta] = attr.ib(default=timedelta(hours=24))
+    logger = attr.ib(default=logging.getLogger('StatefulNotificationClient'))
+    # Check names of the alerts and recoveries handed to the wrapped client since the last flush
+    _pending_alerts: List[str] = attr.ib(init=False, factory=list)
+    _pending_recoveries: List[str] = attr.ib(init=False, factory=list)
+
+    def send_alert_email(
+            self,
+            subject_text: str,
+            body_text: str,
+            check_name: Optional[str] = None,
+    ):
+        check_name = check_name or subject_text
+        should_notify = self.state_store.should_notify(check_name, self.renotify_interval)
+        self.state_store.record_alert(check_name, notified=False)
+        if not should_notify:
+            self.logger.info(f"Suppressing repeated alert for {check_name}: {subject_text}")
+            return
+        self.client.send_alert_email(
+            subject_text=subject_text,
+            body_text=body_text,
+            check_name=check_name,
+        )
+        self._pending_alerts.append(check_name)
+
+    def notify_ok(self, check_name: str):
+        state = self.state_store.get(check_name)
+        if state.alerting and state.last_notified_at is not None:
+            self.client.send_alert_email(
+                subject_text=f"RECOVERED: {check_name} is passing again",
+                body_text=f'''
+                The {check_name} check is passing again.
+                It has been in alert condition since {state.changed_at:%Y-%m-%d %H:%M} UTC.
+                ''',
+                check_name=check_name,
+            )
+            # The check stays in alert condition until the recovery message is delivered
+            self._pending_recoveries.append(check_name)
+        else:
+            self.state_store.record_success(check_name)
+        self.client.notify_ok(check_name)
+
+    def flush(self):
+        alerts, self._pending_alerts = self._pending_alerts, []
+        recoveries, self._pending_recoveries = self._pending_recoveries, []
+        self.client.flush()
+        for check_name in alerts:
+            self.state_store.record_alert(check_name, notified=True)
+        for check_name in recoveries:
+            self.state_store.record_success(check_name)
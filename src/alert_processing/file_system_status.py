@@ -1,48 +1,398 @@
 import logging
+import os
+import re
+import time
+from array import array
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, Optional, Sequence, Union
 
-import pandas as pd
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.directory_index import DirectoryIndex
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from alert_processing.sharded_scan import ShardedScanner
+    from alert_processing.tree_watcher import TreeWatcher
 
 __all__ = [
+    "scan_tree",
+    "get_latest_modified_time",
+    "get_latest_modified_time_by_name",
     "get_modified_time",
+    "scan_modified_time",
+    "get_station_modified_time",
     "check_update_time",
+    "check_station_update_time",
 ]
 
 logger = logging.getLogger(__name__)
 
+
+def scan_tree(
+        dir_path: Union[Path, str],
+        skip_dir: bool = False,
+        skip_hidden: bool = True,
+) -> Iterator[os.DirEntry]:
+    """
+    Walk `dir_path` depth first using `os.scandir` and yield the `DirEntry` of every file and directory below it.
+
+    Only one open directory iterator per level is kept, so memory use is bounded by the depth of the tree and not
+    by the number of files. With `skip_hidden`, hidden entries are skipped including the content of hidden
+    directories, unlike `Path.rglob`, so that e.g. the `.git` directory of a repository does not count as data.
+    Entries that disappear while the tree is being walked are ignored, and directories that cannot be read are
+    logged and skipped like `Path.rglob` does.
+    """
+    try:
+        stack = [os.scandir(dir_path)]
+    except FileNotFoundError:
+        logger.warning(f"Directory does not exist: {dir_path}")
+        return
+    except OSError as e:
+        logger.warning(f"Unable to list {dir_path}: {e}")
+        return
+    try:
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop().close()
+                continue
+            if skip_hidden and entry.name[0] == '.':
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                try:
+                    stack.append(os.scandir(entry.path))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"Unable to list {entry.path}: {e}")
+                    continue
+                if skip_dir:
+                    continue
+            yield entry
+    finally:
+        for iterator in stack:
+            iterator.close()
+
+
+def get_latest_modified_time(
+        dir_path: Path,
+        newer_than: Optional[datetime] = None,
+        skip_dir: bool = False,
+        skip_hidden: bool = True,
+) -> Optional[datetime]:
+    """
+    Stream over all entries below `dir_path` and return the latest modification time.
+
+    If `newer_than` is provided, the scan stops at the first entry modified at or after `newer_than` and returns its
+    modification time, which is then not necessarily the latest. Returns None if no entries were found.
+    """
+    threshold = newer_than.timestamp() if newer_than is not None else None
+    latest_mtime = None
+    entry_count = 0
+    # Time spent in stat is only measured separately from the directory listing when profiling
+    timing = profiling.is_enabled()
+    stat_time = 0.
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_dir=skip_dir, skip_hidden=skip_hidden):
+            entry_count += 1
+            if timing:
+                stat_start_time = time.perf_counter()
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            finally:
+                if timing:
+                    stat_time += time.perf_counter() - stat_start_time
+            if latest_mtime is None or mtime > latest_mtime:
+                latest_mtime = mtime
+                if threshold is not None and mtime >= threshold:
+                    break
+        walk_span.set(
+            entries=entry_count,
+            stat_ms=round(stat_time * 1e3, 3),
+            early_exit=threshold is not None and latest_mtime is not None and latest_mtime >= threshold,
+        )
+    registry.inc(
+        'aws_monitor_entries_scanned_total',
+        entry_count,
+        help='Directory entries visited while searching for the latest modification time',
+        path=os.fspath(dir_path),
+    )
+
+    if latest_mtime is None:
+        return None
+    return datetime.fromtimestamp(latest_mtime, tz=timezone.utc)
+
+
+def _timestamp_key(match: re.Match) -> str:
+    if 'timestamp' in match.re.groupindex:
+        return match.group('timestamp')
+    return match.group(1) if match.re.groups else match.group(0)
+
+
+def get_latest_modified_time_by_name(
+        dir_path: Path,
+        filename_pattern: Union[str, 're.Pattern'],
+        newer_than: Optional[datetime] = None,
+        skip_hidden: bool = True,
+) -> Optional[datetime]:
+    """
+    Return the latest file modification time below `dir_path`, stat-ing only the newest file of each directory
+    according to the timestamp in its name.
+
+    The timestamp is the `timestamp` group of `filename_pattern`, else its first group or the whole match, and must
+    sort chronologically as a string, e.g. `_(?P<timestamp>\\d{8}T\\d{4})\\.bufr$`. Files whose name does not match are
+    stat'ed like in a full scan, and so are all files of a directory whose newest candidate disappeared before it was
+    stat'ed. Unlike `get_latest_modified_time`, the modification times of directories are not considered.
+
+    If `newer_than` is provided, the scan stops at the first file modified at or after `newer_than`.
+    """
+    pattern = re.compile(filename_pattern)
+    threshold = newer_than.timestamp() if newer_than is not None else None
+    latest_mtime = None
+    entry_count = 0
+    stat_count = 0
+    fallback_count = 0
+    stack = [os.fspath(dir_path)]
+    if not os.path.isdir(stack[0]):
+        logger.warning(f"Directory does not exist: {dir_path}")
+        return None
+    with profiling.span('walk', path=os.fspath(dir_path), mode='filename') as walk_span:
+        while stack:
+            if threshold is not None and latest_mtime is not None and latest_mtime >= threshold:
+                break
+            candidate_key = None
+            candidate = None
+            matched = []
+            unmatched = []
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as iterator:
+                    for entry in iterator:
+                        entry_count += 1
+                        if skip_hidden and entry.name[0] == '.':
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                continue
+                        except OSError:
+                            continue
+                        match = pattern.search(entry.name)
+                        if match is None:
+                            unmatched.append(entry)
+                            continue
+                        matched.append(entry)
+                        key = _timestamp_key(match)
+                        if candidate_key is None or key > candidate_key:
+                            candidate_key = key
+                            candidate = entry
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Unable to list {directory}: {e}")
+                continue
+
+            to_stat = unmatched
+            if candidate is not None:
+                try:
+                    stat_count += 1
+                    mtime = candidate.stat().st_mtime
+                    if latest_mtime is None or mtime > latest_mtime:
+                        latest_mtime = mtime
+                except FileNotFoundError:
+                    to_stat = unmatched + matched
+            if to_stat:
+                fallback_count += 1
+            for entry in to_stat:
+                try:
+                    stat_count += 1
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if latest_mtime is None or mtime > latest_mtime:
+                    latest_mtime = mtime
+        walk_span.set(entries=entry_count, stats=stat_count, fallback_directories=fallback_count)
+    if fallback_count:
+        logger.debug(f"{fallback_count} directories below {dir_path} contain names not matching {pattern.pattern}")
+    registry.inc(
+        'aws_monitor_entries_scanned_total',
+        entry_count,
+        help='Directory entries visited while searching for the latest modification time',
+        path=os.fspath(dir_path),
+    )
+    registry.inc(
+        'aws_monitor_stat_calls_total',
+        stat_count,
+        help='Files stat\'ed while searching for the latest modification time by file name',
+        path=os.fspath(dir_path),
+    )
+
+    if latest_mtime is None:
+        return None
+    return datetime.fromtimestamp(latest_mtime, tz=timezone.utc)
+
+
 def get_modified_time(
         files: Iterable[Path],
         skip_dir: bool = False,
         skip_hidden: bool = True,
-) -> pd.DataFrame:
+) -> 'pd.DataFrame':
+    import pandas as pd
+
+    paths = []
+    with profiling.span('stat') as stat_span:
+        for path in files:
+            if skip_dir and path.is_dir():
+                continue
+            if skip_hidden and path.name[0] == '.':
+                continue
+            file_info = dict(
+                stem=path.stem,
+                path=path.as_posix(),
+                modified_datetime=datetime.fromtimestamp(
+                    path.stat().st_mtime,
+                    tz=timezone.utc,
+                ),
+            )
+            paths.append(file_info)
+        stat_span.set(entries=len(paths))
+    with profiling.span('dataframe', rows=len(paths)):
+        return pd.DataFrame(paths, columns=['stem', 'path', 'modified_datetime'])
+
+
+def scan_modified_time(
+        dir_path: Path,
+        skip_dir: bool = False,
+        skip_hidden: bool = True,
+) -> 'pd.DataFrame':
+    """
+    Build a report table with the modification time of all entries below `dir_path`.
+
+    Same columns as `get_modified_time`, but reuses the stat information from `scan_tree`. Only use this for
+    reporting; `check_update_time` does not need the full table.
+    """
+    import pandas as pd
+
+    stems = []
     paths = []
-    for path in files:
-        if skip_dir and path.is_dir():
-            continue
-        if skip_hidden and path.name[0] == '.':
-            continue
-        file_info = dict(
-            stem=path.stem,
-            path=path.as_posix(),
-            modified_datetime=datetime.fromtimestamp(
-                path.stat().st_mtime,
-                tz=timezone.utc,
+    mtimes = []
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_dir=skip_dir, skip_hidden=skip_hidden):
+            try:
+                mtimes.append(entry.stat().st_mtime)
+            except FileNotFoundError:
+                continue
+            path = Path(entry.path)
+            stems.append(path.stem)
+            paths.append(path.as_posix())
+        walk_span.set(entries=len(mtimes))
+    with profiling.span('dataframe', rows=len(mtimes)):
+        return pd.DataFrame(
+            dict(
+                stem=stems,
+                path=paths,
+                modified_datetime=pd.to_datetime(mtimes, unit='s', utc=True),
             ),
+            columns=['stem', 'path', 'modified_datetime'],
+        )
+
+
+def get_station_modified_time(
+        dir_path: Path,
+        skip_hidden: bool = True,
+) -> 'pd.DataFrame':
+    """
+    Latest file modification time and file count per station sub-directory of `dir_path`.
+
+    The tree is scanned once and only a station code and mtime per file are kept in compact arrays, which are then
+    aggregated in a single groupby. Stations without any files are included with a NaT modification time.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by station with columns `modified_datetime` and `file_count`
+    """
+    import numpy as np
+    import pandas as pd
+
+    root = os.fspath(dir_path).rstrip(os.sep) + os.sep
+    station_codes: Dict[str, int] = dict()
+    codes = array('l')
+    mtimes = array('d')
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_hidden=skip_hidden):
+            station, separator, _ = entry.path[len(root):].partition(os.sep)
+            if not separator:
+                # Station directories themselves and files located directly in dir_path
+                if entry.is_dir(follow_symlinks=False):
+                    station_codes.setdefault(station, len(station_codes))
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                mtimes.append(entry.stat().st_mtime)
+            except FileNotFoundError:
+                continue
+            codes.append(station_codes.setdefault(station, len(station_codes)))
+        walk_span.set(entries=len(mtimes), stations=len(station_codes))
+    registry.inc(
+        'aws_monitor_entries_scanned_total',
+        len(mtimes),
+        help='Directory entries visited while searching for the latest modification time',
+        path=os.fspath(dir_path),
+    )
+
+    with profiling.span('dataframe', rows=len(mtimes)):
+        stations = pd.Categorical.from_codes(
+            codes=np.asarray(codes),
+            categories=list(station_codes),
+        )
+        station_stats = (
+            pd.DataFrame(dict(station=stations, mtime=mtimes))
+            .groupby('station', observed=False)['mtime']
+            .agg(['max', 'count'])
+        )
+        return pd.DataFrame(
+            dict(
+                modified_datetime=pd.to_datetime(station_stats['max'], unit='s', utc=True),
+                file_count=station_stats['count'],
+            ),
+            index=station_stats.index.astype(str),
         )
-        paths.append(file_info)
-    return pd.DataFrame(paths, columns=['stem', 'path', 'modified_datetime'])
 
 
 def check_update_time(
         dir_path: Path,
         current_time: datetime,
         max_age: timedelta,
+        directory_index: Optional[DirectoryIndex] = None,
+        tree_watcher: Optional['TreeWatcher'] = None,
+        filename_pattern: Optional[Union[str, 're.Pattern']] = None,
+        scanner: Optional['ShardedScanner'] = None,
 ) -> bool:
     '''Find the most recent update time for all files in dirpath,
     and return a status boolean if we pass certain time check thresholds.
 
+    The directory tree is streamed and the scan stops as soon as a file
+    younger than `max_age` is found. Hidden files and the content of hidden
+    directories such as `.git` are not considered, and directories that
+    cannot be read are skipped. If a directory index is provided, only
+    directories that changed since the previous run are listed. If a tree
+    watcher is provided and its state of dir_path is available, no
+    directories are listed at all. With a filename pattern, only the file
+    with the newest timestamp in its name is stat'ed in each directory.
+    Otherwise a sharded scanner scans the station directories concurrently.
+
     Parameters
     ----------
     dir_path : Path
@@ -51,15 +401,126 @@ def check_update_time(
         Current datetime used for determine file age
     max_age : timedelta
         Maximum allowed age of latest modified file before returning True.
+    directory_index : DirectoryIndex, optional
+        Persistent index of directory modification times
+    tree_watcher : TreeWatcher, optional
+        inotify watcher of the directory trees, used in daemon mode
+    filename_pattern : str, optional
+        Regular expression of the file names with a `timestamp` group,
+        see `get_latest_modified_time_by_name`
+    scanner : ShardedScanner, optional
+        Pool scanning the station sub-directories concurrently
 
     Returns
     -------
     status : bool
         Result of the check. False (default) is passing, True is alert condition
     '''
-    modified_time_df = get_modified_time(dir_path.rglob('*'))
-    if modified_time_df.empty:
+    watched = False
+    # The scans with newer_than stop at the first fresh file, which need not be the newest
+    early_exit = False
+    if tree_watcher is not None:
+        with profiling.span('watch_lookup', path=os.fspath(dir_path)) as lookup_span:
+            watched, latest_modified_time = tree_watcher.get_latest_modified_time(dir_path)
+            lookup_span.set(watched=watched)
+    if not watched:
+        early_exit = directory_index is None or filename_pattern is not None
+        if filename_pattern is not None:
+            latest_modified_time = get_latest_modified_time_by_name(
+                dir_path,
+                filename_pattern,
+                newer_than=current_time - max_age,
+            )
+        elif directory_index is not None:
+            with profiling.span('index_lookup', path=os.fspath(dir_path)):
+                latest_modified_time = directory_index.get_latest_modified_time(dir_path)
+        elif scanner is not None:
+            latest_modified_time = scanner.get_latest_modified_time(
+                dir_path,
+                newer_than=current_time - max_age,
+            )
+        else:
+            latest_modified_time = get_latest_modified_time(
+                dir_path,
+                newer_than=current_time - max_age,
+            )
+    if latest_modified_time is None:
         logger.warning(f"Unable to find any files in {dir_path}")
         return True
-    latest_age = current_time - modified_time_df['modified_datetime'].max()
+    latest_age = current_time - latest_modified_time
+    report_data_age(latest_age, upper_bound=early_exit and latest_age <= max_age)
+    registry.set_gauge(
+        'aws_monitor_data_age_seconds',
+        latest_age.total_seconds(),
+        help='Age of the newest data found. An upper bound when the scan stopped at the first fresh file',
+        path=os.fspath(dir_path),
+    )
     return latest_age > max_age
+
+
+def check_station_update_time(
+        dir_path: Path,
+        current_time: datetime,
+        max_age: timedelta,
+        stations: Optional[Sequence[str]] = None,
+        tree_watcher: Optional['TreeWatcher'] = None,
+        scanner: Optional['ShardedScanner'] = None,
+) -> 'pd.Series':
+    '''Find the most recent update time for each station sub-directory in dir_path
+    and return the stations which are older than `max_age`.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Directory path to dir containing station sub-directories and files
+    current_time : datetime
+        Current datetime used for determine file age
+    max_age : timedelta
+        Maximum allowed age of latest modified file per station.
+    stations : Sequence[str], optional
+        Stations to check. All station sub-directories are checked if not provided.
+        Listed stations without a sub-directory are reported as stale with unknown age.
+    tree_watcher : TreeWatcher, optional
+        inotify watcher of the directory trees. The tree is scanned if the watched state is not available.
+    scanner : ShardedScanner, optional
+        Pool scanning the station sub-directories concurrently when the tree is scanned
+
+    Returns
+    -------
+    stale_stations : pd.Series
+        Age of the latest modified file for each stale station, oldest first
+    '''
+    import pandas as pd
+
+    watched = False
+    if tree_watcher is not None:
+        with profiling.span('watch_lookup', path=os.fspath(dir_path)) as lookup_span:
+            watched, station_times = tree_watcher.get_station_modified_times(dir_path)
+            lookup_span.set(watched=watched, stations=len(station_times))
+    if watched:
+        station_modified_time = pd.Series(
+            pd.to_datetime(list(station_times.values()), utc=True),
+            index=pd.Index(list(station_times), dtype=str, name='station'),
+            name='modified_datetime',
+        )
+    elif scanner is not None:
+        station_modified_time = scanner.get_station_modified_time(dir_path)['modified_datetime']
+    else:
+        station_modified_time = get_station_modified_time(dir_path)['modified_datetime']
+    if stations is not None:
+        station_modified_time = station_modified_time.reindex(list(stations))
+    station_age = current_time - station_modified_time
+    if station_age.notna().any():
+        # The age of the check as a whole is that of the stalest station
+        report_data_age(station_age.max())
+    for station, age in station_age.dropna().items():
+        report_data_age(age, station=station)
+        registry.set_gauge(
+            'aws_monitor_station_data_age_seconds',
+            age.total_seconds(),
+            help='Age of the newest file per station',
+            path=os.fspath(dir_path),
+            station=station,
+        )
+    stale = station_age[station_age.isna() | (station_age > max_age)]
+    return stale.sort_values(ascending=False, na_position='first')
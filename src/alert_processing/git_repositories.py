@@ -1,11 +1,26 @@
+import json
 import logging
+import os
 import subprocess
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Sequence, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.metrics import registry
 
 __all__ = [
-    'get_last_commit_datetime'
+    'get_last_commit_datetime',
+    'get_last_commit_datetimes',
+    'is_ancestor',
+    'find_git_dir',
+    'read_head',
+    'CommitTimeCache',
+    'check_last_commit',
 ]
 
 logger = logging.getLogger(__name__)
@@ -19,32 +34,309 @@ def get_last_commit_datetime(repository_path: Path) -> Optional[datetime]:
     If `repository_path` is a subdirectory, only commits related to files located below will be considered.
     """
     try:
-        stdout = subprocess.check_output(
+        with profiling.span('git_log', path=os.fspath(repository_path)):
+            stdout = subprocess.check_output(
+                [
+                    'git',
+                    "-C", repository_path,
+                    'log',
+                    '-n 1',
+                    '--format=%aI',
+                    '--', '.'
+                ],
+            )
+
+        datetime_string = stdout.decode("utf-8").strip()
+        return datetime.fromisoformat(datetime_string)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logger.error(f"Failed while parsing: {repository_path}: {e}")
+        return None
+
+
+def _matches(file_path: str, pathspec: str) -> bool:
+    if pathspec in ('', '.'):
+        return True
+    pathspec = pathspec.rstrip('/')
+    return file_path == pathspec or file_path.startswith(pathspec + '/')
+
+
+def get_last_commit_datetimes(
+        repository_path: Path,
+        pathspecs: Sequence[str],
+        revisions: Sequence[str] = (),
+) -> Dict[str, Optional[datetime]]:
+    """
+    Read the date of the latest commit of HEAD for each of `pathspecs` in a single history walk.
+
+    The pathspecs are directories or files relative to `repository_path`. The history is read newest first and the
+    walk is stopped as soon as a commit has been found for every pathspec. Pathspecs without any commits are None.
+    Only the first parents are followed and merge commits count for the files they change relative to their first
+    parent, so data merged from a branch is dated by the merge.
+    `revisions` limits the walk, e.g. to a range `old..new`, instead of the full history of HEAD.
+    """
+    last_commit_datetimes: Dict[str, Optional[datetime]] = {pathspec: None for pathspec in pathspecs}
+    remaining = set(pathspecs)
+    if not remaining:
+        return last_commit_datetimes
+
+    with profiling.span('git_log', path=os.fspath(repository_path), pathspecs=len(pathspecs)):
+        process = subprocess.Popen(
             [
                 'git',
-                "-C", repository_path,
+                '-C', os.fspath(repository_path),
                 'log',
-                '-n 1',
-                '--format=%aI',
-                '--', '.'
+                '--format=%x00%aI',
+                '--name-only',
+                # Merge commits list no files without -m
+                '--first-parent',
+                '-m',
+                '--relative',
+                '--no-renames',
+                *revisions,
+                '--', *pathspecs,
             ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
+        commit_datetime = None
+        try:
+            for line in process.stdout:
+                line = line.decode('utf-8').rstrip('\n')
+                if line.startswith('\0'):
+                    commit_datetime = datetime.fromisoformat(line[1:])
+                    continue
+                if not line or commit_datetime is None:
+                    continue
+                for pathspec in [p for p in remaining if _matches(line, p)]:
+                    last_commit_datetimes[pathspec] = commit_datetime
+                    remaining.remove(pathspec)
+                if not remaining:
+                    break
+        finally:
+            if remaining:
+                stderr = process.communicate()[1]
+                if process.returncode:
+                    raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+            else:
+                process.kill()
+                process.communicate()
+    return last_commit_datetimes
 
-        datetime_string = stdout.decode("utf-8").strip()
-        return datetime.fromisoformat(datetime_string)
-    except subprocess.CalledProcessError as e:
-        print(f"Failed while parsing: {repository_path}")
-        return None
+
+def is_ancestor(repository_path: Path, ancestor: str, descendant: str) -> bool:
+    """Whether commit `ancestor` is reachable from `descendant`. False if either commit does not exist."""
+    result = subprocess.run(
+        ['git', '-C', os.fspath(repository_path), 'merge-base', '--is-ancestor', ancestor, descendant],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def find_git_dir(path: Path) -> Optional[Path]:
+    """Find the git directory of the repository containing `path`, following `.git` files of worktrees"""
+    path = Path(path).absolute()
+    for directory in (path, *path.parents):
+        dot_git = directory / '.git'
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            content = dot_git.read_text().strip()
+            if content.startswith('gitdir:'):
+                return (directory / content[len('gitdir:'):].strip()).resolve()
+    return None
+
+
+def _common_dir(git_dir: Path) -> Path:
+    commondir_file = git_dir / 'commondir'
+    if commondir_file.is_file():
+        return (git_dir / commondir_file.read_text().strip()).resolve()
+    return git_dir
+
+
+def _head_ref(git_dir: Path) -> Optional[str]:
+    head = (git_dir / 'HEAD').read_text().strip()
+    if head.startswith('ref:'):
+        return head[len('ref:'):].strip()
+    return None
+
+
+def _ref_files(git_dir: Path) -> Tuple[Path, ...]:
+    common_dir = _common_dir(git_dir)
+    ref = _head_ref(git_dir)
+    files = [git_dir / 'HEAD', common_dir / 'packed-refs']
+    if ref is not None:
+        files.append(common_dir / ref)
+    return tuple(files)
+
+
+def _ref_state(git_dir: Path) -> Tuple[Optional[int], ...]:
+    """Modification times of HEAD and the files HEAD points to. Any commit changes at least one of these."""
+    state = []
+    for ref_file in _ref_files(git_dir):
+        try:
+            state.append(ref_file.stat().st_mtime_ns)
+        except FileNotFoundError:
+            state.append(None)
+    return tuple(state)
+
+
+def read_head(git_dir: Path) -> Optional[str]:
+    """Read the commit sha of HEAD directly from the git directory without invoking git"""
+    ref = _head_ref(git_dir)
+    if ref is None:
+        return (git_dir / 'HEAD').read_text().strip()
+
+    common_dir = _common_dir(git_dir)
+    ref_file = common_dir / ref
+    if ref_file.is_file():
+        return ref_file.read_text().strip()
+    packed_refs = common_dir / 'packed-refs'
+    if packed_refs.is_file():
+        for line in packed_refs.read_text().splitlines():
+            if line.endswith(' ' + ref):
+                return line.split(' ', 1)[0]
+    return None
+
+
+@attr.s
+class CommitTimeCache:
+    """
+    Cache of last commit times per pathspec for a repository, keyed by the sha of HEAD.
+
+    As long as the modification times of HEAD and the ref it points to are unchanged, the cached times are returned
+    without reading any files or invoking git. When HEAD has moved forward, only the new commits are read to update
+    the cached times, so a pathspec without recent commits does not cause a walk of the whole history on every
+    commit. Pathspecs that are not cached yet are read in a single history walk, as are all pathspecs when the
+    history was rewritten. The cache is optionally persisted in `cache_path` to survive between runs.
+    """
+    repository_path: Path = attr.ib(converter=Path)
+    cache_path: Optional[Path] = attr.ib(default=None)
+    git_dir: Optional[Path] = attr.ib(init=False, default=None)
+    head_sha: Optional[str] = attr.ib(init=False, default=None)
+    ref_state: Optional[Tuple] = attr.ib(init=False, default=None)
+    commit_datetimes: Dict[str, Optional[datetime]] = attr.ib(init=False, factory=dict)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.git_dir = find_git_dir(self.repository_path)
+        if self.cache_path is not None:
+            self._load()
+
+    def _load(self):
+        """Load the persisted cache. An unreadable or invalid cache is ignored and rebuilt by the next update."""
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        try:
+            if cache.get('repository_path') != os.fspath(self.repository_path):
+                return
+            head_sha = cache['head_sha']
+            ref_state = tuple(cache['ref_state'])
+            commit_datetimes = {
+                pathspec: datetime.fromisoformat(value) if value else None
+                for pathspec, value in cache['commit_datetimes'].items()
+            }
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid commit time cache {self.cache_path}: {e!r}")
+            return
+        self.head_sha = head_sha
+        self.ref_state = ref_state
+        self.commit_datetimes = commit_datetimes
+
+    def _save(self):
+        cache = dict(
+            repository_path=os.fspath(self.repository_path),
+            head_sha=self.head_sha,
+            ref_state=self.ref_state,
+            commit_datetimes={
+                pathspec: value.isoformat() if value else None
+                for pathspec, value in self.commit_datetimes.items()
+            },
+        )
+        temporary_path = self.cache_path.with_name(self.cache_path.name + '.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temporary_path, self.cache_path)
+
+    def get_last_commit_datetimes(self, pathspecs: Sequence[str] = ('.',)) -> Dict[str, Optional[datetime]]:
+        if self.git_dir is None:
+            raise FileNotFoundError(f"{self.repository_path} is not located in a git repository")
+        with self._lock:
+            modified = False
+            ref_state = _ref_state(self.git_dir)
+            if ref_state != self.ref_state:
+                head_sha = read_head(self.git_dir)
+                if head_sha is None or head_sha != self.head_sha:
+                    logger.debug(f"HEAD of {self.repository_path} moved from {self.head_sha} to {head_sha}")
+                    self._update_commit_datetimes(head_sha)
+                    modified = True
+                self.head_sha = head_sha
+                self.ref_state = ref_state
+
+            missing = [pathspec for pathspec in pathspecs if pathspec not in self.commit_datetimes]
+            if missing:
+                self.commit_datetimes.update(get_last_commit_datetimes(
+                    self.repository_path,
+                    missing,
+                    revisions=[self.head_sha] if self.head_sha else [],
+                ))
+                modified = True
+            if modified and self.cache_path is not None:
+                self._save()
+            return {pathspec: self.commit_datetimes[pathspec] for pathspec in pathspecs}
+
+    def _update_commit_datetimes(self, head_sha: Optional[str]):
+        """Update the cached times with the commits since the previous HEAD, or drop them if history was rewritten"""
+        if (
+                head_sha is None or self.head_sha is None or not self.commit_datetimes
+                or not is_ancestor(self.repository_path, self.head_sha, head_sha)
+        ):
+            self.commit_datetimes = dict()
+            return
+        new_datetimes = get_last_commit_datetimes(
+            self.repository_path,
+            list(self.commit_datetimes),
+            revisions=[f'{self.head_sha}..{head_sha}'],
+        )
+        self.commit_datetimes.update({
+            pathspec: commit_datetime
+            for pathspec, commit_datetime in new_datetimes.items()
+            if commit_datetime is not None
+        })
+
+    def get_last_commit_datetime(self, pathspec: str = '.') -> Optional[datetime]:
+        return self.get_last_commit_datetimes([pathspec])[pathspec]
 
 
 def check_last_commit(
         repository_path: Path,
         current_time: datetime,
         max_age: timedelta,
+        commit_time_cache: Optional[CommitTimeCache] = None,
 ) -> bool:
-    last_commit_datetime = get_last_commit_datetime(repository_path)
+    if commit_time_cache is not None:
+        try:
+            last_commit_datetime = commit_time_cache.get_last_commit_datetime()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.error(f"Failed reading last commit: {repository_path}: {e}")
+            last_commit_datetime = None
+    else:
+        last_commit_datetime = get_last_commit_datetime(repository_path)
+    if last_commit_datetime is None:
+        logger.warning(f"Unable to determine the last commit of {repository_path}")
+        return True
     commit_age = current_time - last_commit_datetime
     logger.debug(f"Commit age {repository_path}: {commit_age}")
+    report_data_age(commit_age)
+    registry.set_gauge(
+        'aws_monitor_data_age_seconds',
+        commit_age.total_seconds(),
+        help='Age of the newest data found. An upper bound when the scan stopped at the first fresh file',
+        path=os.fspath(repository_path),
+    )
     return commit_age > max_age
 
 # %%
@@ -0,0 +1,300 @@
+"""
+Heartbeats of remote hosts such as glacio01.
+
+Hosts send a small heartbeat over UDP or HTTP every few minutes and the receiver keeps the last time each host was
+seen in memory. The `heartbeat` check of the daemon reports hosts that have not been seen within the maximum age
+through the configured notification client, like any other check.
+
+A heartbeat is the host name optionally followed by a shared token, e.g. `glacio01 s3cret`. It can be sent with
+`python -m alert_processing.heartbeat send`, curl or even bash alone:
+
+    echo "glacio01 s3cret" > /dev/udp/azure-aws/9478
+    curl -fsS -X POST -H 'X-Heartbeat-Token: s3cret' http://azure-aws:9479/heartbeat/glacio01
+"""
+import hmac
+import json
+import logging
+import re
+import socket
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+import attr
+
+from alert_processing.check_runner import report_data_age
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+    from socketserver import UDPServer
+
+__all__ = [
+    'HeartbeatRegistry',
+    'HeartbeatReceiver',
+    'parse_heartbeat',
+    'send_udp_heartbeat',
+    'send_http_heartbeat',
+    'check_heartbeats',
+]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UDP_PORT = 9478
+DEFAULT_HTTP_PORT = 9479
+_HOST_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]{0,63}')
+# Bound on the number of distinct hosts kept in memory, in case of a flood of forged names without a token
+_MAX_HOSTS = 1000
+
+
+def parse_heartbeat(payload: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """Return the host name and token of a heartbeat payload, or (None, None) if the host name is invalid"""
+    parts = payload.decode('utf-8', errors='replace').split()
+    if not parts or not _HOST_PATTERN.fullmatch(parts[0]):
+        return None, None
+    return parts[0], parts[1] if len(parts) > 1 else None
+
+
+@attr.s
+class HeartbeatRegistry:
+    """
+    Last heartbeat time of each host.
+
+    Hosts which have not been seen since the registry was created are measured from its creation, so a restart of
+    the daemon does not report every host as stale before it had a chance to send a heartbeat.
+    """
+    token: Optional[str] = attr.ib(default=None, repr=False)
+    started_at: float = attr.ib(factory=time.time)
+    last_seen: Dict[str, float] = attr.ib(init=False, factory=dict)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def record(self, host: str, token: Optional[str] = None, timestamp: Optional[float] = None) -> bool:
+        """Record a heartbeat of `host`. Returns False if it was rejected."""
+        if self.token is not None and not hmac.compare_digest((token or '').encode(), self.token.encode()):
+            logger.warning(f"Rejected heartbeat of {host} with an invalid token")
+            return False
+        with self._lock:
+            if host not in self.last_seen and len(self.last_seen) >= _MAX_HOSTS:
+                logger.warning(f"Rejected heartbeat of {host}, already tracking {_MAX_HOSTS} hosts")
+                return False
+            self.last_seen[host] = timestamp if timestamp is not None else time.time()
+        return True
+
+    def get_last_seen(self) -> Dict[str, datetime]:
+        with self._lock:
+            last_seen = dict(self.last_seen)
+        return {host: datetime.fromtimestamp(seen, tz=timezone.utc) for host, seen in last_seen.items()}
+
+    def get_ages(
+            self,
+            current_time: datetime,
+            hosts: Optional[Sequence[str]] = None,
+    ) -> Dict[str, Tuple[timedelta, bool]]:
+        """Age of the last heartbeat of each host and whether the host has been seen at all"""
+        with self._lock:
+            last_seen = dict(self.last_seen)
+        if hosts is None:
+            hosts = list(last_seen)
+        now = current_time.timestamp()
+        return {
+            host: (timedelta(seconds=now - last_seen.get(host, self.started_at)), host in last_seen)
+            for host in hosts
+        }
+
+
+def _handle_payload(heartbeat_registry: HeartbeatRegistry, payload: bytes, protocol: str):
+    host, token = parse_heartbeat(payload)
+    if host is None:
+        logger.debug(f"Ignoring invalid {protocol} heartbeat")
+        return False
+    accepted = heartbeat_registry.record(host, token)
+    if accepted:
+        registry.inc(
+            'aws_monitor_heartbeats_received_total',
+            help='Heartbeats received from remote hosts',
+            protocol=protocol,
+        )
+    return accepted
+
+
+@attr.s
+class HeartbeatReceiver:
+    """
+    Receive heartbeats over UDP and/or HTTP in background threads.
+
+    The HTTP receiver accepts `POST /heartbeat/<host>` with the token in the `X-Heartbeat-Token` header and serves
+    the last seen times of all hosts as JSON at `GET /heartbeats`.
+    """
+    heartbeat_registry: HeartbeatRegistry = attr.ib()
+    bind: str = attr.ib(default='')
+    udp_port: Optional[int] = attr.ib(default=None)
+    http_port: Optional[int] = attr.ib(default=None)
+    _udp_server: Optional['UDPServer'] = attr.ib(init=False, repr=False, default=None)
+    _http_server: Optional['ThreadingHTTPServer'] = attr.ib(init=False, repr=False, default=None)
+
+    def start(self):
+        if self.udp_port is not None:
+            self._udp_server = self._start_udp_server()
+        if self.http_port is not None:
+            self._http_server = self._start_http_server()
+
+    def close(self):
+        for server in (self._udp_server, self._http_server):
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        self._udp_server = self._http_server = None
+
+    @property
+    def udp_address(self) -> Optional[Tuple[str, int]]:
+        return self._udp_server.server_address if self._udp_server is not None else None
+
+    @property
+    def http_address(self) -> Optional[Tuple[str, int]]:
+        return self._http_server.server_address if self._http_server is not None else None
+
+    def _start_udp_server(self) -> 'UDPServer':
+        from socketserver import BaseRequestHandler, UDPServer
+
+        heartbeat_registry = self.heartbeat_registry
+
+        class HeartbeatHandler(BaseRequestHandler):
+            def handle(self):
+                payload, _ = self.request
+                _handle_payload(heartbeat_registry, payload[:256], 'udp')
+
+        # Handling a datagram is a dictionary update, so no thread per request is needed
+        server = UDPServer((self.bind, self.udp_port), HeartbeatHandler)
+        thread = threading.Thread(target=server.serve_forever, name='heartbeat-udp', daemon=True)
+        thread.start()
+        logger.info(f"Receiving UDP heartbeats on port {server.server_address[1]}")
+        return server
+
+    def _start_http_server(self) -> 'ThreadingHTTPServer':
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        heartbeat_registry = self.heartbeat_registry
+
+        class HeartbeatHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                prefix = '/heartbeat/'
+                path = self.path.split('?')[0]
+                if not path.startswith(prefix):
+                    self.send_error(404)
+                    return
+                # The body is not used, but is read so that the connection can be reused
+                self.rfile.read(min(int(self.headers.get('Content-Length') or 0), 1024))
+                token = self.headers.get('X-Heartbeat-Token')
+                payload = path[len(prefix):] + (f' {token}' if token else '')
+                if _handle_payload(heartbeat_registry, payload.encode(), 'http'):
+                    self.send_response(204)
+                    self.end_headers()
+                else:
+                    self.send_error(403)
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/heartbeats':
+                    self.send_error(404)
+                    return
+                content = json.dumps({
+                    host: seen.isoformat() for host, seen in heartbeat_registry.get_last_seen().items()
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = ThreadingHTTPServer((self.bind, self.http_port), HeartbeatHandler)
+        thread = threading.Thread(target=server.serve_forever, name='heartbeat-http', daemon=True)
+        thread.start()
+        logger.info(f"Receiving HTTP heartbeats on port {server.server_address[1]}")
+        return server
+
+
+def send_udp_heartbeat(server: str, port: int = DEFAULT_UDP_PORT, host: Optional[str] = None,
+                       token: Optional[str] = None):
+    """Send a single heartbeat datagram. Delivery is not confirmed, so send more often than the maximum age."""
+    host = host or socket.gethostname().split('.')[0]
+    payload = f'{host} {token}' if token else host
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(payload.encode('utf-8'), (server, port))
+
+
+def send_http_heartbeat(url: str, host: Optional[str] = None, token: Optional[str] = None, timeout: float = 10.):
+    """Send a heartbeat to the HTTP receiver at `url`, e.g. http://azure-aws:9479. Raises on failure."""
+    from urllib.request import Request, urlopen
+
+    host = host or socket.gethostname().split('.')[0]
+    request = Request(f"{url.rstrip('/')}/heartbeat/{host}", data=b'', method='POST')
+    if token:
+        request.add_header('X-Heartbeat-Token', token)
+    with urlopen(request, timeout=timeout):
+        pass
+
+
+def check_heartbeats(
+        heartbeat_registry: HeartbeatRegistry,
+        current_time: datetime,
+        max_age: timedelta,
+        hosts: Optional[Sequence[str]] = None,
+) -> Dict[str, Tuple[timedelta, bool]]:
+    '''Find the hosts whose last heartbeat is older than `max_age`.
+
+    Parameters
+    ----------
+    heartbeat_registry : HeartbeatRegistry
+        Last heartbeat times received by the HeartbeatReceiver
+    current_time : datetime
+        Current datetime used for determine the heartbeat age
+    max_age : timedelta
+        Maximum allowed age of the last heartbeat per host.
+    hosts : Sequence[str], optional
+        Expected hosts. All hosts that sent a heartbeat are checked if not provided.
+
+    Returns
+    -------
+    stale_hosts : Dict[str, Tuple[timedelta, bool]]
+        Age of the last heartbeat and whether the host has been seen since the start, for each stale host
+    '''
+    host_ages = heartbeat_registry.get_ages(current_time, hosts=hosts)
+    for host, (age, seen) in host_ages.items():
+        report_data_age(age, station=host)
+        if seen:
+            registry.set_gauge(
+                'aws_monitor_heartbeat_age_seconds',
+                age.total_seconds(),
+                help='Age of the last heartbeat per host',
+                host=host,
+            )
+    if host_ages:
+        report_data_age(max(age for age, _ in host_ages.values()))
+    return {host: (age, seen) for host, (age, seen) in host_ages.items() if age > max_age}
+
+
+def main(arguments: Optional[List[str]] = None):
+    parser = ArgumentParser(description="Send a heartbeat to the aws-monitor-alert daemon")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    send_parser = subparsers.add_parser('send', help='Send a heartbeat')
+    send_parser.add_argument('--udp', metavar='SERVER[:PORT]', help='Send a UDP datagram to the server')
+    send_parser.add_argument('--url', help='Send an HTTP request to the receiver at URL, e.g. http://azure-aws:9479')
+    send_parser.add_argument('--host', help='Host name to report. Defaults to the short host name')
+    send_parser.add_argument('--token', help='Shared token configured in the heartbeat section of the receiver')
+    args = parser.parse_args(arguments)
+
+    if not args.udp and not args.url:
+        parser.error('--udp or --url is required')
+    if args.udp:
+        server, _, port = args.udp.partition(':')
+        send_udp_heartbeat(server, int(port or DEFAULT_UDP_PORT), host=args.host, token=args.token)
+    if args.url:
+        send_http_heartbeat(args.url, host=args.host, token=args.token)
+
+
+if __name__ == '__main__':
+    main()
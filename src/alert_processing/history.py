@@ -0,0 +1,386 @@
+"""
+Columnar history of the data ages and results of every check run.
+
+Each run appends fixed size binary records to a journal file using only the standard library. Compaction merges the
+journal into one sorted `.npy` file per column (`time`, `key`, `age`, `alert`), which are memory mapped when read, so
+a query over a time window only touches the pages of the columns and rows it needs. Keys are the check names, with
+`check/station` for per-station ages, and are stored as integer ids with the names in `keys.json`. Ages of scans that
+stopped at the first fresh file are upper bounds of the true age and are flagged as such.
+
+    python -m alert_processing.history /data/logs/aws-monitor-alert.history quantile bufr_out --q 0.95 --days 30
+    python -m alert_processing.history /data/logs/aws-monitor-alert.history summary --days 30
+    python -m alert_processing.history /data/logs/aws-monitor-alert.history compact --retention-days 400
+
+Reading and compacting need numpy from the `reporting` extra.
+"""
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+import sys
+import threading
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence
+
+import attr
+
+from alert_processing.check_runner import CheckResult
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+__all__ = [
+    'FreshnessHistory',
+]
+
+logger = logging.getLogger(__name__)
+
+# time (unix seconds), key id, age (seconds, NaN if unknown), alert (0 passing, 1 alert, 2 failed) combined with the
+# _UPPER_BOUND flag
+_RECORD = struct.Struct('<dIdB')
+_COLUMNS = ('time', 'key', 'age', 'alert')
+_UPPER_BOUND = 0x80
+# Columns returned by `read`, upper_bound is stored in the alert column
+_READ_COLUMNS = _COLUMNS + ('upper_bound',)
+_JOURNAL_NAME = 'journal.bin'
+_CURRENT_NAME = 'CURRENT'
+
+
+def _record_dtype():
+    import numpy as np
+
+    return np.dtype([('time', '<f8'), ('key', '<u4'), ('age', '<f8'), ('alert', 'u1')])
+
+
+def _drop_partial_record(journal, path: Path):
+    """Truncate a record left incomplete by an interrupted append, which would misalign all records after it"""
+    size = journal.seek(0, os.SEEK_END)
+    partial_size = size % _RECORD.size
+    if partial_size:
+        logger.warning(f"Dropping a partially written record of {partial_size} bytes at the end of {path}")
+        journal.truncate(size - partial_size)
+
+
+@attr.s
+class FreshnessHistory:
+    """
+    History store in the directory `path`.
+
+    The journal is compacted automatically by `append` once it holds more than `compact_threshold` records, if numpy
+    is available.
+    """
+    path: Path = attr.ib(converter=Path)
+    compact_threshold: Optional[int] = attr.ib(default=50000)
+    keys: List[str] = attr.ib(init=False, factory=list)
+    _key_ids: Dict[str, int] = attr.ib(init=False, repr=False, factory=dict)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_keys()
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        """Readers take a shared lock, appends and compaction an exclusive lock"""
+        with self._lock, open(self.path / 'lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _load_keys(self):
+        try:
+            self.keys = json.loads((self.path / 'keys.json').read_text())
+        except FileNotFoundError:
+            self.keys = []
+        self._key_ids = {key: i for i, key in enumerate(self.keys)}
+
+    def _key_id(self, key: str) -> int:
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            # Another process may have added keys since they were loaded
+            self._load_keys()
+            key_id = self._key_ids.get(key)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.keys.append(key)
+            self._key_ids[key] = key_id
+            temporary_path = self.path / 'keys.json.tmp'
+            temporary_path.write_text(json.dumps(self.keys))
+            os.replace(temporary_path, self.path / 'keys.json')
+        return key_id
+
+    def append_results(self, results: Sequence[CheckResult], time: Optional[datetime] = None):
+        """Append the data ages and status of `results`. Skipped checks are not recorded."""
+        time = time or datetime.now(tz=timezone.utc)
+        rows = []
+        for result in results:
+            if result.skipped:
+                continue
+            alert = 2 if result.error is not None else int(result.alert is not None)
+            rows.append((
+                result.name,
+                result.data_ages.get(None, math.nan),
+                alert,
+                None in result.upper_bound_ages,
+            ))
+            for station, age in result.data_ages.items():
+                if station is not None:
+                    rows.append((f'{result.name}/{station}', age, alert, station in result.upper_bound_ages))
+        self.append(rows, time)
+
+    def append(self, rows: Sequence, time: datetime):
+        """Append (key, age in seconds, alert, whether the age is an upper bound) rows observed at `time`"""
+        if not rows:
+            return
+        timestamp = time.timestamp()
+        with self._file_lock(exclusive=True):
+            data = b''.join(
+                _RECORD.pack(timestamp, self._key_id(key), age, alert | (_UPPER_BOUND if upper_bound else 0))
+                for key, age, alert, upper_bound in rows
+            )
+            journal_path = self.path / _JOURNAL_NAME
+            with open(journal_path, 'ab') as f:
+                _drop_partial_record(f, journal_path)
+                f.write(data)
+                journal_size = f.tell()
+        if self.compact_threshold is not None and journal_size > self.compact_threshold * _RECORD.size:
+            try:
+                self.compact()
+            except ImportError:
+                logger.debug("numpy is not installed, the history journal is not compacted")
+
+    def _read_current(self) -> Dict:
+        try:
+            return json.loads((self.path / _CURRENT_NAME).read_text())
+        except FileNotFoundError:
+            return dict(generation=0, merged_journals=[])
+
+    def _journal_paths(self, current: Dict) -> List[Path]:
+        """Journals not yet merged into the columns, including journals left by an interrupted compaction"""
+        return sorted(
+            path for path in self.path.glob('journal*.bin')
+            if path.name not in current['merged_journals']
+        )
+
+    def _load_columns(self, current: Dict) -> Dict[str, 'np.ndarray']:
+        import numpy as np
+
+        if not current['generation']:
+            dtype = _record_dtype()
+            return {column: np.empty(0, dtype=dtype[column]) for column in _COLUMNS}
+        directory = self.path / f"columns-{current['generation']}"
+        return {column: np.load(directory / f'{column}.npy', mmap_mode='r') for column in _COLUMNS}
+
+    def _load_journal(self, path: Path) -> 'np.ndarray':
+        import numpy as np
+
+        size = path.stat().st_size
+        count = size // _RECORD.size
+        if not count:
+            return np.empty(0, dtype=_record_dtype())
+        return np.memmap(path, dtype=_record_dtype(), mode='r', shape=(count,))
+
+    def compact(self, retention: Optional[timedelta] = None):
+        """Merge the journal into new sorted column files and drop records older than `retention`"""
+        import numpy as np
+
+        with self._file_lock(exclusive=True):
+            current = self._read_current()
+            for name in current['merged_journals']:
+                (self.path / name).unlink(missing_ok=True)
+            current['merged_journals'] = []
+
+            generation = current['generation'] + 1
+            journal_path = self.path / _JOURNAL_NAME
+            if journal_path.exists():
+                with open(journal_path, 'ab') as f:
+                    _drop_partial_record(f, journal_path)
+                # Journals of an interrupted compaction may still exist with the same generation
+                sequence = 0
+                while (self.path / f'journal-{generation}-{sequence}.bin').exists():
+                    sequence += 1
+                journal_path.rename(self.path / f'journal-{generation}-{sequence}.bin')
+            journal_paths = self._journal_paths(current)
+            columns = self._load_columns(current)
+            journals = [self._load_journal(path) for path in journal_paths]
+            merged = {
+                column: np.concatenate([np.asarray(columns[column])] + [journal[column] for journal in journals])
+                for column in _COLUMNS
+            }
+            order = np.argsort(merged['time'], kind='stable')
+            if retention is not None:
+                cutoff = datetime.now(tz=timezone.utc).timestamp() - retention.total_seconds()
+                order = order[merged['time'][order] >= cutoff]
+
+            directory = self.path / f'columns-{generation}'
+            if directory.exists():
+                shutil.rmtree(directory)
+            directory.mkdir()
+            for column in _COLUMNS:
+                np.save(directory / f'{column}.npy', merged[column][order])
+            del columns, journals, merged
+
+            temporary_path = self.path / f'{_CURRENT_NAME}.tmp'
+            temporary_path.write_text(json.dumps(dict(
+                generation=generation,
+                merged_journals=[path.name for path in journal_paths],
+            )))
+            os.replace(temporary_path, self.path / _CURRENT_NAME)
+            for path in journal_paths:
+                path.unlink()
+            for old_directory in self.path.glob('columns-*'):
+                if old_directory != directory:
+                    shutil.rmtree(old_directory, ignore_errors=True)
+        logger.info(f"Compacted history to {len(order)} records")
+
+    def read(
+            self,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            key: Optional[str] = None,
+            columns: Sequence[str] = _READ_COLUMNS,
+    ) -> Dict[str, 'np.ndarray']:
+        """
+        Read the records in the time window for a single key or all keys.
+
+        Only the rows within the window are read from the memory mapped columns, located by binary search on the
+        sorted time column. Records still in the journal are appended. The boolean `upper_bound` column flags the ages
+        which are upper bounds of the true age.
+        """
+        import numpy as np
+
+        with self._file_lock(exclusive=False):
+            current = self._read_current()
+            stored = self._load_columns(current)
+            journals = [self._load_journal(path) for path in self._journal_paths(current)]
+        self._load_keys()
+        stored_columns = {column for column in columns if column != 'upper_bound'} | {'time', 'key'}
+        if 'upper_bound' in columns:
+            stored_columns.add('alert')
+        start = since.timestamp() if since is not None else -np.inf
+        end = until.timestamp() if until is not None else np.inf
+        first, last = np.searchsorted(stored['time'], [start, end], side='left')
+        parts = [{column: stored[column][first:last] for column in stored_columns}]
+        for journal in journals:
+            in_window = (journal['time'] >= start) & (journal['time'] < end)
+            parts.append({column: journal[column][in_window] for column in stored_columns})
+        result = {column: np.concatenate([part[column] for part in parts]) for column in stored_columns}
+        if 'alert' in result:
+            result['upper_bound'] = (result['alert'] & _UPPER_BOUND) > 0
+            result['alert'] = result['alert'] & ~np.uint8(_UPPER_BOUND)
+        if key is not None:
+            key_id = self._key_ids.get(key)
+            selected = result['key'] == key_id if key_id is not None else np.zeros(len(result['key']), dtype=bool)
+            result = {column: values[selected] for column, values in result.items()}
+        return {column: result[column] for column in columns}
+
+    def quantile(
+            self,
+            key: str,
+            q: float,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            exact_only: bool = False,
+    ) -> Optional[timedelta]:
+        """
+        Quantile `q` of the data age of `key` in the time window, e.g. `q=0.95` for the p95 age.
+
+        Ages which are upper bounds make the quantile an upper bound as well. With `exact_only` they are left out,
+        which leaves out most passing runs of checks that stop at the first fresh file.
+        """
+        import numpy as np
+
+        records = self.read(since=since, until=until, key=key, columns=['age', 'upper_bound'])
+        ages = records['age']
+        selected = ~np.isnan(ages)
+        if exact_only:
+            selected &= ~records['upper_bound']
+        ages = ages[selected]
+        if not len(ages):
+            return None
+        return timedelta(seconds=float(np.quantile(ages, q)))
+
+    def summary(
+            self,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            quantiles: Sequence[float] = (0.5, 0.95, 0.99),
+    ) -> 'pd.DataFrame':
+        """
+        Number of runs, alert fraction, fraction of ages which are upper bounds, age quantiles and maximum age in hours
+        per key
+        """
+        import pandas as pd
+
+        records = self.read(since=since, until=until, columns=['key', 'age', 'alert', 'upper_bound'])
+        df = pd.DataFrame(dict(
+            key=pd.Categorical.from_codes(records['key'].astype('int64'), categories=self.keys),
+            age=records['age'] / 3600,
+            alert=records['alert'] > 0,
+            upper_bound=records['upper_bound'],
+        ))
+        grouped = df.groupby('key', observed=True)
+        summary = grouped.agg(
+            runs=('alert', 'size'),
+            alert_fraction=('alert', 'mean'),
+            upper_bound_fraction=('upper_bound', 'mean'),
+        )
+        for q in quantiles:
+            summary[f'p{q * 100:g}_age_hours'] = grouped['age'].quantile(q)
+        summary['max_age_hours'] = grouped['age'].max()
+        return summary
+
+
+def _since(days: Optional[float]) -> Optional[datetime]:
+    return datetime.now(tz=timezone.utc) - timedelta(days=days) if days is not None else None
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = ArgumentParser(description="Query the freshness history of the checks")
+    parser.add_argument('path', type=Path, help='History directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    quantile_parser = subparsers.add_parser('quantile', help='Quantile of the data age of a check')
+    quantile_parser.add_argument('key', help='Check name, or check/station')
+    quantile_parser.add_argument('--q', type=float, default=0.95)
+    quantile_parser.add_argument('--days', type=float, default=30)
+    quantile_parser.add_argument('--exact-only', action='store_true', help='Leave out ages which are upper bounds')
+
+    summary_parser = subparsers.add_parser('summary', help='Age statistics of all checks')
+    summary_parser.add_argument('--days', type=float, default=30)
+    summary_parser.add_argument('--stations', action='store_true', help='Include per-station keys')
+
+    compact_parser = subparsers.add_parser('compact', help='Merge the journal and drop old records')
+    compact_parser.add_argument('--retention-days', type=float)
+
+    args = parser.parse_args(argv)
+    history = FreshnessHistory(args.path)
+    if args.command == 'quantile':
+        age = history.quantile(args.key, args.q, since=_since(args.days), exact_only=args.exact_only)
+        if age is None:
+            print(f"No ages recorded for {args.key} in the last {args.days:g} days")
+            sys.exit(1)
+        print(f"p{args.q * 100:g} age of {args.key} in the last {args.days:g} days: {age}")
+    elif args.command == 'summary':
+        summary = history.summary(since=_since(args.days))
+        if not args.stations:
+            summary = summary[~summary.index.astype(str).str.contains('/')]
+        print(summary.round(3).to_string())
+    elif args.command == 'compact':
+        retention = timedelta(days=args.retention_days) if args.retention_days is not None else None
+        history.compact(retention=retention)
+
+
+if __name__ == '__main__':
+    main()
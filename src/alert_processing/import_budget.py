@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Check the startup cost of check_alerts against a fixed budget.
+
+A fresh interpreter is started with `-X importtime` for each repetition. The check fails if the median cumulative
+import time of the module exceeds the budget or if any of the heavy reporting dependencies is imported on the core
+path.
+
+```bash
+python -m alert_processing.import_budget --budget-ms 300
+```
+"""
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from typing import Dict, List, Sequence
+
+import attr
+
+__all__ = [
+    'ImportTiming',
+    'measure_import_time',
+    'check_import_budget',
+]
+
+FORBIDDEN_MODULES = (
+    'pandas',
+    'numpy',
+    'xarray',
+)
+
+
+@attr.s(frozen=True)
+class ImportTiming:
+    cumulative_us: int = attr.ib()
+    modules: Dict[str, int] = attr.ib(repr=False)
+
+
+def measure_import_time(module: str) -> ImportTiming:
+    """Import `module` in a new interpreter and return the cumulative import time per module in microseconds"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return ImportTiming(cumulative_us=modules[module], modules=modules)
+
+
+def check_import_budget(
+        module: str,
+        budget_ms: float,
+        repeat: int = 5,
+        forbidden_modules: Sequence[str] = FORBIDDEN_MODULES,
+) -> List[str]:
+    """Return a list of violations of the import budget for `module`. An empty list means the budget is met."""
+    timings = [measure_import_time(module) for _ in range(repeat)]
+    median_ms = statistics.median(t.cumulative_us for t in timings) / 1000
+    print(f"Import time of {module}: {median_ms:.1f} ms (median of {repeat}), budget {budget_ms:.1f} ms")
+
+    violations = []
+    if median_ms > budget_ms:
+        violations.append(f"{module} imports in {median_ms:.1f} ms which exceeds the budget of {budget_ms:.1f} ms")
+    imported_forbidden = sorted(
+        {name.split('.')[0] for name in timings[0].modules}.intersection(forbidden_modules)
+    )
+    if imported_forbidden:
+        violations.append(f"{module} imports {', '.join(imported_forbidden)}")
+    return violations
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Check the import time of alert_processing against a budget")
+    parser.add_argument('--module', default='alert_processing.check_alerts')
+    parser.add_argument('--budget-ms', type=float, default=300.)
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    """Executed from the command line"""
+    args = parse_arguments()
+    violations = check_import_budget(args.module, budget_ms=args.budget_ms, repeat=args.repeat)
+    for violation in violations:
+        print(f"FAILED: {violation}")
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,316 @@
+"""
+Compact per-file manifests of the directory trees and the changes between consecutive runs.
+
+A manifest is a numpy structured array with a 64-bit hash of the path, the size and the modification time of every
+file below a directory, sorted by path hash and saved as a `.npy` file at the end of each run. The previous manifest
+is memory mapped when loaded, and the current files are matched to it with a binary search merge of the sorted
+hashes, which classifies every file as vanished, unchanged, modified or new without any per-file Python work. At 24
+bytes per file, the manifest of a tree of a million files is 24 MB.
+
+The previous manifest only contains hashes, so vanished files are counted but cannot be named. Reading and writing
+manifests need numpy from the `reporting` extra.
+"""
+import fnmatch
+import logging
+import os
+import re
+from array import array
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Union
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.file_system_status import scan_tree
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    import numpy as np
+
+__all__ = [
+    'manifest_dtype',
+    'ManifestSnapshot',
+    'ManifestDiff',
+    'ManifestChanges',
+    'ManifestStore',
+    'hash_paths',
+    'scan_manifest',
+    'diff_manifests',
+    'check_manifest_changes',
+]
+
+logger = logging.getLogger(__name__)
+
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def manifest_dtype():
+    import numpy as np
+
+    return np.dtype([('path_hash', '<u8'), ('size', '<i8'), ('mtime_ns', '<i8')])
+
+
+def hash_paths(paths: Sequence[str]) -> 'np.ndarray':
+    """
+    64-bit hash of each path, stable between runs and platforms.
+
+    The paths are packed into a fixed width byte array and hashed eight bytes at a time for all paths at once. Words
+    beyond the end of a path are skipped, so the hash of a path does not depend on the longest path of the call.
+    """
+    import numpy as np
+
+    if not len(paths):
+        return np.zeros(0, dtype=np.uint64)
+    with profiling.span('manifest_hash', paths=len(paths)):
+        width = max(map(len, paths), default=0)
+        try:
+            packed = np.array(paths, dtype=f'S{-(-width // 8) * 8}')
+        except UnicodeEncodeError:
+            encoded = [os.fsencode(path) for path in paths]
+            packed = np.array(encoded, dtype=f'S{-(-max(map(len, encoded)) // 8) * 8}')
+        words = packed.view('<u8').reshape(len(paths), -1)
+        hashes = np.zeros(len(paths), dtype=np.uint64)
+        mixed = np.empty_like(hashes)
+        shifted = np.empty_like(hashes)
+        multiplier = np.uint64(_HASH_MULTIPLIER)
+        for column in range(words.shape[1]):
+            word = words[:, column]
+            np.bitwise_xor(hashes, word, out=mixed)
+            np.multiply(mixed, multiplier, out=mixed)
+            np.right_shift(mixed, np.uint64(29), out=shifted)
+            np.bitwise_xor(mixed, shifted, out=mixed)
+            # Paths cannot contain null bytes, so only the padding after a path is a zero word
+            np.copyto(hashes, mixed, where=word != 0)
+        # Final avalanche of the murmur3 finalizer
+        hashes ^= hashes >> np.uint64(33)
+        hashes *= np.uint64(0xFF51AFD7ED558CCD)
+        hashes ^= hashes >> np.uint64(33)
+    return hashes
+
+
+@attr.s(frozen=True)
+class ManifestSnapshot:
+    # Structured array of path_hash, size and mtime_ns sorted by path_hash
+    entries: 'np.ndarray' = attr.ib()
+    # Paths in the order of the walk and the position in `paths` of each entry
+    paths: Sequence[str] = attr.ib()
+    path_positions: 'np.ndarray' = attr.ib()
+
+    def get_paths(self, positions: Sequence[int]) -> List[str]:
+        return [self.paths[i] for i in self.path_positions[positions]]
+
+
+@attr.s(frozen=True)
+class ManifestDiff:
+    """Positions of the entries of the previous (vanished) and the current snapshot (the others) in each class"""
+    vanished: 'np.ndarray' = attr.ib()
+    unchanged: 'np.ndarray' = attr.ib()
+    modified: 'np.ndarray' = attr.ib()
+    new: 'np.ndarray' = attr.ib()
+
+    def counts(self) -> Dict[str, int]:
+        return dict(
+            vanished=len(self.vanished),
+            unchanged=len(self.unchanged),
+            modified=len(self.modified),
+            new=len(self.new),
+        )
+
+
+def scan_manifest(dir_path: Path, skip_hidden: bool = True) -> ManifestSnapshot:
+    """Manifest of all files below `dir_path` in a single walk. Only the path, size and mtime of each file are kept."""
+    import numpy as np
+
+    paths: List[str] = []
+    sizes = array('q')
+    mtimes = array('q')
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_dir=True, skip_hidden=skip_hidden):
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            paths.append(entry.path)
+            sizes.append(stat_result.st_size)
+            mtimes.append(stat_result.st_mtime_ns)
+        walk_span.set(entries=len(paths))
+    registry.inc(
+        'aws_monitor_entries_scanned_total',
+        len(paths),
+        help='Directory entries visited while searching for the latest modification time',
+        path=os.fspath(dir_path),
+    )
+
+    entries = np.empty(len(paths), dtype=manifest_dtype())
+    entries['path_hash'] = hash_paths(paths)
+    entries['size'] = np.frombuffer(sizes, dtype=np.int64)
+    entries['mtime_ns'] = np.frombuffer(mtimes, dtype=np.int64)
+    order = np.argsort(entries['path_hash'])
+    return ManifestSnapshot(entries=entries.take(order), paths=paths, path_positions=order)
+
+
+def diff_manifests(previous: 'np.ndarray', current: 'np.ndarray') -> ManifestDiff:
+    """
+    Classify the entries of two manifests sorted by path hash.
+
+    Each current hash is located in the previous hashes with a binary search, which touches only the pages of a
+    memory mapped manifest that are needed. A file is unchanged if its size and modification time are equal.
+    """
+    import numpy as np
+
+    with profiling.span('manifest_diff', previous=len(previous), current=len(current)):
+        previous_hashes = previous['path_hash']
+        current_hashes = current['path_hash']
+        positions = np.searchsorted(previous_hashes, current_hashes)
+        if len(previous):
+            matched = previous_hashes[np.minimum(positions, len(previous) - 1)] == current_hashes
+        else:
+            matched = np.zeros(len(current), dtype=bool)
+        current_matched = np.flatnonzero(matched)
+        previous_matched = positions[matched]
+        same = (
+                (previous['size'][previous_matched] == current['size'][current_matched])
+                & (previous['mtime_ns'][previous_matched] == current['mtime_ns'][current_matched])
+        )
+        kept = np.zeros(len(previous), dtype=bool)
+        kept[previous_matched] = True
+        return ManifestDiff(
+            vanished=np.flatnonzero(~kept),
+            unchanged=current_matched[same],
+            modified=current_matched[~same],
+            new=np.flatnonzero(~matched),
+        )
+
+
+@attr.s
+class ManifestStore:
+    """One manifest file per directory tree in `path`"""
+    path: Path = attr.ib(converter=Path)
+
+    def __attrs_post_init__(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get_manifest_path(self, dir_path: Path) -> Path:
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.fspath(dir_path).strip(os.sep)) or 'root'
+        return self.path / f'{name}.npy'
+
+    def load(self, dir_path: Path) -> Optional['np.ndarray']:
+        """Memory mapped manifest of the previous run, None if there is none"""
+        import numpy as np
+
+        manifest_path = self.get_manifest_path(dir_path)
+        try:
+            entries = np.load(manifest_path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # An empty tree gives an array without data, which cannot be mapped
+            try:
+                entries = np.load(manifest_path)
+            except ValueError:
+                logger.warning(f"Ignoring invalid manifest {manifest_path}")
+                return None
+        if entries.dtype != manifest_dtype():
+            logger.warning(f"Ignoring manifest {manifest_path} with dtype {entries.dtype}")
+            return None
+        return entries
+
+    def get_time(self, dir_path: Path) -> Optional[datetime]:
+        try:
+            mtime = self.get_manifest_path(dir_path).stat().st_mtime
+        except FileNotFoundError:
+            return None
+        return datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+    def save(self, dir_path: Path, entries: 'np.ndarray'):
+        import numpy as np
+
+        manifest_path = self.get_manifest_path(dir_path)
+        temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with profiling.span('manifest_save', entries=len(entries)):
+            with open(temporary_path, 'wb') as manifest_file:
+                np.save(manifest_file, entries)
+            # A mapping of the previous manifest stays valid, it keeps the replaced file open
+            os.replace(temporary_path, manifest_path)
+
+
+@attr.s(frozen=True)
+class ManifestChanges:
+    dir_path: Path = attr.ib()
+    counts: Dict[str, int] = attr.ib()
+    # Time of the previous manifest, None on the first run
+    previous_time: Optional[datetime] = attr.ib()
+    # Paths of the watched files which did not change since the previous run and are older than the maximum age
+    stopped_paths: List[str] = attr.ib(factory=list)
+
+
+def check_manifest_changes(
+        dir_path: Path,
+        store: ManifestStore,
+        current_time: datetime,
+        max_age: timedelta,
+        pattern: Optional[Union[str, Sequence[str]]] = None,
+) -> ManifestChanges:
+    '''Compare the files in dir_path to the manifest of the previous run
+    and replace the manifest with the current files.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Directory path to dir containing files or station sub-directories and files
+    store : ManifestStore
+        Storage of the manifests between runs
+    current_time : datetime
+        Current datetime used for determine file age
+    max_age : timedelta
+        Maximum allowed age of a watched file which did not change since the previous run
+    pattern : str or Sequence[str], optional
+        Glob pattern(s) of the names of the watched files, which are expected to be updated on every run.
+        No file is watched if not provided.
+
+    Returns
+    -------
+    changes : ManifestChanges
+        Number of vanished, unchanged, modified and new files and the paths of the watched files
+        which stopped updating, oldest first
+    '''
+    import numpy as np
+
+    current = scan_manifest(dir_path)
+    previous = store.load(dir_path)
+    previous_time = store.get_time(dir_path) if previous is not None else None
+    stopped_paths = []
+    if previous is None:
+        logger.info(f"No previous manifest of {dir_path}")
+        counts = dict(vanished=0, unchanged=0, modified=0, new=len(current.entries))
+    else:
+        diff = diff_manifests(previous, current.entries)
+        counts = diff.counts()
+        patterns = [pattern] if isinstance(pattern, str) else list(pattern or [])
+        if patterns and len(diff.unchanged):
+            name_pattern = re.compile('|'.join(fnmatch.translate(name) for name in patterns))
+            threshold = np.int64((current_time - max_age).timestamp() * 1e9)
+            old = diff.unchanged[current.entries['mtime_ns'][diff.unchanged] < threshold]
+            old = old[np.argsort(current.entries['mtime_ns'][old], kind='stable')]
+            stopped_paths = [
+                path for path in current.get_paths(old)
+                if name_pattern.match(os.path.basename(path))
+            ]
+    del previous
+    store.save(dir_path, current.entries)
+
+    for change, count in counts.items():
+        registry.set_gauge(
+            'aws_monitor_manifest_files',
+            count,
+            help='Files per change since the previous manifest',
+            path=os.fspath(dir_path),
+            change=change,
+        )
+    return ManifestChanges(
+        dir_path=dir_path,
+        counts=counts,
+        previous_time=previous_time,
+        stopped_paths=stopped_paths,
+    )
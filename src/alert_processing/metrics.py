@@ -0,0 +1,186 @@
+"""
+Metrics of the checks in the Prometheus text exposition format.
+
+The module level `registry` is updated by the checks and can be written as a node-exporter textfile or served over
+HTTP in daemon mode. Updates are a dictionary operation under a lock and are made once per check or scan, never per
+file.
+"""
+import logging
+import math
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+import attr
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+__all__ = [
+    'MetricsRegistry',
+    'registry',
+    'write_textfile',
+    'start_http_server',
+]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300.)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: LabelKey, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+@attr.s
+class _Histogram:
+    buckets: Tuple[float, ...] = attr.ib()
+    counts: List[int] = attr.ib()
+    total: float = attr.ib(default=0.)
+    count: int = attr.ib(default=0)
+
+    def observe(self, value: float):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+@attr.s
+class _Metric:
+    kind: str = attr.ib()
+    help: str = attr.ib()
+    samples: Dict[LabelKey, object] = attr.ib(factory=dict)
+
+
+@attr.s
+class MetricsRegistry:
+    _metrics: Dict[str, _Metric] = attr.ib(init=False, factory=dict)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def _get(self, name: str, kind: str, help: str) -> _Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = _Metric(kind=kind, help=help)
+        elif metric.kind != kind:
+            raise ValueError(f"Metric {name} is a {metric.kind}, not a {kind}")
+        return metric
+
+    def set_gauge(self, name: str, value: float, help: str = '', **labels: str):
+        with self._lock:
+            self._get(name, 'gauge', help).samples[tuple(sorted(labels.items()))] = float(value)
+
+    def inc(self, name: str, value: float = 1, help: str = '', **labels: str):
+        with self._lock:
+            samples = self._get(name, 'counter', help).samples
+            key = tuple(sorted(labels.items()))
+            samples[key] = samples.get(key, 0.) + value
+
+    def observe(
+            self,
+            name: str,
+            value: float,
+            help: str = '',
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+            **labels: str,
+    ):
+        with self._lock:
+            samples = self._get(name, 'histogram', help).samples
+            key = tuple(sorted(labels.items()))
+            histogram = samples.get(key)
+            if histogram is None:
+                bounds = tuple(sorted(buckets)) + (math.inf,)
+                histogram = samples[key] = _Histogram(buckets=bounds, counts=[0] * len(bounds))
+            histogram.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                if metric.help:
+                    lines.append(f'# HELP {name} {metric.help}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+                for labels, sample in sorted(metric.samples.items()):
+                    if metric.kind == 'histogram':
+                        base_name = name
+                        for upper_bound, count in zip(sample.buckets, sample.counts):
+                            bucket_labels = _format_labels(labels, [('le', _format_value(upper_bound))])
+                            lines.append(f'{base_name}_bucket{bucket_labels} {count}')
+                        lines.append(f'{base_name}_sum{_format_labels(labels)} {_format_value(sample.total)}')
+                        lines.append(f'{base_name}_count{_format_labels(labels)} {sample.count}')
+                    else:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def write_textfile(path: Path, metrics_registry: Optional[MetricsRegistry] = None):
+    """Write the metrics atomically for the node-exporter textfile collector"""
+    path = Path(path)
+    content = (metrics_registry or registry).render()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(file_descriptor, 'w') as f:
+            f.write(content)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def start_http_server(
+        port: int,
+        host: str = '',
+        metrics_registry: Optional[MetricsRegistry] = None,
+) -> 'ThreadingHTTPServer':
+    """Serve the metrics at /metrics from a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    metrics_registry = metrics_registry or registry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            content = metrics_registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
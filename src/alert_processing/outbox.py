@@ -0,0 +1,319 @@
+"""
+Durable outbox for notifications.
+
+Notifications are appended to a journal file and fsynced before they are delivered, so a slow or unreachable SMTP
+server never blocks the checks and no notification is lost when the process crashes or is restarted. The journal is
+a JSON line per event (`add`, `sent` or `retry`) and is replayed on every read, so several processes can share it.
+A truncated last line from a crash during a write is ignored. The journal is rewritten with only the pending messages
+once it is mostly delivered messages.
+
+The `OutboxDeliveryWorker` sends the pending messages through the wrapped client, in a background thread in daemon
+mode or once per run otherwise. Failed deliveries are retried with exponential backoff and jitter, and the number of
+messages sent is limited by a token bucket. Delivery is at least once: a batch that fails halfway is retried as a
+whole.
+"""
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    from alert_processing.email_notification import NotificationClient
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+__all__ = [
+    'OutboxMessage',
+    'Outbox',
+    'OutboxDeliveryWorker',
+]
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class OutboxMessage:
+    id: str = attr.ib()
+    subject_text: str = attr.ib()
+    body_text: str = attr.ib()
+    created_at: float = attr.ib()
+    attempts: int = attr.ib(default=0)
+    next_attempt_at: float = attr.ib(default=0.)
+
+
+@attr.s
+class Outbox:
+    """Append-only journal of the notifications at `path`"""
+    path: Path = attr.ib(converter=Path)
+    # Rewrite the journal when it has this many more lines than pending messages
+    compact_threshold: int = attr.ib(default=200)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _open(self) -> Iterator:
+        """Open the journal for reading and appending with an exclusive lock"""
+        with self._lock:
+            while True:
+                journal = open(self.path, 'a+', encoding='utf-8')
+                if fcntl is not None:
+                    fcntl.flock(journal, fcntl.LOCK_EX)
+                # The journal may have been replaced by a compaction while waiting for the lock
+                if os.path.exists(self.path) and os.path.samestat(os.fstat(journal.fileno()), os.stat(self.path)):
+                    break
+                journal.close()
+            with journal:
+                journal.seek(0)
+                yield journal
+
+    def _replay(self, journal) -> Tuple[Dict[str, OutboxMessage], int, int]:
+        """Pending messages, number of lines and number of invalid lines of the journal"""
+        pending: Dict[str, OutboxMessage] = dict()
+        line_count = 0
+        invalid_count = 0
+        for line in journal:
+            line_count += 1
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+                if event['event'] == 'add':
+                    pending[event['id']] = OutboxMessage(
+                        id=event['id'],
+                        subject_text=event['subject'],
+                        body_text=event['body'],
+                        created_at=event['created'],
+                    )
+                elif event['event'] == 'sent':
+                    pending.pop(event['id'], None)
+                elif event['event'] == 'retry' and event['id'] in pending:
+                    pending[event['id']] = attr.evolve(
+                        pending[event['id']],
+                        attempts=event['attempts'],
+                        next_attempt_at=event['next'],
+                    )
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Ignoring invalid line {line_count} of {self.path}")
+                invalid_count += 1
+        return pending, line_count, invalid_count
+
+    @staticmethod
+    def _append(journal, events: Sequence[Dict]):
+        size = os.fstat(journal.fileno()).st_size
+        # Start a new line after a line truncated by a crash, so that only the truncated event is lost
+        separator = '\n' if size and os.pread(journal.fileno(), 1, size - 1) != b'\n' else ''
+        journal.write(separator + ''.join(json.dumps(event) + '\n' for event in events))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def put(self, messages: Sequence[Tuple[str, str]]) -> List[str]:
+        """Append (subject_text, body_text) messages and return their ids once they are on disk"""
+        created_at = time.time()
+        events = [
+            dict(event='add', id=uuid.uuid4().hex, subject=subject_text, body=body_text, created=created_at)
+            for subject_text, body_text in messages
+        ]
+        if events:
+            with self._open() as journal:
+                journal.seek(0, os.SEEK_END)
+                self._append(journal, events)
+        return [event['id'] for event in events]
+
+    def get_pending(self) -> List[OutboxMessage]:
+        """Messages not delivered yet, oldest first"""
+        with self._open() as journal:
+            pending, _, _ = self._replay(journal)
+        return sorted(pending.values(), key=lambda message: message.created_at)
+
+    def mark_sent(self, ids: Sequence[str]):
+        self._update([dict(event='sent', id=message_id) for message_id in ids])
+
+    def mark_failed(self, messages: Sequence[OutboxMessage], next_attempt_at: float):
+        """Record a failed attempt of each message and the unix time of the next attempt"""
+        self._update([
+            dict(event='retry', id=message.id, attempts=message.attempts + 1, next=next_attempt_at)
+            for message in messages
+        ])
+
+    def _update(self, events: Sequence[Dict]):
+        if not events:
+            return
+        with self._open() as journal:
+            pending, line_count, invalid_count = self._replay(journal)
+            self._append(journal, events)
+            if invalid_count or line_count + len(events) - len(pending) > self.compact_threshold:
+                self._compact(journal)
+
+    def _compact(self, journal):
+        journal.seek(0)
+        pending, _, _ = self._replay(journal)
+        events = []
+        for message in sorted(pending.values(), key=lambda message: message.created_at):
+            events.append(dict(
+                event='add',
+                id=message.id,
+                subject=message.subject_text,
+                body=message.body_text,
+                created=message.created_at,
+            ))
+            if message.attempts:
+                events.append(dict(
+                    event='retry',
+                    id=message.id,
+                    attempts=message.attempts,
+                    next=message.next_attempt_at,
+                ))
+        temporary_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary_path, 'w', encoding='utf-8') as compacted:
+            self._append(compacted, events)
+        # Other processes wait for the lock of the old file, then reopen the path
+        os.replace(temporary_path, self.path)
+        logger.debug(f"Compacted {self.path} to {len(pending)} pending messages")
+
+
+@attr.s
+class OutboxDeliveryWorker:
+    """
+    Deliver the messages of `outbox` through `client`. Nothing is delivered while `client` is None.
+
+    After a failed delivery nothing is sent until a delay drawn uniformly between half and all of `min_retry_delay`,
+    doubled for every consecutive failure up to `max_retry_delay`. Once a delivery succeeds again, the messages
+    waiting for a retry are sent right away. At most `max_per_hour` messages are sent per hour, in bursts of up to
+    `max_batch` messages over one connection.
+    """
+    outbox: Outbox = attr.ib()
+    client: Optional['NotificationClient'] = attr.ib(default=None)
+    min_retry_delay: timedelta = attr.ib(default=timedelta(minutes=1))
+    max_retry_delay: timedelta = attr.ib(default=timedelta(hours=1))
+    max_per_hour: Optional[float] = attr.ib(default=20)
+    max_batch: int = attr.ib(default=10)
+    _tokens: float = attr.ib(init=False, default=None)
+    _refilled_at: float = attr.ib(init=False, factory=time.monotonic)
+    _failures: int = attr.ib(init=False, default=0)
+    # Unix time before which no delivery is attempted after a failure
+    _retry_at: float = attr.ib(init=False, default=0.)
+    _delivery_lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+    _wake_event: threading.Event = attr.ib(init=False, repr=False, factory=threading.Event)
+    _stop_requested: bool = attr.ib(init=False, default=False)
+    _thread: Optional[threading.Thread] = attr.ib(init=False, repr=False, default=None)
+
+    def __attrs_post_init__(self):
+        self._tokens = self.max_per_hour if self.max_per_hour else math.inf
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.max_per_hour:
+            self._tokens = min(self.max_per_hour, self._tokens + (now - self._refilled_at) * self.max_per_hour / 3600)
+        self._refilled_at = now
+
+    def _retry_delay(self, failures: int) -> float:
+        delay = min(
+            self.min_retry_delay.total_seconds() * 2 ** min(failures - 1, 32),
+            self.max_retry_delay.total_seconds(),
+        )
+        return random.uniform(delay / 2, delay)
+
+    def deliver_pending(self) -> float:
+        """
+        Send the messages that are due and return the seconds until the next message is due, inf if none is pending.
+        """
+        if self.client is None:
+            return math.inf
+        with self._delivery_lock, profiling.span('outbox_delivery') as delivery_span:
+            sent_count = 0
+            failed_count = 0
+            while time.time() >= self._retry_at:
+                pending = self.outbox.get_pending()
+                now = time.time()
+                due = pending if sent_count else [message for message in pending if message.next_attempt_at <= now]
+                self._refill()
+                batch = due[:int(min(self.max_batch, self._tokens))]
+                if not batch:
+                    break
+                try:
+                    self.client.send_alert_emails([(message.subject_text, message.body_text) for message in batch])
+                except Exception as e:
+                    self._failures += 1
+                    self._retry_at = now + self._retry_delay(self._failures)
+                    logger.warning(
+                        f"Delivery of {len(batch)} notification(s) failed, retrying in {self._retry_at - now:.0f} s: "
+                        f"{e!r}"
+                    )
+                    self.outbox.mark_failed(batch, self._retry_at)
+                    failed_count += len(batch)
+                    registry.inc(
+                        'aws_monitor_outbox_failures_total',
+                        len(batch),
+                        help='Failed notification delivery attempts',
+                    )
+                    break
+                self._failures = 0
+                self._tokens -= len(batch)
+                self.outbox.mark_sent([message.id for message in batch])
+                sent_count += len(batch)
+                registry.inc('aws_monitor_outbox_delivered_total', len(batch), help='Notifications delivered')
+
+            pending = self.outbox.get_pending()
+            registry.set_gauge('aws_monitor_outbox_pending', len(pending), help='Notifications waiting for delivery')
+            delivery_span.set(sent=sent_count, failed=failed_count, pending=len(pending))
+            if not pending:
+                return math.inf
+            now = time.time()
+            wait = max(min(message.next_attempt_at for message in pending), self._retry_at) - now
+            wait = max(wait, 0.)
+            if self.max_per_hour and self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) * 3600 / self.max_per_hour)
+            logger.info(
+                f"{len(pending)} notification(s) pending, oldest from {time.ctime(pending[0].created_at)} "
+                f"after {pending[0].attempts} attempt(s)"
+            )
+            return wait
+
+    def wake(self):
+        """Deliver pending messages now in the background thread"""
+        self._wake_event.set()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop_requested = False
+        self._thread = threading.Thread(target=self._run, name='outbox-delivery', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: Optional[float] = None):
+        """Stop the background thread. Pending messages stay in the outbox."""
+        self._stop_requested = True
+        self._wake_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_requested:
+            self._wake_event.clear()
+            try:
+                wait = self.deliver_pending()
+            except Exception:
+                logger.exception("Unable to deliver notifications from the outbox")
+                wait = self.min_retry_delay.total_seconds()
+            self._wake_event.wait(None if math.isinf(wait) else wait)
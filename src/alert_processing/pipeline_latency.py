@@ -0,0 +1,232 @@
+"""
+Per-station latency through the pipeline stages: l0 commit, l3 tx, l3 level_3, BUFR_out and the DMI upload.
+
+Each stage is read with a single batched operation regardless of the number of stations: one git history walk for
+the station directories of aws-l0/tx, one scan of each l3 tree and of BUFR_out, and one listing of the DMI ftp
+directory. The times are joined into a station x stage matrix and the stage where the data of each station stops is
+found in one vectorised pass.
+
+The DMI upload directory only contains concatenated files, so its time is the newest upload for all stations. A
+station without data in a stage, e.g. a station that is not exported to BUFR, is not evaluated for that and the
+following stages.
+"""
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Sequence
+
+from alert_processing import profiling
+from alert_processing.dmi_bufr import parse_filename_datetime
+from alert_processing.file_system_status import get_station_modified_time, scan_tree
+from alert_processing.git_repositories import CommitTimeCache
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from alert_processing.sharded_scan import ShardedScanner
+
+__all__ = [
+    'STAGES',
+    'DEFAULT_BUFR_STATION_PATTERN',
+    'get_bufr_station_times',
+    'get_l0_station_times',
+    'collect_stage_times',
+    'compute_latency_matrix',
+    'check_pipeline_latency',
+]
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('l0_tx', 'l3_tx', 'l3_joined', 'bufr_out', 'dmi')
+DEFAULT_BUFR_STATION_PATTERN = r'(?P<station>.+)\.bufr$'
+
+
+def get_l0_station_times(
+        repository_path: Path,
+        commit_time_cache: Optional[CommitTimeCache] = None,
+) -> Dict[str, Optional[datetime]]:
+    """Last commit time of each station sub-directory of aws-l0/tx in a single history walk"""
+    commit_time_cache = commit_time_cache or CommitTimeCache(repository_path)
+    with os.scandir(repository_path) as iterator:
+        stations = [
+            entry.name for entry in iterator
+            if entry.name[0] != '.' and entry.is_dir(follow_symlinks=False)
+        ]
+    return commit_time_cache.get_last_commit_datetimes(stations)
+
+
+def get_bufr_station_times(
+        dir_path: Path,
+        station_pattern: str = DEFAULT_BUFR_STATION_PATTERN,
+) -> Dict[str, datetime]:
+    """
+    Latest modification time of the individual station BUFR files in BUFR_out in a single scan.
+
+    The station is the first sub-directory, or the `station` group of `station_pattern` for files directly in
+    dir_path. Concatenated files such as geus_20230117T1303.bufr are skipped.
+    """
+    pattern = re.compile(station_pattern)
+    root = os.fspath(dir_path).rstrip(os.sep) + os.sep
+    station_mtimes: Dict[str, float] = dict()
+    for entry in scan_tree(dir_path, skip_dir=True):
+        station, separator, _ = entry.path[len(root):].partition(os.sep)
+        if not separator:
+            match = pattern.search(entry.name)
+            if match is None or parse_filename_datetime(entry.name) is not None:
+                continue
+            station = match.group('station')
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if mtime > station_mtimes.get(station, float('-inf')):
+            station_mtimes[station] = mtime
+    return {
+        station: datetime.fromtimestamp(mtime, tz=timezone.utc)
+        for station, mtime in station_mtimes.items()
+    }
+
+
+def collect_stage_times(
+        l0_tx_path: Optional[Path] = None,
+        l3_tx_path: Optional[Path] = None,
+        l3_joined_path: Optional[Path] = None,
+        bufr_out_path: Optional[Path] = None,
+        dmi_time: Optional[datetime] = None,
+        commit_time_cache: Optional[CommitTimeCache] = None,
+        bufr_station_pattern: str = DEFAULT_BUFR_STATION_PATTERN,
+        scanner: Optional['ShardedScanner'] = None,
+) -> 'pd.DataFrame':
+    """
+    Newest data time of each station in each configured stage. The l3 trees are scanned with `scanner` if provided.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by station with a UTC datetime column per configured stage in pipeline order. NaT where a station has
+        no data in a stage.
+    """
+    import pandas as pd
+
+    scan_stations = scanner.get_station_modified_time if scanner is not None else get_station_modified_time
+    columns = dict()
+    with profiling.span('stage_times') as stage_span:
+        if l0_tx_path:
+            columns['l0_tx'] = pd.Series(get_l0_station_times(l0_tx_path, commit_time_cache), dtype=object)
+        if l3_tx_path:
+            columns['l3_tx'] = scan_stations(l3_tx_path)['modified_datetime']
+        if l3_joined_path:
+            columns['l3_joined'] = scan_stations(l3_joined_path)['modified_datetime']
+        if bufr_out_path:
+            columns['bufr_out'] = pd.Series(
+                get_bufr_station_times(bufr_out_path, bufr_station_pattern),
+                dtype=object,
+            )
+        stage_times = pd.DataFrame({
+            stage: pd.to_datetime(series, utc=True)
+            for stage, series in columns.items()
+        })
+        if dmi_time is not None:
+            stage_times['dmi'] = pd.Timestamp(dmi_time)
+        stage_times.index.name = 'station'
+        stage_span.set(stations=len(stage_times), stages=len(stage_times.columns))
+    return stage_times.sort_index()
+
+
+def compute_latency_matrix(
+        stage_times: 'pd.DataFrame',
+        current_time: datetime,
+        max_stage_lag: timedelta,
+        max_source_age: Optional[timedelta] = None,
+) -> 'pd.DataFrame':
+    """
+    Age of the data of each station in each stage and the stage where the data stops.
+
+    The data of a station stops at a stage if the previous stage has data more than `max_stage_lag` newer, or at the
+    first stage if its data is older than `max_source_age`. Stages are evaluated up to the first stage without data.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by station with the age per stage, `stuck_stage` with the first stage the newest data did not reach
+        and `stage_lag` with the lag at that stage
+    """
+    import numpy as np
+    import pandas as pd
+
+    stages = [stage for stage in STAGES if stage in stage_times.columns]
+    with profiling.span('latency_matrix', stations=len(stage_times), stages=len(stages)):
+        # Seconds since the epoch with NaN for missing data
+        values = stage_times[stages].to_numpy(dtype='datetime64[ns]').reshape(len(stage_times), len(stages))
+        present = ~np.isnat(values)
+        times = np.where(present, values.astype('int64') / 1e9, np.nan)
+        # Stages after the first missing stage are not evaluated
+        evaluated = np.logical_and.accumulate(present, axis=1)
+
+        stuck = np.zeros_like(present)
+        lags = np.full(times.shape, np.nan)
+        if stages and max_source_age is not None:
+            source_age = current_time.timestamp() - times[:, 0]
+            stuck[:, 0] = evaluated[:, 0] & (source_age > max_source_age.total_seconds())
+            lags[:, 0] = source_age
+        if len(stages) > 1:
+            lags[:, 1:] = times[:, :-1] - times[:, 1:]
+            stuck[:, 1:] = evaluated[:, 1:] & (lags[:, 1:] > max_stage_lag.total_seconds())
+
+        # An extra column which is True where no stage is stuck, so that argmax points to a stuck_stage of None
+        stuck = np.column_stack([stuck, ~stuck.any(axis=1)])
+        lags = np.column_stack([lags, np.full(len(lags), np.nan)])
+        first_stuck = stuck.argmax(axis=1)
+        stuck_stage = np.array([*stages, None], dtype=object)[first_stuck]
+        stage_lag = lags[np.arange(len(lags)), first_stuck]
+
+        ages = pd.DataFrame(
+            {stage: current_time - stage_times[stage] for stage in stages},
+            index=stage_times.index,
+        )
+        ages['stuck_stage'] = stuck_stage
+        ages['stage_lag'] = pd.to_timedelta(stage_lag, unit='s')
+    return ages
+
+
+def check_pipeline_latency(
+        current_time: datetime,
+        max_stage_lag: timedelta,
+        max_source_age: Optional[timedelta] = None,
+        stations: Optional[Sequence[str]] = None,
+        **stage_settings,
+) -> 'pd.DataFrame':
+    '''Build the station x stage latency matrix
+    and return the stations whose data stops at one of the stages.
+
+    Parameters
+    ----------
+    current_time : datetime
+        Current datetime used for determine data age
+    max_stage_lag : timedelta
+        Maximum allowed time between the newest data of consecutive stages
+    max_source_age : timedelta, optional
+        Maximum allowed age of the newest data in the first stage
+    stations : Sequence[str], optional
+        Stations to report. All stations found in any stage are reported if not provided.
+    stage_settings
+        Paths and DMI time passed to `collect_stage_times`
+
+    Returns
+    -------
+    stuck_stations : pd.DataFrame
+        Rows of the latency matrix of the stations whose data stops, ordered by stage and lag
+    '''
+    stage_times = collect_stage_times(**stage_settings)
+    if stations is not None:
+        stage_times = stage_times.reindex(list(stations))
+    latency = compute_latency_matrix(stage_times, current_time, max_stage_lag, max_source_age)
+    stuck = latency[latency['stuck_stage'].notna()]
+    stage_order = {stage: i for i, stage in enumerate(STAGES)}
+    return stuck.sort_values(
+        ['stuck_stage', 'stage_lag'],
+        ascending=[True, False],
+        key=lambda column: column.map(stage_order) if column.name == 'stuck_stage' else column,
+    )
@@ -0,0 +1,173 @@
+"""
+Timing spans and cProfile collection enabled with `check_alerts --profile`.
+
+Spans are emitted as one JSON log record each on the `alert_processing.profiling` logger when they finish, also
+available to handlers as the `span` attribute of the record. While profiling is disabled, `span` returns a shared
+no-op context manager and nothing is timed or logged.
+
+cProfile only observes the thread it is enabled in, so every check thread is profiled separately with
+`profile_thread` and the profiles are merged when they are dumped.
+"""
+import cProfile
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+__all__ = [
+    'enable',
+    'disable',
+    'is_enabled',
+    'span',
+    'profile_thread',
+    'dump_stats',
+]
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_profile_directory: Optional[Path] = None
+_profiles: List[cProfile.Profile] = []
+_profiles_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'attributes', 'parent', 'start_time', 'start_datetime')
+
+    def __init__(self, name: str, attributes: Dict):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.start_datetime = datetime.now(tz=timezone.utc)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start_time
+        _stack().pop()
+        record = dict(
+            span=self.name,
+            parent=self.parent.full_name if self.parent is not None else None,
+            start=self.start_datetime.isoformat(),
+            duration_ms=round(duration * 1e3, 3),
+            thread=threading.current_thread().name,
+            **self.attributes,
+        )
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        logger.info(json.dumps(record, default=str), extra=dict(span=record))
+        return False
+
+    @property
+    def full_name(self) -> str:
+        """Names of this and the enclosing spans in the same thread, outermost first"""
+        return f'{self.parent.full_name}/{self.name}' if self.parent is not None else self.name
+
+    def set(self, **attributes):
+        """Add attributes known only after the span started, such as counts"""
+        self.attributes.update(attributes)
+
+
+def _stack() -> List[_Span]:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enable(profile_directory: Optional[Path] = None):
+    """
+    Enable the timing spans. With `profile_directory`, cProfile statistics of every check thread are collected and
+    written there by `dump_stats`.
+    """
+    global _enabled, _profile_directory
+    _enabled = True
+    _profile_directory = Path(profile_directory) if profile_directory is not None else None
+    if logger.getEffectiveLevel() > logging.INFO:
+        logger.setLevel(logging.INFO)
+
+
+def disable():
+    global _enabled, _profile_directory
+    _enabled = False
+    _profile_directory = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **attributes):
+    """
+    Time the enclosed block. Use `set` on the returned span to add attributes known only at the end of the block.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, attributes)
+
+
+@contextmanager
+def profile_thread() -> Iterator[None]:
+    """Collect cProfile statistics of the enclosed block in the current thread if enabled"""
+    if _profile_directory is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler is active, e.g. the interpreter does not support concurrent profilers
+        logger.debug("Unable to profile thread", exc_info=True)
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        with _profiles_lock:
+            _profiles.append(profile)
+
+
+def dump_stats() -> Optional[Path]:
+    """Merge the collected profiles into a new pstats file in the profile directory and reset the collection"""
+    import pstats
+
+    with _profiles_lock:
+        profiles = _profiles[:]
+        _profiles.clear()
+    if not profiles or _profile_directory is None:
+        return None
+    _profile_directory.mkdir(parents=True, exist_ok=True)
+    path = _profile_directory / datetime.now(tz=timezone.utc).strftime('check_alerts_%Y%m%dT%H%M%S.pstats')
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.dump_stats(path)
+    logger.info(f"cProfile statistics written to {path}")
+    return path
@@ -0,0 +1,406 @@
+"""
+Monitoring of data on other machines through compact summaries.
+
+An agent (`check_alerts --agent`) scans the local paths of its configuration and sends a summary to the aggregator:
+the newest modification time and file count of each path and of each station sub-directory, and the last commit
+times of git repositories. The summary does not contain any file lists, so its size depends on the number of
+paths and stations only.
+
+The aggregator runs in the daemon, keeps the latest summary of every agent and evaluates the thresholds in its own
+configuration with one `remote_<agent>` check per agent. An agent that stops sending summaries is reported as well.
+"""
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.check_runner import report_data_age
+from alert_processing.file_system_status import scan_tree
+from alert_processing.git_repositories import CommitTimeCache
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+__all__ = [
+    'PathSummary',
+    'summarize_tree',
+    'summarize_repository',
+    'build_summary',
+    'send_summary',
+    'default_agent_name',
+    'SummaryStore',
+    'SummaryReceiver',
+    'check_remote_summary',
+]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9480
+_AGENT_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]{0,63}')
+# Upper bound of an accepted summary. A summary of a few hundred stations is in the order of 50 kB
+_MAX_SUMMARY_BYTES = 1 << 20
+
+
+@attr.s
+class PathSummary:
+    kind: str = attr.ib()
+    # Newest modification or commit time as POSIX timestamp, None if nothing was found
+    latest: Optional[float] = attr.ib(default=None)
+    # Number of files, None for git repositories
+    count: Optional[int] = attr.ib(default=None)
+    # (latest, count) per station sub-directory
+    stations: Dict[str, Tuple[Optional[float], Optional[int]]] = attr.ib(factory=dict)
+    error: Optional[str] = attr.ib(default=None)
+
+    def to_json(self) -> Dict:
+        return attr.asdict(self, filter=lambda attribute, value: value is not None)
+
+    @classmethod
+    def from_json(cls, value: Mapping) -> 'PathSummary':
+        return cls(
+            kind=value['kind'],
+            latest=value.get('latest'),
+            count=value.get('count'),
+            stations={station: tuple(entry) for station, entry in value.get('stations', {}).items()},
+            error=value.get('error'),
+        )
+
+
+def summarize_tree(dir_path: Path, skip_hidden: bool = True) -> PathSummary:
+    """
+    Newest modification time and file count of the tree below `dir_path` and of each station sub-directory, in a
+    single scan. The newest time of the path includes directories like `get_latest_modified_time`, the station times
+    only files like `get_station_modified_time`.
+    """
+    if not os.path.isdir(dir_path):
+        return PathSummary(kind='tree', error=f'Directory does not exist: {dir_path}')
+    root = os.fspath(dir_path).rstrip(os.sep) + os.sep
+    latest = None
+    count = 0
+    stations: Dict[str, List] = dict()
+    with profiling.span('walk', path=os.fspath(dir_path)) as walk_span:
+        for entry in scan_tree(dir_path, skip_hidden=skip_hidden):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            if latest is None or mtime > latest:
+                latest = mtime
+            station, separator, _ = entry.path[len(root):].partition(os.sep)
+            if not separator:
+                # Station directories themselves and files located directly in dir_path
+                if is_dir:
+                    stations.setdefault(station, [None, 0])
+                else:
+                    count += 1
+                continue
+            if is_dir:
+                continue
+            count += 1
+            station_summary = stations.setdefault(station, [None, 0])
+            station_summary[1] += 1
+            if station_summary[0] is None or mtime > station_summary[0]:
+                station_summary[0] = mtime
+        walk_span.set(entries=count, stations=len(stations))
+    registry.inc(
+        'aws_monitor_entries_scanned_total',
+        count,
+        help='Directory entries visited while searching for the latest modification time',
+        path=os.fspath(dir_path),
+    )
+    return PathSummary(
+        kind='tree',
+        latest=latest,
+        count=count,
+        stations={station: tuple(summary) for station, summary in stations.items()},
+    )
+
+
+def summarize_repository(repository_path: Path, commit_time_cache: Optional[CommitTimeCache] = None) -> PathSummary:
+    """Last commit time of a git repository and of each station sub-directory, in a single history walk"""
+    commit_time_cache = commit_time_cache or CommitTimeCache(repository_path)
+    try:
+        with os.scandir(repository_path) as iterator:
+            stations = sorted(
+                entry.name for entry in iterator
+                if entry.name[0] != '.' and entry.is_dir(follow_symlinks=False)
+            )
+        commit_datetimes = commit_time_cache.get_last_commit_datetimes(['.', *stations])
+    except (OSError, subprocess.CalledProcessError) as e:
+        return PathSummary(kind='git', error=f'Unable to read the last commits of {repository_path}: {e}')
+
+    def timestamp(value: Optional[datetime]) -> Optional[float]:
+        return value.timestamp() if value is not None else None
+
+    return PathSummary(
+        kind='git',
+        latest=timestamp(commit_datetimes['.']),
+        stations={station: (timestamp(commit_datetimes[station]), None) for station in stations},
+    )
+
+
+def build_summary(
+        agent: str,
+        tree_paths: Mapping[str, Path],
+        repository_paths: Mapping[str, Path],
+        commit_time_caches: Optional[Mapping[str, CommitTimeCache]] = None,
+) -> Dict:
+    """Summary of all paths of an agent, keyed by the path names of the configuration, e.g. `l3_tx`"""
+    commit_time_caches = commit_time_caches or dict()
+    paths = dict()
+    for name, dir_path in tree_paths.items():
+        paths[name] = summarize_tree(dir_path)
+    for name, repository_path in repository_paths.items():
+        paths[name] = summarize_repository(repository_path, commit_time_caches.get(name))
+    return dict(
+        agent=agent,
+        time=time.time(),
+        paths={name: summary.to_json() for name, summary in paths.items()},
+    )
+
+
+def send_summary(url: str, summary: Mapping, token: Optional[str] = None, timeout: float = 30.):
+    """Post the summary to the aggregator at `url`, e.g. http://azure-aws:9480. Raises on failure."""
+    from urllib.request import Request, urlopen
+
+    content = json.dumps(summary, separators=(',', ':')).encode('utf-8')
+    request = Request(
+        f"{url.rstrip('/')}/summaries/{summary['agent']}",
+        data=content,
+        method='POST',
+        headers={'Content-Type': 'application/json'},
+    )
+    if token:
+        request.add_header('X-Agent-Token', token)
+    with profiling.span('send_summary', url=url, bytes=len(content)), urlopen(request, timeout=timeout):
+        pass
+    logger.info(f"Sent summary of {len(summary['paths'])} paths ({len(content)} bytes) to {url}")
+
+
+def default_agent_name() -> str:
+    return socket.gethostname().split('.')[0]
+
+
+@attr.s
+class SummaryStore:
+    """
+    Latest summary of each agent and the time it was received.
+
+    The store is optionally persisted in `path` as json, so that a restart of the aggregator does not lose track of
+    agents that send summaries less often than the daemon is restarted.
+    """
+    path: Optional[Path] = attr.ib(default=None)
+    summaries: Dict[str, Dict] = attr.ib(init=False, factory=dict)
+    received_at: Dict[str, float] = attr.ib(init=False, factory=dict)
+    started_at: float = attr.ib(init=False, factory=time.time)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.summaries = state.get('summaries', {})
+        self.received_at = state.get('received_at', {})
+
+    def put(self, agent: str, summary: Dict, received_at: Optional[float] = None):
+        with self._lock:
+            self.summaries[agent] = summary
+            self.received_at[agent] = received_at if received_at is not None else time.time()
+            if self.path is not None:
+                temporary_path = Path(f'{self.path}.tmp')
+                with open(temporary_path, 'w') as f:
+                    json.dump(dict(summaries=self.summaries, received_at=self.received_at), f)
+                os.replace(temporary_path, self.path)
+
+    def get_all(self) -> Dict[str, Dict]:
+        with self._lock:
+            return dict(self.summaries)
+
+    def get(self, agent: str) -> Tuple[Optional[Dict], Optional[float]]:
+        """Latest summary of `agent` and when it was received"""
+        with self._lock:
+            return self.summaries.get(agent), self.received_at.get(agent)
+
+
+@attr.s
+class SummaryReceiver:
+    """
+    Receive summaries at `POST /summaries/<agent>` with the token in the `X-Agent-Token` header, and serve all
+    summaries as JSON at `GET /summaries`.
+    """
+    store: SummaryStore = attr.ib()
+    port: int = attr.ib(default=DEFAULT_PORT)
+    bind: str = attr.ib(default='')
+    token: Optional[str] = attr.ib(default=None, repr=False)
+    _server: Optional['ThreadingHTTPServer'] = attr.ib(init=False, repr=False, default=None)
+
+    @property
+    def address(self) -> Optional[Tuple[str, int]]:
+        return self._server.server_address if self._server is not None else None
+
+    def start(self):
+        import hmac
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        store = self.store
+        token = self.token
+
+        class SummaryHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                prefix = '/summaries/'
+                path = self.path.split('?')[0]
+                agent = path[len(prefix):]
+                if not path.startswith(prefix) or not _AGENT_PATTERN.fullmatch(agent):
+                    self.send_error(404)
+                    return
+                if token is not None and not hmac.compare_digest(
+                        (self.headers.get('X-Agent-Token') or '').encode(), token.encode(),
+                ):
+                    logger.warning(f"Rejected summary of {agent} with an invalid token")
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > _MAX_SUMMARY_BYTES:
+                    self.send_error(413)
+                    return
+                try:
+                    summary = json.loads(self.rfile.read(length))
+                    for value in summary['paths'].values():
+                        PathSummary.from_json(value)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    self.send_error(400)
+                    return
+                store.put(agent, summary)
+                registry.inc('aws_monitor_summaries_received_total', help='Summaries received from agents', agent=agent)
+                self.send_response(204)
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/summaries':
+                    self.send_error(404)
+                    return
+                content = json.dumps(store.get_all()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((self.bind, self.port), SummaryHandler)
+        thread = threading.Thread(target=self._server.serve_forever, name='summary-http', daemon=True)
+        thread.start()
+        logger.info(f"Receiving agent summaries on port {self._server.server_address[1]}")
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _format_time(timestamp: Optional[float]) -> str:
+    if timestamp is None:
+        return 'never'
+    return f'{datetime.fromtimestamp(timestamp, tz=timezone.utc):%Y-%m-%d %H:%M} UTC'
+
+
+def check_remote_summary(
+        store: SummaryStore,
+        agent: str,
+        current_time: datetime,
+        max_summary_age: timedelta,
+        max_ages: Mapping[str, timedelta],
+        default_max_age: timedelta = timedelta(hours=1),
+        station_max_age: Optional[timedelta] = None,
+        max_stale_stations: int = 0,
+) -> List[str]:
+    '''Evaluate the thresholds of the aggregator on the latest summary of an agent
+    and return a description of each problem found.
+
+    Parameters
+    ----------
+    store : SummaryStore
+        Latest summaries received from the agents
+    agent : str
+        Name of the agent
+    current_time : datetime
+        Current datetime used for determine data age
+    max_summary_age : timedelta
+        Maximum allowed time since the last summary of the agent was received
+    max_ages : Mapping[str, timedelta]
+        Maximum allowed age of the newest data per path name
+    default_max_age : timedelta
+        Maximum allowed age of the newest data of paths not in `max_ages`
+    station_max_age : timedelta, optional
+        Maximum allowed age of the newest data per station. Stations are not checked if not provided.
+    max_stale_stations : int
+        Number of stale stations per path tolerated
+
+    Returns
+    -------
+    problems : List[str]
+        Empty if passing
+    '''
+    summary, received_at = store.get(agent)
+    now = current_time.timestamp()
+    since = received_at if received_at is not None else store.started_at
+    if now - since > max_summary_age.total_seconds():
+        return [f'No summary received from {agent} since {_format_time(received_at)}']
+    if summary is None:
+        return []
+
+    problems = []
+    ages = []
+    for name, value in sorted(summary['paths'].items()):
+        path_summary = PathSummary.from_json(value)
+        if path_summary.error is not None:
+            problems.append(f'{name}: {path_summary.error}')
+            continue
+        if path_summary.latest is None:
+            problems.append(f'{name}: no data found')
+            continue
+        age = timedelta(seconds=now - path_summary.latest)
+        ages.append(age)
+        registry.set_gauge(
+            'aws_monitor_remote_data_age_seconds',
+            age.total_seconds(),
+            help='Age of the newest data of a path reported by an agent',
+            agent=agent,
+            path=name,
+        )
+        if age > max_ages.get(name, default_max_age):
+            problems.append(f'{name}: newest data from {_format_time(path_summary.latest)}, {age} ago')
+
+        if station_max_age is None:
+            continue
+        stale_stations = {
+            station: latest for station, (latest, _) in path_summary.stations.items()
+            if latest is None or now - latest > station_max_age.total_seconds()
+        }
+        if len(stale_stations) > max_stale_stations:
+            problems.append(
+                f'{name}: {len(stale_stations)} stale stations: '
+                + ', '.join(f'{station} ({_format_time(latest)})' for station, latest in sorted(stale_stations.items()))
+            )
+    if ages:
+        report_data_age(max(ages))
+    return problems
@@ -0,0 +1,194 @@
+"""
+Full scans of station trees split into one shard per top-level station directory.
+
+The shards are scanned in a thread pool, which overlaps the I/O latency of slow or network mounted filesystems, or in
+a process pool, which also uses all cores for the Python side of very large trees. A worker walks its shard with
+`scan_tree` and returns only the latest modification time and the counts of the shard, so the results passed between
+processes are a few bytes per station regardless of the number of files.
+
+The pool is created on first use and kept until `close`, so in daemon mode the worker processes are started once.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+import attr
+
+from alert_processing import profiling
+from alert_processing.file_system_status import scan_tree
+from alert_processing.metrics import registry
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+__all__ = [
+    'ShardSummary',
+    'ShardedScanner',
+]
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class ShardSummary:
+    # Latest modification time in seconds since the epoch, None if the shard is empty
+    latest_mtime: Optional[float] = attr.ib()
+    file_count: int = attr.ib()
+    entry_count: int = attr.ib()
+
+
+def _scan_shard(
+        shard_path: str,
+        skip_dir: bool,
+        skip_hidden: bool,
+        threshold: Optional[float] = None,
+) -> Tuple[Optional[float], int, int]:
+    """Latest mtime, file count and entry count of one shard. Stops at the first mtime at or after `threshold`."""
+    latest_mtime = None
+    file_count = 0
+    entry_count = 0
+    for entry in scan_tree(shard_path, skip_dir=skip_dir, skip_hidden=skip_hidden):
+        entry_count += 1
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        file_count += skip_dir or not entry.is_dir(follow_symlinks=False)
+        if latest_mtime is None or mtime > latest_mtime:
+            latest_mtime = mtime
+            if threshold is not None and mtime >= threshold:
+                break
+    return latest_mtime, file_count, entry_count
+
+
+@attr.s
+class ShardedScanner:
+    """
+    Scan the station directories of a tree concurrently in `max_workers` threads, or processes if `use_processes`.
+
+    Entries directly in the scanned directory are handled by the calling thread.
+    """
+    max_workers: Optional[int] = attr.ib(default=None)
+    use_processes: bool = attr.ib(default=False)
+    _executor: Optional[Executor] = attr.ib(init=False, repr=False, default=None)
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                # Forking a process with running threads, e.g. in daemon mode, can deadlock the children
+                start_methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers or min(32, 4 * (os.cpu_count() or 1)),
+                    thread_name_prefix='shard',
+                )
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def scan_shards(
+            self,
+            dir_path: Path,
+            skip_dir: bool = False,
+            skip_hidden: bool = True,
+            newer_than: Optional[datetime] = None,
+    ) -> Tuple[Dict[str, ShardSummary], Optional[float]]:
+        """
+        Summary of each station directory of `dir_path` and the latest mtime of the entries directly in `dir_path`.
+
+        If `newer_than` is provided, the shards not started yet are cancelled once a modification time at or after
+        `newer_than` is found, so the summaries are incomplete.
+        """
+        threshold = newer_than.timestamp() if newer_than is not None else None
+        shard_paths: Dict[str, str] = dict()
+        root_mtime = None
+        with profiling.span('sharded_walk', path=os.fspath(dir_path), processes=self.use_processes) as walk_span:
+            try:
+                with os.scandir(dir_path) as iterator:
+                    for entry in iterator:
+                        if skip_hidden and entry.name[0] == '.':
+                            continue
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if is_dir:
+                                shard_paths[entry.name] = entry.path
+                                if skip_dir:
+                                    continue
+                            mtime = entry.stat().st_mtime
+                        except FileNotFoundError:
+                            continue
+                        if root_mtime is None or mtime > root_mtime:
+                            root_mtime = mtime
+            except FileNotFoundError:
+                logger.warning(f"Directory does not exist: {dir_path}")
+                return dict(), None
+
+            summaries: Dict[str, ShardSummary] = dict()
+            if threshold is not None and root_mtime is not None and root_mtime >= threshold:
+                shard_paths = dict()
+            executor = self._get_executor()
+            futures = {
+                executor.submit(_scan_shard, shard_path, skip_dir, skip_hidden, threshold): station
+                for station, shard_path in shard_paths.items()
+            }
+            cancelled = 0
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                summary = ShardSummary(*future.result())
+                summaries[futures[future]] = summary
+                if threshold is not None and summary.latest_mtime is not None and summary.latest_mtime >= threshold:
+                    cancelled += sum(other.cancel() for other in futures)
+            entry_count = sum(summary.entry_count for summary in summaries.values())
+            walk_span.set(shards=len(shard_paths), entries=entry_count, cancelled=cancelled)
+        registry.inc(
+            'aws_monitor_entries_scanned_total',
+            entry_count,
+            help='Directory entries visited while searching for the latest modification time',
+            path=os.fspath(dir_path),
+        )
+        return summaries, root_mtime
+
+    def get_latest_modified_time(
+            self,
+            dir_path: Path,
+            newer_than: Optional[datetime] = None,
+            skip_dir: bool = False,
+            skip_hidden: bool = True,
+    ) -> Optional[datetime]:
+        """Same as `file_system_status.get_latest_modified_time` with the station directories scanned concurrently"""
+        summaries, root_mtime = self.scan_shards(dir_path, skip_dir, skip_hidden, newer_than=newer_than)
+        latest_mtime = max(
+            (mtime for mtime in (root_mtime, *(s.latest_mtime for s in summaries.values())) if mtime is not None),
+            default=None,
+        )
+        if latest_mtime is None:
+            return None
+        return datetime.fromtimestamp(latest_mtime, tz=timezone.utc)
+
+    def get_station_modified_time(self, dir_path: Path, skip_hidden: bool = True) -> 'pd.DataFrame':
+        """Same as `file_system_status.get_station_modified_time` with the station directories scanned concurrently"""
+        import pandas as pd
+
+        summaries, _ = self.scan_shards(dir_path, skip_dir=True, skip_hidden=skip_hidden)
+        stations = sorted(summaries)
+        return pd.DataFrame(
+            dict(
+                modified_datetime=pd.to_datetime(
+                    [summaries[station].latest_mtime for station in stations],
+                    unit='s',
+                    utc=True,
+                ),
+                file_count=[summaries[station].file_count for station in stations],
+            ),
+            index=pd.Index(stations, dtype=str, name='station'),
+        )
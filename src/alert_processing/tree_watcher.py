@@ -0,0 +1,407 @@
+"""
+Event driven freshness of directory trees using Linux inotify.
+
+In daemon mode the newest modification time of every watched tree and of each station sub-directory is kept in
+memory and updated from inotify events, so a freshness check is a dictionary lookup instead of a walk of the tree.
+inotify is called through ctypes and needs no additional dependency.
+
+The watcher only reports a tree while its state is known to be complete. Until the initial scan of a tree has
+finished, after an event queue overflow and on filesystems where inotify does not see all changes, lookups report
+the tree as unavailable and the checks fall back to scanning.
+"""
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import attr
+
+from alert_processing.metrics import registry
+
+__all__ = [
+    'TreeWatcher',
+]
+
+logger = logging.getLogger(__name__)
+
+# Flags and event masks from <sys/inotify.h>
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR | _IN_DONT_FOLLOW
+)
+# Events which change the entries of a directory and thereby its modification time
+_NAMESPACE_EVENTS = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO
+_EVENT_HEADER = struct.Struct('iIII')
+
+# statfs magic numbers of network and FUSE filesystems, where changes made by other hosts produce no events
+_REMOTE_FILESYSTEMS = {
+    0x6969: 'nfs',
+    0x517B: 'smb',
+    0xFF534D42: 'cifs',
+    0xFE534D42: 'smb2',
+    0x65735546: 'fuse',
+    0x01021997: 'v9fs',
+}
+
+
+class _Inotify:
+    """Minimal ctypes binding of the inotify system calls"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._statfs = getattr(libc, 'statfs', None)
+        self._ctypes = ctypes
+        self.fd = self._init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+
+    def _raise_errno(self, path: Optional[str] = None):
+        error_number = self._ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number), path)
+
+    def add_watch(self, path: str) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            self._raise_errno(path)
+        return wd
+
+    def remove_watch(self, wd: int):
+        # The watch is already gone if the directory was removed
+        self._rm_watch(self.fd, wd)
+
+    def filesystem_type(self, path: str) -> Optional[int]:
+        if self._statfs is None:
+            return None
+        # struct statfs starts with the filesystem type as a native long
+        buffer = self._ctypes.create_string_buffer(256)
+        if self._statfs(os.fsencode(path), buffer) != 0:
+            return None
+        return self._ctypes.c_ulong.from_buffer(buffer).value & 0xFFFFFFFF
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """Read the pending events as (watch descriptor, mask, name)"""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+@attr.s
+class _WatchedTree:
+    root: str = attr.ib()
+    ready: bool = attr.ib(default=False)
+    # Watching is not possible, e.g. on a network filesystem or when the watch limit is reached
+    unsupported: bool = attr.ib(default=False)
+    # Newest modification time of any file or directory below root
+    latest_mtime: Optional[float] = attr.ib(default=None)
+    # Newest modification time of the files below each station sub-directory, None for stations without files
+    station_mtimes: Dict[str, Optional[float]] = attr.ib(factory=dict)
+    watches: Set[int] = attr.ib(factory=set)
+    synced_at: float = attr.ib(default=0.)
+
+    def update(self, path: str, mtime: float, is_dir: bool):
+        if self.latest_mtime is None or mtime > self.latest_mtime:
+            self.latest_mtime = mtime
+        station, separator, _ = path[len(self.root) + 1:].partition(os.sep)
+        if not separator:
+            # Station directories themselves and files located directly in root
+            if is_dir:
+                self.station_mtimes.setdefault(station, None)
+        elif not is_dir:
+            station_mtime = self.station_mtimes.get(station)
+            if station_mtime is None or mtime > station_mtime:
+                self.station_mtimes[station] = mtime
+
+
+@attr.s
+class TreeWatcher:
+    """
+    Newest modification times of directory trees kept up to date from inotify events by a background thread.
+
+    The watcher only records maxima. Removed files and modification times set back in time are therefore not
+    reflected until the tree is scanned again, which happens every `resync_interval` and after an event queue
+    overflow. Hidden entries are ignored like in `file_system_status.scan_tree`.
+    """
+    resync_interval: timedelta = attr.ib(default=timedelta(hours=24))
+    skip_hidden: bool = attr.ib(default=True)
+    _inotify: Optional[_Inotify] = attr.ib(init=False, repr=False, default=None)
+    _trees: Dict[str, _WatchedTree] = attr.ib(init=False, repr=False, factory=dict)
+    _watch_paths: Dict[int, Tuple[_WatchedTree, str]] = attr.ib(init=False, repr=False, factory=dict)
+    _lock: threading.Lock = attr.ib(init=False, repr=False, factory=threading.Lock)
+    _thread: Optional[threading.Thread] = attr.ib(init=False, repr=False, default=None)
+    _wake_pipe: Optional[Tuple[int, int]] = attr.ib(init=False, repr=False, default=None)
+    _stop_requested: bool = attr.ib(init=False, repr=False, default=False)
+
+    def start(self):
+        """Start the event thread. Raises OSError if inotify is not available."""
+        self._inotify = _Inotify()
+        self._wake_pipe = os.pipe()
+        self._thread = threading.Thread(target=self._run, name='tree-watcher', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop_requested = True
+        os.write(self._wake_pipe[1], b'\0')
+        self._thread.join()
+        self._thread = None
+        self._inotify.close()
+        for fd in self._wake_pipe:
+            os.close(fd)
+
+    def watch(self, dir_path: Union[Path, str]):
+        """Start watching the tree below `dir_path`. The tree is scanned in the background."""
+        root = os.fspath(dir_path).rstrip(os.sep)
+        with self._lock:
+            if root in self._trees:
+                return
+            self._trees[root] = _WatchedTree(root)
+        if self._wake_pipe is not None:
+            os.write(self._wake_pipe[1], b'\0')
+
+    def get_latest_modified_time(self, dir_path: Union[Path, str]) -> Tuple[bool, Optional[datetime]]:
+        """
+        Return whether the watched state of `dir_path` is available and the latest modification time of any file or
+        directory below it, matching `file_system_status.get_latest_modified_time`.
+        """
+        with self._lock:
+            tree = self._trees.get(os.fspath(dir_path).rstrip(os.sep))
+            if tree is None or not tree.ready:
+                return False, None
+            latest_mtime = tree.latest_mtime
+        if latest_mtime is None:
+            return True, None
+        return True, datetime.fromtimestamp(latest_mtime, tz=timezone.utc)
+
+    def get_station_modified_times(
+            self,
+            dir_path: Union[Path, str],
+    ) -> Tuple[bool, Dict[str, Optional[datetime]]]:
+        """Return whether the watched state of `dir_path` is available and the latest file time per station"""
+        with self._lock:
+            tree = self._trees.get(os.fspath(dir_path).rstrip(os.sep))
+            if tree is None or not tree.ready:
+                return False, dict()
+            station_mtimes = dict(tree.station_mtimes)
+        return True, {
+            station: datetime.fromtimestamp(mtime, tz=timezone.utc) if mtime is not None else None
+            for station, mtime in station_mtimes.items()
+        }
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._inotify.fd, select.POLLIN)
+        poller.register(self._wake_pipe[0], select.POLLIN)
+        while not self._stop_requested:
+            try:
+                self._sync_trees()
+                timeout = max(self.resync_interval.total_seconds() / 10, 1.)
+                for fd, _ in poller.poll(timeout * 1e3):
+                    if fd == self._wake_pipe[0]:
+                        os.read(fd, 1 << 10)
+                self._process_events()
+            except Exception:
+                logger.exception("Tree watcher failed. Rescanning all trees")
+                with self._lock:
+                    for tree in self._trees.values():
+                        tree.ready = False
+                time.sleep(10.)
+
+    def _sync_trees(self):
+        """Scan the trees that are new, overflowed or due for a periodic resync"""
+        now = time.monotonic()
+        with self._lock:
+            trees = [
+                tree for tree in self._trees.values()
+                if not tree.unsupported and (
+                        not tree.ready or now - tree.synced_at > self.resync_interval.total_seconds()
+                )
+            ]
+        for tree in trees:
+            self._sync_tree(tree)
+
+    def _sync_tree(self, tree: _WatchedTree):
+        filesystem_type = self._inotify.filesystem_type(tree.root)
+        if filesystem_type in _REMOTE_FILESYSTEMS:
+            logger.warning(
+                f"{tree.root} is on a {_REMOTE_FILESYSTEMS[filesystem_type]} filesystem, which is not watched"
+            )
+            tree.unsupported = True
+            return
+
+        start_time = time.perf_counter()
+        with self._lock:
+            tree.ready = False
+            self._remove_watches(tree)
+            tree.latest_mtime = None
+            tree.station_mtimes = dict()
+        try:
+            directory_count = self._add_directory(tree, tree.root)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.warning(f"Unable to watch {tree.root}, the inotify watch limit is reached")
+            else:
+                logger.warning(f"Unable to watch {tree.root}: {e}")
+            with self._lock:
+                self._remove_watches(tree)
+                tree.unsupported = True
+            return
+        if directory_count == 0:
+            # The root does not exist (yet). The checks scan it and report it as missing
+            return
+        with self._lock:
+            tree.ready = True
+            tree.synced_at = time.monotonic()
+        logger.info(
+            f"Watching {directory_count} directories below {tree.root}, "
+            f"scanned in {time.perf_counter() - start_time:.3f} s"
+        )
+
+    def _remove_watches(self, tree: _WatchedTree):
+        for wd in tree.watches:
+            self._inotify.remove_watch(wd)
+            self._watch_paths.pop(wd, None)
+        tree.watches = set()
+
+    def _add_directory(self, tree: _WatchedTree, dir_path: str) -> int:
+        """
+        Watch `dir_path` and all directories below it and record the modification times of their entries. The watch
+        is added before the directory is listed, so that no change is missed in between.
+        """
+        directory_count = 0
+        stack = [dir_path]
+        while stack:
+            path = stack.pop()
+            try:
+                wd = self._inotify.add_watch(path)
+            except FileNotFoundError:
+                continue
+            except NotADirectoryError:
+                continue
+            directory_count += 1
+            entries = []
+            try:
+                with os.scandir(path) as iterator:
+                    for entry in iterator:
+                        if self.skip_hidden and entry.name[0] == '.':
+                            continue
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            mtime = entry.stat(follow_symlinks=False).st_mtime
+                        except FileNotFoundError:
+                            continue
+                        entries.append((entry.path, mtime, is_dir))
+                        if is_dir:
+                            stack.append(entry.path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._watch_paths[wd] = (tree, path)
+                tree.watches.add(wd)
+                for entry_path, mtime, is_dir in entries:
+                    tree.update(entry_path, mtime, is_dir)
+        return directory_count
+
+    def _process_events(self):
+        """Read and apply the pending events. Events of the same entry are merged into a single stat."""
+        changed_paths: Dict[str, Tuple[_WatchedTree, bool]] = dict()
+        new_directories: List[Tuple[_WatchedTree, str]] = []
+        resync_trees: Set[str] = set()
+        for wd, mask, name in self._inotify.read_events():
+            if mask & _IN_Q_OVERFLOW:
+                logger.warning("inotify event queue overflow. Rescanning all trees")
+                registry.inc('aws_monitor_watcher_overflows_total', help='inotify event queue overflows')
+                with self._lock:
+                    resync_trees.update(self._trees)
+                continue
+            with self._lock:
+                watched = self._watch_paths.get(wd)
+                if mask & _IN_IGNORED:
+                    self._watch_paths.pop(wd, None)
+                    if watched is not None:
+                        watched[0].watches.discard(wd)
+                    continue
+            if watched is None:
+                continue
+            tree, dir_path = watched
+            if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                if dir_path == tree.root:
+                    resync_trees.add(tree.root)
+                continue
+            if mask & _NAMESPACE_EVENTS and dir_path != tree.root:
+                changed_paths[dir_path] = (tree, True)
+            if not name or (self.skip_hidden and name[0] == '.'):
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & _IN_ISDIR:
+                if mask & _IN_MOVED_FROM:
+                    # The watches below a moved directory keep their old paths
+                    resync_trees.add(tree.root)
+                    continue
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    new_directories.append((tree, path))
+                if not mask & _IN_DELETE:
+                    changed_paths[path] = (tree, True)
+            elif not mask & (_IN_DELETE | _IN_MOVED_FROM):
+                changed_paths[path] = (tree, False)
+
+        for tree, path in new_directories:
+            if tree.root not in resync_trees:
+                self._add_directory(tree, path)
+        updates = []
+        for path, (tree, is_dir) in changed_paths.items():
+            try:
+                updates.append((tree, path, os.stat(path, follow_symlinks=False).st_mtime, is_dir))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        with self._lock:
+            for tree, path, mtime, is_dir in updates:
+                tree.update(path, mtime, is_dir)
+            for root in resync_trees:
+                self._trees[root].ready = False
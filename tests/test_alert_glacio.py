@@ -0,0 +1,37 @@
+import os
+import time
+from datetime import timedelta
+
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.email_notification import EmailNotificationClient, StatefulNotificationClient
+from benchmarks.fixtures import smtp_server
+from glacio01_monitor.alert_glacio import run_glacio_checks
+
+
+def test_hourly_runs_alert_once_and_recover(tmp_path):
+    glacio_file = tmp_path / 'glacio01_monitor.txt'
+    glacio_file.write_text('')
+    os.utime(glacio_file, (time.time() - 2 * 3600, time.time() - 2 * 3600))
+
+    with smtp_server() as smtp:
+        def run():
+            # Each cron run creates a new client like create_notification_client
+            notification_client = StatefulNotificationClient(
+                EmailNotificationClient(timeout=5, **smtp['client_settings']),
+                state_store=AlertStateStore(tmp_path / 'state.sqlite'),
+                renotify_interval=timedelta(hours=24),
+            )
+            run_glacio_checks(os.fspath(glacio_file), notification_client)
+            subjects = [
+                line for message in smtp['received'] for line in message.decode().splitlines()
+                if line.startswith('Subject:')
+            ]
+            smtp['received'].clear()
+            return subjects
+
+        assert run() == ['Subject: ALERT: glacio01 down!']
+        assert run() == []
+
+        glacio_file.touch()
+        assert run() == ['Subject: RECOVERED: glacio01 is passing again']
+        assert run() == []
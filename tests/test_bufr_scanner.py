@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+
+from alert_processing.bufr_scanner import check_bufr_content, scan_bufr_directory
+
+REFERENCE_TIME = datetime(2024, 1, 17, 13, 0, tzinfo=timezone.utc)
+
+
+def make_message(reference_time: datetime, subset_count: int) -> bytes:
+    """Minimal edition 4 BUFR message with an empty data section"""
+    section1 = bytes(3) + bytes([0, 0, 94, 0, 0, 0, 0, 0, 0, 0, 0, 32])
+    section1 += reference_time.year.to_bytes(2, 'big')
+    section1 += bytes([reference_time.month, reference_time.day, reference_time.hour, reference_time.minute, 0])
+    section1 = len(section1).to_bytes(3, 'big') + section1[3:]
+    section3 = (9).to_bytes(3, 'big') + bytes(1) + subset_count.to_bytes(2, 'big') + bytes([0x80, 0, 0])
+    section4 = (4).to_bytes(3, 'big') + bytes(1)
+    length = 8 + len(section1) + len(section3) + len(section4) + 4
+    return b'BUFR' + length.to_bytes(3, 'big') + bytes([4]) + section1 + section3 + section4 + b'7777'
+
+
+def test_single_station_files_are_not_scanned(tmp_path):
+    concatenated_path = tmp_path / REFERENCE_TIME.strftime('geus_%Y%m%dT%H%M.bufr')
+    concatenated_path.write_bytes(make_message(REFERENCE_TIME, 3) + b'\n' + make_message(REFERENCE_TIME, 2))
+    older_path = tmp_path / (REFERENCE_TIME - timedelta(hours=1)).strftime('geus_%Y%m%dT%H%M.bufr')
+    older_path.write_bytes(b'truncated')
+    # The single station file is written last and must not be taken as the newest file
+    station_path = tmp_path / 'geus_KAN_U.bufr'
+    station_path.write_bytes(make_message(REFERENCE_TIME - timedelta(days=1), 1))
+
+    summaries = scan_bufr_directory(tmp_path, max_files=1)
+    assert [summary.path for summary in summaries] == [concatenated_path]
+    assert summaries[0].subset_count == 5
+
+    problems = check_bufr_content(
+        tmp_path,
+        current_time=REFERENCE_TIME + timedelta(hours=1),
+        max_observation_lag=timedelta(hours=3),
+        min_stations=5,
+    )
+    assert problems == []
@@ -0,0 +1,70 @@
+import sqlite3
+from configparser import ConfigParser
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from pyftpdlib.handlers import FTPHandler
+
+from alert_processing.check_alerts import CheckResources, build_checks_from_config
+from alert_processing.check_runner import run_checks
+from alert_processing.disk_usage import DiskUsageTracker
+from benchmarks.fixtures import ftp_server
+
+
+def make_config(tmp_path: Path, text: str, dmi: str = 'skip : yes') -> ConfigParser:
+    config_parser = ConfigParser(converters={'list': str.split, 'path': Path})
+    config_parser.read_string(f'''
+[local]
+l3-tx-path : {tmp_path / 'l3'}
+[logging]
+log_path : {tmp_path / 'monitor.log'}
+[dmi]
+{dmi}
+{text}
+''')
+    return config_parser
+
+
+def test_reload_reuses_and_closes_resources(tmp_path):
+    resources = CheckResources()
+    trackers = []
+    for text in ('[capacity]', '[capacity]\nmin-days-to-full : 7', ''):
+        resources.begin()
+        build_checks_from_config(make_config(tmp_path, text), resources=resources)
+        resources.release_unused()
+        trackers.extend(r for r in resources._objects.values() if isinstance(r, DiskUsageTracker))
+
+    assert len(trackers) == 2 and trackers[0] is trackers[1]
+    with pytest.raises(sqlite3.ProgrammingError):
+        trackers[0].connection.execute('SELECT 1')
+
+
+def test_dmi_ftp_is_read_once_per_run(tmp_path):
+    listings = []
+
+    def record_mlsd(self, path):
+        listings.append(path)
+        return FTPHandler.ftp_MLSD(self, path)
+
+    reference_time = datetime(2024, 1, 17, 13, 0, tzinfo=timezone.utc)
+    (tmp_path / 'l3').mkdir()
+    with ftp_server(tmp_path / 'ftp', file_count=5, reference_time=reference_time,
+                    handler_attributes=dict(ftp_MLSD=record_mlsd)) as settings:
+        dmi = '\n'.join([
+            f"user : {settings['user']}",
+            f"password : {settings['passwd']}",
+            f"server : {settings['host']}",
+            f"port : {settings['port']}",
+            'retries : 0',
+        ])
+        checks = build_checks_from_config(make_config(tmp_path, '[latency]', dmi=dmi))
+        checks = [check for check in checks if check.name in ('dmi_ftp', 'pipeline_latency')]
+        assert len(checks) == 2
+
+        results = run_checks(checks, reference_time + timedelta(minutes=10))
+        assert [result.error for result in results] == [None, None]
+        assert len(listings) == 1
+
+        run_checks(checks, reference_time + timedelta(minutes=20))
+        assert len(listings) == 2
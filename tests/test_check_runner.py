@@ -0,0 +1,57 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+from alert_processing.check_runner import Alert, PipelineCheck, run_checks
+
+
+def test_hanging_check_is_not_started_again():
+    release = threading.Event()
+    calls = []
+
+    def hanging_check(current_time):
+        calls.append(current_time)
+        release.wait(10)
+
+    checks = [
+        PipelineCheck(name='hanging', function=hanging_check),
+        PipelineCheck(name='alerting', function=lambda current_time: Alert('subject', 'body')),
+    ]
+    try:
+        first = run_checks(checks, datetime.now(tz=timezone.utc), timeout=0.2)
+        assert isinstance(first[0].error, TimeoutError)
+        assert first[1].alert is not None
+
+        second = run_checks(checks, datetime.now(tz=timezone.utc), timeout=0.2)
+        assert isinstance(second[0].error, TimeoutError)
+        assert second[1].alert is not None
+        assert len(calls) == 1
+    finally:
+        release.set()
+
+
+def test_finished_check_runs_again():
+    checks = [PipelineCheck(name='passing', function=lambda current_time: None)]
+    for _ in range(2):
+        result, = run_checks(checks, datetime.now(tz=timezone.utc))
+        assert result.error is None and result.alert is None
+
+
+def test_timeout_starts_when_the_check_gets_a_slot():
+    checks = [PipelineCheck(name=f'slow_{i}', function=lambda current_time: time.sleep(0.2)) for i in range(3)]
+    results = run_checks(checks, datetime.now(tz=timezone.utc), max_workers=1, timeout=0.5)
+    assert [result.error for result in results] == [None, None, None]
+
+
+def test_timed_out_check_gives_its_slot_back():
+    release = threading.Event()
+    checks = [
+        PipelineCheck(name='hanging_slot', function=lambda current_time: release.wait(10)),
+        PipelineCheck(name='waiting', function=lambda current_time: Alert('subject', 'body')),
+    ]
+    try:
+        hanging, waiting = run_checks(checks, datetime.now(tz=timezone.utc), max_workers=1, timeout=0.2)
+        assert isinstance(hanging.error, TimeoutError)
+        assert waiting.error is None and waiting.alert is not None
+    finally:
+        release.set()
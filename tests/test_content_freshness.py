@@ -0,0 +1,87 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+from alert_processing import content_freshness
+from alert_processing.content_freshness import (
+    ContentTimestampCache,
+    get_station_content_times,
+    read_last_csv_timestamp,
+)
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('content, expected', [
+    ('time,t_u\n2024-01-01 00:00:00,-5.1\n2024-01-01 01:00:00,-5.3\n', utc(2024, 1, 1, 1)),
+    ('time,t_u\n2024-01-01 00:00:00,-5.1\n2024-01-01 01:00:00,-5.3', utc(2024, 1, 1, 1)),
+    ('time,t_u\r\n2024-01-01 00:00:00,-5.1\r\n\r\n', utc(2024, 1, 1)),
+    # The last line is being written
+    ('time,t_u\n2024-01-01 00:00:00,-5.1\n2024-01-01 01:0', utc(2024, 1, 1)),
+    ('time,t_u\n', None),
+    ('time,t_u', None),
+    ('', None),
+])
+def test_last_csv_timestamp(tmp_path, content, expected):
+    path = tmp_path / 'KAN_U_hour.csv'
+    path.write_bytes(content.encode())
+    assert read_last_csv_timestamp(path) == expected
+
+
+def test_last_line_spanning_blocks(tmp_path):
+    path = tmp_path / 'KAN_U_hour.csv'
+    rows = [f'2024-01-01 {hour:02d}:00:00Z,{"-5.1," * 200}' for hour in range(24)]
+    path.write_text('time,t_u\n' + '\n'.join(rows))
+    assert read_last_csv_timestamp(path) == utc(2024, 1, 1, 23)
+
+
+def test_changed_file_is_read_again(tmp_path, monkeypatch):
+    path = tmp_path / 'l3' / 'KAN_U' / 'KAN_U_hour.csv'
+    path.parent.mkdir(parents=True)
+    path.write_text('time,t_u\n2024-01-01 00:00:00,-5.1\n')
+    os.utime(path, ns=(1_700_000_000_000_000_000, 1_700_000_000_000_000_000))
+    cache_path = tmp_path / 'cache.json'
+    assert get_station_content_times(tmp_path / 'l3', cache=ContentTimestampCache(cache_path)) == {
+        'KAN_U': utc(2024, 1, 1),
+    }
+
+    read_paths = []
+    read_last_timestamp = content_freshness.read_last_timestamp
+
+    def recording_read(path):
+        read_paths.append(path)
+        return read_last_timestamp(path)
+
+    monkeypatch.setattr(content_freshness, 'read_last_timestamp', recording_read)
+    cache = ContentTimestampCache(cache_path)
+    assert get_station_content_times(tmp_path / 'l3', cache=cache) == {'KAN_U': utc(2024, 1, 1)}
+    assert read_paths == []
+
+    # Rewritten with the same size, only the modification time differs
+    path.write_text('time,t_u\n2024-01-02 00:00:00,-5.1\n')
+    os.utime(path, ns=(1_700_000_000_000_000_000, 1_700_000_000_000_000_001))
+    assert get_station_content_times(tmp_path / 'l3', cache=cache) == {'KAN_U': utc(2024, 1, 2)}
+    # Appended to within the same modification time
+    with open(path, 'a') as f:
+        f.write('2024-01-03 00:00:00,-5.1\n')
+    os.utime(path, ns=(1_700_000_000_000_000_000, 1_700_000_000_000_000_001))
+    assert get_station_content_times(tmp_path / 'l3', cache=cache) == {'KAN_U': utc(2024, 1, 3)}
+    assert read_paths == [path, path]
+
+
+def test_netcdf_files_are_skipped_without_xarray(tmp_path, monkeypatch, caplog):
+    monkeypatch.setitem(sys.modules, 'xarray', None)
+    monkeypatch.setattr(content_freshness, '_netcdf_readable', None)
+    for station in ('KAN_U', 'QAS_L'):
+        (tmp_path / station).mkdir()
+        (tmp_path / station / f'{station}_hour.nc').write_bytes(b'CDF\x01')
+    (tmp_path / 'KAN_U' / 'KAN_U_hour.csv').write_text('time,t_u\n2024-01-01 00:00:00,-5.1\n')
+
+    assert get_station_content_times(tmp_path) == {'KAN_U': utc(2024, 1, 1)}
+    assert get_station_content_times(tmp_path) == {'KAN_U': utc(2024, 1, 1)}
+    warnings = [record for record in caplog.records if 'NetCDF files are skipped' in record.getMessage()]
+    assert len(warnings) == 1
@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Optional
+
+import attr
+
+from alert_processing.check_runner import PipelineCheck
+from alert_processing.daemon import CheckScheduler, Schedule
+from alert_processing.email_notification import NotificationClient
+
+
+@attr.s
+class RecordingClient(NotificationClient):
+    """Records the names of the passing checks and the subjects of the alerts"""
+    passed: list = attr.ib(factory=list)
+    alerts: list = attr.ib(factory=list)
+
+    def send_alert_email(self, subject_text: str, body_text: str, check_name: Optional[str] = None):
+        self.alerts.append(subject_text)
+
+    def notify_ok(self, check_name: str):
+        self.passed.append(check_name)
+
+
+@attr.s
+class FakeClock:
+    now: float = attr.ib(default=1000.)
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run_ticks(scheduler: CheckScheduler, condition, timeout: float = 5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Condition not met'
+        scheduler._wake_event.wait(min(scheduler.tick(), 0.05))
+        scheduler._wake_event.clear()
+
+
+def settle(scheduler: CheckScheduler, timeout: float = 5.) -> float:
+    """Tick until the started checks are handled and return the seconds until the next tick"""
+    deadline = time.monotonic() + timeout
+    delay = scheduler.tick()
+    while scheduler._batches:
+        assert time.monotonic() < deadline, 'Checks not finished'
+        scheduler._wake_event.wait(0.05)
+        scheduler._wake_event.clear()
+        delay = scheduler.tick()
+    return delay
+
+
+def make_check(name: str, minutes: float, calls: list) -> PipelineCheck:
+    return PipelineCheck(
+        name=name,
+        function=lambda current_time: calls.append(name),
+        interval=timedelta(minutes=minutes),
+    )
+
+
+def test_checks_run_at_their_intervals():
+    calls = []
+    checks = [make_check('l3_tx', 10, calls), make_check('bufr_out', 30, calls)]
+    client = RecordingClient()
+    clock = FakeClock()
+    scheduler = CheckScheduler(lambda: Schedule(checks=checks, notification_client=client), clock=clock)
+
+    assert settle(scheduler) == 600
+    assert sorted(calls) == ['bufr_out', 'l3_tx']
+    # Nothing is due before the next interval
+    calls.clear()
+    clock.now += 300
+    assert settle(scheduler) == 300
+    assert calls == []
+
+    clock.now += 300
+    assert settle(scheduler) == 600
+    assert calls == ['l3_tx']
+
+    calls.clear()
+    clock.now += 1200
+    settle(scheduler)
+    assert sorted(calls) == ['bufr_out', 'l3_tx']
+    assert client.passed.count('l3_tx') == 3 and client.alerts == []
+
+
+def test_reload_keeps_next_run_of_unchanged_checks():
+    calls = []
+    schedules = [[make_check('l3_tx', 10, calls), make_check('bufr_out', 30, calls)]]
+    client = RecordingClient()
+    clock = FakeClock()
+    scheduler = CheckScheduler(lambda: Schedule(checks=schedules[-1], notification_client=client), clock=clock)
+    settle(scheduler)
+
+    # SIGHUP after a changed configuration: l3_tx every 5 minutes, bufr_out removed and l3_joined added
+    calls.clear()
+    schedules.append([make_check('l3_tx', 5, calls), make_check('l3_joined', 10, calls)])
+    scheduler.request_reload()
+    clock.now += 100
+    assert settle(scheduler) == 500
+    assert calls == ['l3_joined']
+    assert sorted(scheduler.next_run) == ['l3_joined', 'l3_tx']
+
+    calls.clear()
+    clock.now += 500
+    assert settle(scheduler) == 100
+    assert calls == ['l3_tx']
+    assert scheduler.next_run['l3_tx'] == clock.now + 300
+
+
+def test_failed_reload_keeps_previous_schedule():
+    calls = []
+    checks = [make_check('l3_tx', 10, calls)]
+    loads = []
+
+    def load_schedule():
+        loads.append(None)
+        if len(loads) > 1:
+            raise ValueError('Invalid configuration')
+        return Schedule(checks=checks, notification_client=RecordingClient())
+
+    clock = FakeClock()
+    scheduler = CheckScheduler(load_schedule, clock=clock)
+    settle(scheduler)
+    scheduler.request_reload()
+    clock.now += 600
+    settle(scheduler)
+    assert len(loads) == 2
+    assert calls == ['l3_tx', 'l3_tx']
+
+
+def test_stop_returns_while_checks_are_running(caplog):
+    started = threading.Event()
+    release = threading.Event()
+
+    def hanging_check(current_time):
+        started.set()
+        release.wait(10)
+
+    checks = [PipelineCheck(name='daemon_hanging', function=hanging_check, interval=timedelta(hours=1))]
+    scheduler = CheckScheduler(lambda: Schedule(checks=checks, notification_client=RecordingClient()))
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    try:
+        assert started.wait(5)
+        with caplog.at_level(logging.WARNING, logger='alert_processing.daemon'):
+            scheduler.request_stop()
+            thread.join(5)
+        assert not thread.is_alive()
+        assert 'Stopping with checks still running: daemon_hanging' in caplog.text
+    finally:
+        release.set()
+        thread.join(5)
+
+
+def test_hanging_check_does_not_delay_other_checks():
+    release = threading.Event()
+    hanging_calls = []
+
+    def hanging_check(current_time):
+        hanging_calls.append(current_time)
+        release.wait(10)
+
+    client = RecordingClient()
+    checks = [
+        PipelineCheck(name='daemon_hanging', function=hanging_check, interval=timedelta(0)),
+        PipelineCheck(name='bufr_out', function=lambda current_time: None, interval=timedelta(0)),
+    ]
+    scheduler = CheckScheduler(lambda: Schedule(checks=checks, notification_client=client, timeout=60))
+    try:
+        run_ticks(scheduler, lambda: client.passed.count('bufr_out') >= 3)
+        # The hanging check is due on every tick, but is not started again while it is in flight
+        assert len(hanging_calls) == 1
+        assert 'daemon_hanging' not in client.passed and client.alerts == []
+    finally:
+        release.set()
+    run_ticks(scheduler, lambda: 'daemon_hanging' in client.passed)
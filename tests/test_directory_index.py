@@ -0,0 +1,155 @@
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from alert_processing.directory_index import DirectoryIndex
+from alert_processing.file_system_status import get_latest_modified_time
+
+HOUR = 3600
+
+
+@pytest.fixture
+def listed(monkeypatch):
+    """Paths listed with os.scandir"""
+    paths = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        paths.append(os.fspath(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', recording_scandir)
+    return paths
+
+
+def set_mtime(path, timestamp):
+    os.utime(path, (timestamp, timestamp))
+
+
+def make_tree(root, now):
+    """Two stations with files 5 to 8 hours old and directories 10 hours old"""
+    for station in ('KAN_U', 'QAS_L'):
+        (root / station).mkdir(parents=True)
+        for i, name in enumerate(('hour', 'day', 'month')):
+            path = root / station / f'{station}_{name}.csv'
+            path.write_text('time,t_u\n')
+            set_mtime(path, now - (5 + i) * HOUR - (station == 'QAS_L') * HOUR)
+        set_mtime(root / station, now - 10 * HOUR)
+    set_mtime(root, now - 10 * HOUR)
+
+
+def timestamp(value: datetime) -> float:
+    return value.timestamp()
+
+
+def same_time(value: datetime, expected: datetime) -> bool:
+    """Equal up to the rounding of nanosecond modification times to microseconds"""
+    return abs(timestamp(value) - timestamp(expected)) < 1e-5
+
+
+def test_unchanged_tree_is_not_listed_again(tmp_path, listed):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    expected = get_latest_modified_time(tmp_path / 'l3')
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    listed.clear()
+    first = index.get_latest_modified_time(tmp_path / 'l3')
+    assert same_time(first, expected)
+    assert timestamp(first) == pytest.approx(now - 5 * HOUR)
+    assert len(listed) == 3
+
+    listed.clear()
+    assert index.get_latest_modified_time(tmp_path / 'l3') == first
+    assert listed == []
+    index.close()
+
+
+def test_added_file_is_found(tmp_path, listed):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    index.get_latest_modified_time(tmp_path / 'l3')
+
+    listed.clear()
+    new_path = tmp_path / 'l3' / 'QAS_L' / 'QAS_L_10min.csv'
+    new_path.write_text('time,t_u\n')
+    set_mtime(new_path, now - HOUR)
+    # The directory mtime counts like in a full scan
+    directory_time = datetime.fromtimestamp((tmp_path / 'l3' / 'QAS_L').stat().st_mtime, tz=timezone.utc)
+    assert same_time(index.get_latest_modified_time(tmp_path / 'l3'), directory_time)
+    assert listed == [os.fspath(tmp_path / 'l3' / 'QAS_L')]
+    assert same_time(get_latest_modified_time(tmp_path / 'l3'), directory_time)
+    index.close()
+
+
+def test_file_rewritten_in_place_is_found(tmp_path, listed):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    index.get_latest_modified_time(tmp_path / 'l3')
+
+    # Appending to a file which is not the newest of its directory keeps the directory mtime
+    listed.clear()
+    month_path = tmp_path / 'l3' / 'QAS_L' / 'QAS_L_month.csv'
+    with open(month_path, 'a') as f:
+        f.write('2024-01-17,1.0\n')
+    set_mtime(month_path, now - HOUR)
+    assert timestamp(index.get_latest_modified_time(tmp_path / 'l3')) == pytest.approx(now - HOUR)
+    assert listed == []
+
+    # The updated newest file is recorded
+    listed.clear()
+    assert timestamp(index.get_latest_modified_time(tmp_path / 'l3')) == pytest.approx(now - HOUR)
+    assert listed == []
+    index.close()
+
+
+def test_removed_subdirectory_is_dropped(tmp_path):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    index.get_latest_modified_time(tmp_path / 'l3')
+
+    shutil.rmtree(tmp_path / 'l3' / 'KAN_U')
+    set_mtime(tmp_path / 'l3', now - 10 * HOUR)
+    assert timestamp(index.get_latest_modified_time(tmp_path / 'l3')) == pytest.approx(now - 6 * HOUR)
+    paths = {path for path, in index.connection.execute("SELECT path FROM directories")}
+    assert paths == {os.fspath(tmp_path / 'l3'), os.fspath(tmp_path / 'l3' / 'QAS_L')}
+    index.close()
+
+
+def test_rebuild_rescans_everything(tmp_path, listed):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    first = index.get_latest_modified_time(tmp_path / 'l3')
+    index.close()
+
+    # --rebuild-index on the next run
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    index.rebuild()
+    listed.clear()
+    assert index.get_latest_modified_time(tmp_path / 'l3') == first
+    assert len(listed) == 3
+    index.close()
+
+
+def test_index_of_a_previous_schema_is_rebuilt(tmp_path):
+    now = time.time()
+    make_tree(tmp_path / 'l3', now)
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    with index.connection:
+        index.connection.execute("DROP TABLE directories")
+        index.connection.execute(
+            "CREATE TABLE directories (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, newest_name TEXT, "
+            "newest_ns INTEGER, subdirs TEXT NOT NULL, scanned_at REAL NOT NULL)"
+        )
+    index.close()
+
+    index = DirectoryIndex(tmp_path / 'index.sqlite')
+    expected = datetime.fromtimestamp((tmp_path / 'l3' / 'KAN_U' / 'KAN_U_hour.csv').stat().st_mtime, tz=timezone.utc)
+    assert same_time(index.get_latest_modified_time(tmp_path / 'l3'), expected)
+    index.close()
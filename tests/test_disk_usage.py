@@ -0,0 +1,114 @@
+import math
+import os
+from datetime import datetime, timedelta, timezone
+
+import attr
+import numpy as np
+import pytest
+
+from alert_processing.disk_usage import DiskUsageTracker, check_disk_capacity, fit_growth_rates
+
+GB = 1000 ** 3
+DAY = 86400
+
+
+@attr.s
+class FakeStatvfs:
+    used: int = attr.ib()
+    total: int = attr.ib(default=100 * GB)
+    f_frsize: int = attr.ib(default=1000)
+
+    @property
+    def f_blocks(self):
+        return self.total // self.f_frsize
+
+    @property
+    def f_bfree(self):
+        return (self.total - self.used) // self.f_frsize
+
+    @property
+    def f_bavail(self):
+        return self.f_bfree
+
+
+def test_fit_growth_rates_matches_polyfit():
+    rng = np.random.default_rng(0)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    times = start + np.sort(rng.uniform(0, 7 * DAY, 40))
+    codes = np.repeat([0, 1], 20)
+    values = np.where(codes == 0, 1e9 + 2e3 * (times - start), 5e8 - 10. * (times - start)) + rng.normal(0, 1e3, 40)
+    rates = fit_growth_rates(times, codes, values, series_count=3)
+    for code in (0, 1):
+        selected = codes == code
+        assert rates[code] == pytest.approx(np.polyfit(times[selected], values[selected], 1)[0])
+    assert rates[0] == pytest.approx(2e3, rel=1e-3) and rates[1] == pytest.approx(-10., abs=1.)
+    # A series without samples
+    assert math.isnan(rates[2])
+
+
+def test_single_time_has_no_rate():
+    rates = fit_growth_rates([1e9, 1e9], [0, 0], [1., 2.], series_count=1)
+    assert math.isnan(rates[0])
+
+
+def test_growth_rates_need_min_samples(tmp_path):
+    tracker = DiskUsageTracker(tmp_path / 'capacity.sqlite')
+    start = 1.7e9
+    for day in range(3):
+        tracker.record_samples({'filesystem:/data': day * GB}, sample_time=start + day * DAY, retention=None)
+    tracker.record_samples({'directory:/data/l3': GB}, sample_time=start + 2 * DAY, retention=None)
+    assert tracker.get_growth_rates(since=start) == {'filesystem:/data': pytest.approx(GB / DAY)}
+    assert tracker.get_growth_rates(since=start + DAY) == dict()
+    assert tracker.get_growth_rates(since=start + DAY, min_samples=2) == {'filesystem:/data': pytest.approx(GB / DAY)}
+    tracker.close()
+
+
+def test_forecast_of_days_to_full(tmp_path, monkeypatch):
+    (tmp_path / 'l3').mkdir()
+    tracker = DiskUsageTracker(tmp_path / 'capacity.sqlite')
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    statvfs = FakeStatvfs(used=50 * GB)
+    monkeypatch.setattr(os, 'statvfs', lambda path: statvfs)
+
+    def check(day: int, min_days_to_full: float = 14):
+        statvfs.used = (50 + 10 * day) * GB
+        return check_disk_capacity(
+            tracker,
+            [tmp_path / 'l3'],
+            current_time=start + timedelta(days=day),
+            min_time_to_full=timedelta(days=min_days_to_full),
+        )
+
+    # No forecast before three samples
+    assert check(0) == []
+    assert check(1) == []
+    problem, = check(2)
+    assert problem.startswith(
+        f'The filesystem of {tmp_path / "l3"} is projected to be full in 3 days, 0:00:00: 30.0 GB free, '
+        f'growing 10.0 GB/day.'
+    )
+    assert f'{tmp_path / "l3"} 0.0 B/day' in problem
+    assert check(3, min_days_to_full=1) == []
+    tracker.close()
+
+
+def test_directory_size_follows_changes(tmp_path):
+    (tmp_path / 'l3' / 'KAN_U').mkdir(parents=True)
+    (tmp_path / 'l3' / 'KAN_U' / 'KAN_U_hour.csv').write_bytes(b'x' * 100_000)
+    tracker = DiskUsageTracker(tmp_path / 'capacity.sqlite')
+
+    def du():
+        return sum(
+            os.stat(os.path.join(directory, name)).st_blocks * 512
+            for directory, _, names in os.walk(tmp_path / 'l3') for name in names
+        )
+
+    assert tracker.get_directory_size(tmp_path / 'l3') == du()
+    # Growing in place does not change the directory, the recently modified file is stat'ed again
+    with open(tmp_path / 'l3' / 'KAN_U' / 'KAN_U_hour.csv', 'ab') as f:
+        f.write(b'x' * 100_000)
+    (tmp_path / 'l3' / 'QAS_L').mkdir()
+    (tmp_path / 'l3' / 'QAS_L' / 'QAS_L_hour.csv').write_bytes(b'x' * 50_000)
+    assert tracker.get_directory_size(tmp_path / 'l3') == du()
+    assert tracker.get_directory_size(tmp_path / 'missing') is None
+    tracker.close()
@@ -0,0 +1,101 @@
+import socket
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pyftpdlib.handlers import FTPHandler
+
+from alert_processing.dmi_bufr import check_dmi_ftp, connect_ftp, get_latest_dmi_bufr
+from benchmarks.fixtures import ftp_server
+
+REFERENCE_TIME = datetime(2024, 1, 17, 13, 0, tzinfo=timezone.utc)
+LATEST_FILENAME = 'geus_20240117T1300.bufr'
+
+
+def counting_handler(commands):
+    """Handler attributes which record the MLSD, LIST and MDTM commands received"""
+    def record(name):
+        def handle(self, path):
+            commands.append(name)
+            return getattr(FTPHandler, f'ftp_{name}')(self, path)
+        return handle
+
+    return {f'ftp_{name}': record(name) for name in ('MLSD', 'LIST', 'MDTM')}
+
+
+def test_listing_falls_back_to_list_without_mlsd(tmp_path):
+    commands = []
+    proto_cmds = {name: info for name, info in FTPHandler.proto_cmds.items() if name != 'MLSD'}
+    attributes = dict(counting_handler(commands), proto_cmds=proto_cmds)
+    with ftp_server(tmp_path, file_count=20, reference_time=REFERENCE_TIME, handler_attributes=attributes) as settings:
+        status = get_latest_dmi_bufr(**settings)
+    assert status.latest_filename == LATEST_FILENAME
+    assert status.entry_count == 20
+    assert commands == ['LIST']
+
+
+def test_probe_hit_does_not_list(tmp_path):
+    commands = []
+    attributes = counting_handler(commands)
+    with ftp_server(tmp_path, file_count=20, reference_time=REFERENCE_TIME, handler_attributes=attributes) as settings:
+        alert = check_dmi_ftp(
+            current_time=REFERENCE_TIME + timedelta(minutes=7),
+            max_age=timedelta(hours=2),
+            probe_format='geus_%Y%m%dT%H%M.bufr',
+            probe_step=timedelta(minutes=5),
+            **settings,
+        )
+    assert not alert
+    assert commands == ['MDTM', 'MDTM']
+
+
+def test_late_upload_probes_at_most_max_probes(tmp_path):
+    commands = []
+    attributes = counting_handler(commands)
+    with ftp_server(tmp_path, file_count=20, reference_time=REFERENCE_TIME, handler_attributes=attributes) as settings:
+        alert = check_dmi_ftp(
+            current_time=REFERENCE_TIME + timedelta(hours=3),
+            max_age=timedelta(hours=2),
+            probe_format='geus_%Y%m%dT%H%M.bufr',
+            max_probes=3,
+            **settings,
+        )
+    assert alert
+    assert commands == ['MDTM'] * 3 + ['MLSD']
+
+
+def test_listing_is_retried_after_timeout(tmp_path):
+    stalled = []
+
+    def stall_first_mlsd(self, path):
+        if not stalled:
+            # Never answer, so that the client times out
+            stalled.append(path)
+            return
+        return FTPHandler.ftp_MLSD(self, path)
+
+    attributes = dict(ftp_MLSD=stall_first_mlsd)
+    with ftp_server(tmp_path, file_count=20, reference_time=REFERENCE_TIME, handler_attributes=attributes) as settings:
+        settings.update(retries=1, retry_delay=0.01, read_timeout=0.5)
+        status = get_latest_dmi_bufr(**settings)
+        assert stalled
+        assert status.latest_filename == LATEST_FILENAME
+
+        stalled.clear()
+        settings.update(retries=0)
+        with pytest.raises(socket.timeout):
+            get_latest_dmi_bufr(**settings)
+
+
+def test_failed_login_closes_the_socket(tmp_path, monkeypatch):
+    sockets = []
+    create_connection = socket.create_connection
+
+    def record_connection(*args, **kwargs):
+        sockets.append(create_connection(*args, **kwargs))
+        return sockets[-1]
+
+    monkeypatch.setattr(socket, 'create_connection', record_connection)
+    with ftp_server(tmp_path, file_count=1, reference_time=REFERENCE_TIME) as settings:
+        with pytest.raises(Exception):
+            connect_ftp(settings['user'], 'wrong password', settings['host'], settings['port'])
+    assert sockets and all(sock.fileno() == -1 for sock in sockets)
@@ -0,0 +1,79 @@
+from datetime import timedelta
+from typing import Optional
+
+import attr
+
+from alert_processing.alert_state import AlertStateStore
+from alert_processing.check_runner import Alert, CheckResult, dispatch_notifications
+from alert_processing.email_notification import (
+    BatchingNotificationClient,
+    NotificationClient,
+    StatefulNotificationClient,
+)
+
+
+@attr.s
+class RecordingClient(NotificationClient):
+    """Records the messages sent, or raises while `failing` is set"""
+    failing: bool = attr.ib(default=False)
+    sent: list = attr.ib(factory=list)
+
+    def send_alert_email(self, subject_text: str, body_text: str, check_name: Optional[str] = None):
+        self.send_alert_emails([(subject_text, body_text)])
+
+    def send_alert_emails(self, messages):
+        if self.failing:
+            raise ConnectionRefusedError('SMTP server unavailable')
+        self.sent.extend(subject for subject, _ in messages)
+
+
+def make_client(tmp_path, inner):
+    store = AlertStateStore(tmp_path / 'state.sqlite')
+    return store, StatefulNotificationClient(BatchingNotificationClient(inner), store, timedelta(hours=24))
+
+
+def test_failed_delivery_is_not_recorded_as_notified(tmp_path):
+    inner = RecordingClient(failing=True)
+    store, client = make_client(tmp_path, inner)
+    alert = [CheckResult(name='x', alert=Alert('ALERT: x', 'body'))]
+
+    dispatch_notifications(alert, client)
+    assert store.get('x').alerting
+    assert store.should_notify('x', timedelta(hours=24))
+
+    inner.failing = False
+    dispatch_notifications(alert, client)
+    assert inner.sent == ['ALERT: x']
+    assert not store.should_notify('x', timedelta(hours=24))
+
+    dispatch_notifications(alert, client)
+    assert inner.sent == ['ALERT: x']
+
+
+def test_recovery_is_retried_until_delivered(tmp_path):
+    inner = RecordingClient()
+    store, client = make_client(tmp_path, inner)
+    dispatch_notifications([CheckResult(name='x', alert=Alert('ALERT: x', 'body'))], client)
+
+    inner.failing = True
+    dispatch_notifications([CheckResult(name='x')], client)
+    assert store.get('x').alerting
+
+    inner.failing = False
+    dispatch_notifications([CheckResult(name='x')], client)
+    assert inner.sent == ['ALERT: x', 'RECOVERED: x is passing again']
+    assert not store.get('x').alerting
+
+    dispatch_notifications([CheckResult(name='x')], client)
+    assert len(inner.sent) == 2
+
+
+def test_unsent_alert_sends_no_recovery(tmp_path):
+    inner = RecordingClient(failing=True)
+    store, client = make_client(tmp_path, inner)
+    dispatch_notifications([CheckResult(name='x', alert=Alert('ALERT: x', 'body'))], client)
+
+    inner.failing = False
+    dispatch_notifications([CheckResult(name='x')], client)
+    assert inner.sent == []
+    assert not store.get('x').alerting
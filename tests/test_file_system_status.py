@@ -0,0 +1,203 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from alert_processing import file_system_status
+from alert_processing.check_runner import PipelineCheck, run_checks
+from alert_processing.directory_index import DirectoryIndex
+from alert_processing.metrics import registry
+from alert_processing.file_system_status import (
+    check_station_update_time,
+    check_update_time,
+    get_latest_modified_time,
+    get_latest_modified_time_by_name,
+    get_modified_time,
+    get_station_modified_time,
+    scan_tree,
+)
+
+
+def make_tree(root, ages_hours):
+    """Files named after their station and index, with modification times `ages_hours` ago"""
+    now = time.time()
+    for station, ages in ages_hours.items():
+        (root / station).mkdir(parents=True)
+        for i, age in enumerate(ages):
+            path = root / station / f'{station}_{i}.csv'
+            path.write_text('time,t_u\n')
+            os.utime(path, (now - age * 3600, now - age * 3600))
+        os.utime(root / station, (now - 48 * 3600, now - 48 * 3600))
+
+
+def test_latest_time_matches_get_modified_time(tmp_path):
+    make_tree(tmp_path, dict(KAN_U=[5, 3, 7], QAS_L=[10, 2.5], NUK_K=[]))
+    expected = get_modified_time(tmp_path.rglob('*'))['modified_datetime'].max()
+    assert get_latest_modified_time(tmp_path) == expected.to_pydatetime()
+    assert get_latest_modified_time(tmp_path, skip_dir=True) == expected.to_pydatetime()
+
+
+def test_scan_stops_at_first_fresh_entry(tmp_path, monkeypatch):
+    make_tree(tmp_path, dict(KAN_U=[1, 1, 1], QAS_L=[1, 1]))
+    yielded = []
+
+    def counting_scan_tree(*args, **kwargs):
+        for entry in scan_tree(*args, **kwargs):
+            yielded.append(entry)
+            yield entry
+
+    monkeypatch.setattr(file_system_status, 'scan_tree', counting_scan_tree)
+    newer_than = datetime.now(tz=timezone.utc) - timedelta(days=7)
+    latest = get_latest_modified_time(tmp_path, newer_than=newer_than)
+    assert latest >= newer_than
+    assert len(yielded) == 1
+
+    yielded.clear()
+    get_latest_modified_time(tmp_path)
+    assert len(yielded) == 7
+
+
+def test_hidden_directories_are_skipped(tmp_path):
+    make_tree(tmp_path, dict(KAN_U=[5]))
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.git' / 'index').write_text('')
+    paths = {os.path.relpath(entry.path, tmp_path) for entry in scan_tree(tmp_path)}
+    assert paths == {'KAN_U', os.path.join('KAN_U', 'KAN_U_0.csv')}
+
+
+def test_unreadable_directory_is_skipped(tmp_path, monkeypatch):
+    make_tree(tmp_path, dict(KAN_U=[5], QAS_L=[1]))
+    scandir = os.scandir
+
+    def denied_scandir(path):
+        if os.path.basename(path) == 'QAS_L':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', denied_scandir)
+    paths = {os.path.relpath(entry.path, tmp_path) for entry in scan_tree(tmp_path, skip_dir=True)}
+    assert paths == {os.path.join('KAN_U', 'KAN_U_0.csv')}
+
+
+def test_station_modified_time_per_station(tmp_path):
+    make_tree(tmp_path, dict(KAN_U=[5, 3, 7], QAS_L=[10, 2.5], NUK_K=[]))
+    # Files in nested directories count for their station, files directly in the tree for none
+    (tmp_path / 'KAN_U' / 'raw').mkdir()
+    nested_path = tmp_path / 'KAN_U' / 'raw' / 'KAN_U_raw.txt'
+    nested_path.write_text('')
+    os.utime(nested_path, (time.time() - 3600, time.time() - 3600))
+    (tmp_path / 'README.txt').write_text('')
+
+    station_times = get_station_modified_time(tmp_path)
+    assert sorted(station_times.index) == ['KAN_U', 'NUK_K', 'QAS_L']
+    assert station_times['file_count'].to_dict() == dict(KAN_U=4, QAS_L=2, NUK_K=0)
+    assert station_times.loc['KAN_U', 'modified_datetime'] == pd.Timestamp(
+        nested_path.stat().st_mtime, unit='s', tz='UTC',
+    )
+    assert station_times.loc['QAS_L', 'modified_datetime'] == pd.Timestamp(
+        (tmp_path / 'QAS_L' / 'QAS_L_1.csv').stat().st_mtime, unit='s', tz='UTC',
+    )
+    assert pd.isna(station_times.loc['NUK_K', 'modified_datetime'])
+
+
+def test_stale_stations_oldest_first(tmp_path):
+    make_tree(tmp_path, dict(KAN_U=[1, 3], QAS_L=[10, 8], NUK_K=[20], THU_U=[]))
+    current_time = datetime.now(tz=timezone.utc)
+
+    stale = check_station_update_time(tmp_path, current_time, max_age=timedelta(hours=6))
+    assert list(stale.index) == ['THU_U', 'NUK_K', 'QAS_L']
+    assert abs(stale['QAS_L'] - timedelta(hours=8)) < timedelta(minutes=1)
+
+    # Listed stations without a directory are stale with an unknown age
+    stale = check_station_update_time(tmp_path, current_time, max_age=timedelta(hours=6), stations=['KAN_U', 'MIT'])
+    assert list(stale.index) == ['MIT'] and pd.isna(stale['MIT'])
+
+
+def test_age_of_early_exit_scan_is_an_upper_bound(tmp_path):
+    make_tree(tmp_path / 'l3', dict(KAN_U=[5, 3, 7], QAS_L=[10, 2.5]))
+    directory_index = DirectoryIndex(tmp_path / 'index.sqlite')
+    checks = [
+        PipelineCheck(name='fresh', function=lambda current_time: check_update_time(
+            tmp_path / 'l3', current_time, max_age=timedelta(hours=6),
+        )),
+        PipelineCheck(name='stale', function=lambda current_time: check_update_time(
+            tmp_path / 'l3', current_time, max_age=timedelta(hours=1),
+        )),
+        PipelineCheck(name='indexed', function=lambda current_time: check_update_time(
+            tmp_path / 'l3', current_time, max_age=timedelta(hours=6), directory_index=directory_index,
+        )),
+    ]
+    fresh, stale, indexed = run_checks(checks, datetime.now(tz=timezone.utc))
+    assert fresh.upper_bound_ages == {None}
+    # A stale tree is scanned completely
+    assert stale.upper_bound_ages == set()
+    assert abs(stale.data_ages[None] - 2.5 * 3600) < 60
+    assert indexed.upper_bound_ages == set()
+    directory_index.close()
+
+
+BUFR_PATTERN = r'_(?P<timestamp>\d{8}T\d{4})\.bufr$'
+
+
+def make_bufr_tree(root, names_ages_hours):
+    """Files with the given names and modification times `ages_hours` ago, keyed by directory"""
+    now = time.time()
+    for directory, names in names_ages_hours.items():
+        (root / directory).mkdir(parents=True, exist_ok=True)
+        for name, age in names.items():
+            path = root / directory / name
+            path.write_bytes(b'BUFR')
+            os.utime(path, (now - age * 3600, now - age * 3600))
+
+
+def stat_calls(dir_path) -> int:
+    line_start = f'aws_monitor_stat_calls_total{{path="{os.fspath(dir_path)}"}} '
+    line, = [line for line in registry.render().splitlines() if line.startswith(line_start)]
+    return int(float(line[len(line_start):]))
+
+
+def test_latest_time_by_name_stats_newest_file_per_directory(tmp_path):
+    make_bufr_tree(tmp_path, {
+        'KAN_U': {'geus_20240101T0000.bufr': 26, 'geus_20240102T0000.bufr': 2, 'geus_20240101T1200.bufr': 14},
+        'QAS_L': {'geus_20240101T2300.bufr': 3},
+        'QAS_L/backup': {'geus_20231231T0000.bufr': 50},
+    })
+    expected = get_latest_modified_time(tmp_path, skip_dir=True)
+    assert get_latest_modified_time_by_name(tmp_path, BUFR_PATTERN) == expected
+    assert stat_calls(tmp_path) == 3
+
+
+def test_latest_time_by_name_trusts_the_names(tmp_path):
+    # A file rewritten after a newer one was written is not stat'ed
+    make_bufr_tree(tmp_path, {'bufr': {'geus_20240101T0000.bufr': 1, 'geus_20240102T0000.bufr': 5}})
+    latest = get_latest_modified_time_by_name(tmp_path, r'_(\d{8}T\d{4})\.bufr$')
+    assert latest == datetime.fromtimestamp(
+        (tmp_path / 'bufr' / 'geus_20240102T0000.bufr').stat().st_mtime, tz=timezone.utc,
+    )
+
+
+def test_names_not_matching_the_pattern_are_stat_ed(tmp_path):
+    make_bufr_tree(tmp_path, {
+        'bufr': {'geus_20240101T0000.bufr': 5, 'geus_20240102T0000.bufr': 4, 'README.txt': 1},
+        'other': {'notes.txt': 8, 'list.txt': 9},
+    })
+    assert get_latest_modified_time_by_name(tmp_path, BUFR_PATTERN) == get_latest_modified_time(tmp_path, skip_dir=True)
+    assert stat_calls(tmp_path) == 4
+
+
+def test_latest_time_by_name_stops_at_first_fresh_file(tmp_path):
+    make_bufr_tree(tmp_path, {
+        'KAN_U': {'geus_20240102T0000.bufr': 1},
+        'QAS_L': {'geus_20240102T0000.bufr': 1},
+        'THU_U': {'geus_20240102T0000.bufr': 1},
+    })
+    newer_than = datetime.now(tz=timezone.utc) - timedelta(hours=6)
+    assert get_latest_modified_time_by_name(tmp_path, BUFR_PATTERN, newer_than=newer_than) >= newer_than
+    assert stat_calls(tmp_path) == 1
+
+
+def test_latest_time_by_name_of_missing_directory(tmp_path):
+    assert get_latest_modified_time_by_name(tmp_path / 'missing', BUFR_PATTERN) is None
+    (tmp_path / 'empty').mkdir()
+    assert get_latest_modified_time_by_name(tmp_path / 'empty', BUFR_PATTERN) is None
@@ -0,0 +1,120 @@
+import os
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+from alert_processing import git_repositories
+from alert_processing.git_repositories import CommitTimeCache
+
+
+def git(repository: Path, *arguments: str, date: str = '2020-01-01T00:00:00+00:00'):
+    environment = dict(
+        os.environ,
+        GIT_AUTHOR_NAME='test',
+        GIT_AUTHOR_EMAIL='test@example.com',
+        GIT_COMMITTER_NAME='test',
+        GIT_COMMITTER_EMAIL='test@example.com',
+        GIT_AUTHOR_DATE=date,
+        GIT_COMMITTER_DATE=date,
+    )
+    subprocess.run(['git', '-C', repository, *arguments], check=True, env=environment)
+
+
+def commit(repository: Path, path: str, date: str):
+    (repository / path).parent.mkdir(parents=True, exist_ok=True)
+    with open(repository / path, 'a') as f:
+        f.write(date + '\n')
+    git(repository, 'add', path, date=date)
+    git(repository, 'commit', '-q', '-m', path, date=date)
+
+
+def test_head_move_only_reads_new_commits(tmp_path, monkeypatch):
+    subprocess.run(['git', 'init', '-q', tmp_path], check=True)
+    commit(tmp_path, 'OLD/data.txt', '2020-01-01T00:00:00+00:00')
+    commit(tmp_path, 'NEW/data.txt', '2024-01-01T00:00:00+00:00')
+    cache_path = tmp_path.parent / 'cache.json'
+    cache = CommitTimeCache(tmp_path, cache_path=cache_path)
+    assert cache.get_last_commit_datetimes(['OLD', 'NEW', 'NONE']) == {
+        'OLD': datetime(2020, 1, 1, tzinfo=timezone.utc),
+        'NEW': datetime(2024, 1, 1, tzinfo=timezone.utc),
+        'NONE': None,
+    }
+
+    walks = []
+    get_last_commit_datetimes = git_repositories.get_last_commit_datetimes
+
+    def record_walk(repository_path, pathspecs, revisions=()):
+        walks.append(list(revisions))
+        return get_last_commit_datetimes(repository_path, pathspecs, revisions)
+
+    monkeypatch.setattr(git_repositories, 'get_last_commit_datetimes', record_walk)
+    commit(tmp_path, 'NEW/data.txt', '2024-01-02T00:00:00+00:00')
+    expected = {
+        'OLD': datetime(2020, 1, 1, tzinfo=timezone.utc),
+        'NEW': datetime(2024, 1, 2, tzinfo=timezone.utc),
+        'NONE': None,
+    }
+    assert cache.get_last_commit_datetimes(['OLD', 'NEW', 'NONE']) == expected
+    assert len(walks) == 1 and '..' in walks[0][0]
+    # The persisted cache continues incrementally as well
+    commit(tmp_path, 'NONE/data.txt', '2024-01-03T00:00:00+00:00')
+    expected['NONE'] = datetime(2024, 1, 3, tzinfo=timezone.utc)
+    reloaded_cache = CommitTimeCache(tmp_path, cache_path=cache_path)
+    assert reloaded_cache.get_last_commit_datetimes(['OLD', 'NEW', 'NONE']) == expected
+    assert len(walks) == 2 and '..' in walks[1][0]
+
+
+def test_rewritten_history_is_read_again(tmp_path):
+    subprocess.run(['git', 'init', '-q', tmp_path], check=True)
+    commit(tmp_path, 'A/data.txt', '2020-01-01T00:00:00+00:00')
+    commit(tmp_path, 'B/data.txt', '2024-01-01T00:00:00+00:00')
+    cache = CommitTimeCache(tmp_path)
+    assert cache.get_last_commit_datetime('B') == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    subprocess.run(['git', '-C', tmp_path, 'reset', '-q', '--hard', 'HEAD~1'], check=True)
+    commit(tmp_path, 'A/data.txt', '2023-01-01T00:00:00+00:00')
+    assert cache.get_last_commit_datetimes(['A', 'B']) == {
+        'A': datetime(2023, 1, 1, tzinfo=timezone.utc),
+        'B': None,
+    }
+
+
+def test_merge_commit_dates_merged_files(tmp_path):
+    subprocess.run(['git', 'init', '-q', '-b', 'main', tmp_path], check=True)
+    commit(tmp_path, 'A/data.txt', '2024-01-01T00:00:00+00:00')
+    cache = CommitTimeCache(tmp_path)
+    assert cache.get_last_commit_datetime('A') == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    git(tmp_path, 'checkout', '-q', '-b', 'upload')
+    commit(tmp_path, 'B/data.txt', '2024-01-02T00:00:00+00:00')
+    git(tmp_path, 'checkout', '-q', 'main')
+    commit(tmp_path, 'A/data.txt', '2024-01-03T00:00:00+00:00')
+    git(tmp_path, 'merge', '-q', '--no-ff', '-m', 'Merge upload', 'upload', date='2024-01-04T00:00:00+00:00')
+    expected = {
+        'A': datetime(2024, 1, 3, tzinfo=timezone.utc),
+        'B': datetime(2024, 1, 4, tzinfo=timezone.utc),
+    }
+    # Both incrementally and in a full walk
+    assert cache.get_last_commit_datetimes(['A', 'B']) == expected
+    assert CommitTimeCache(tmp_path).get_last_commit_datetimes(['A', 'B']) == expected
+
+
+@pytest.mark.parametrize('content', [
+    '{"repository_path": "%s", "head_sha": "0000"}',
+    '{"repository_path": "%s", "head_sha": "0000", "ref_state": [1], "commit_datetimes": {"A": "yesterday"}}',
+    '["%s"]',
+])
+def test_invalid_cache_is_rebuilt(tmp_path, content):
+    repository = tmp_path / 'repository'
+    subprocess.run(['git', 'init', '-q', repository], check=True)
+    commit(repository, 'A/data.txt', '2024-01-01T00:00:00+00:00')
+    cache_path = tmp_path / 'cache.json'
+    cache_path.write_text(content % repository)
+
+    cache = CommitTimeCache(repository, cache_path=cache_path)
+    assert cache.get_last_commit_datetime('A') == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert CommitTimeCache(repository, cache_path=cache_path).commit_datetimes == {
+        'A': datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
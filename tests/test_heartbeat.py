@@ -0,0 +1,60 @@
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.error import HTTPError
+
+import pytest
+
+from alert_processing.heartbeat import (
+    HeartbeatReceiver,
+    HeartbeatRegistry,
+    check_heartbeats,
+    send_http_heartbeat,
+    send_udp_heartbeat,
+)
+
+TOKEN = 's3cret'
+
+
+def wait_for(condition, timeout: float = 5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('Condition not met')
+        time.sleep(0.01)
+
+
+def test_only_the_stale_host_is_reported():
+    started_at = time.time() - 3600
+    heartbeat_registry = HeartbeatRegistry(token=TOKEN, started_at=started_at)
+    receiver = HeartbeatReceiver(heartbeat_registry, bind='127.0.0.1', udp_port=0, http_port=0)
+    receiver.start()
+    try:
+        _, udp_port = receiver.udp_address
+        _, http_port = receiver.http_address
+        url = f'http://127.0.0.1:{http_port}'
+
+        send_udp_heartbeat('127.0.0.1', udp_port, host='glacio01', token=TOKEN)
+        send_http_heartbeat(url, host='glacio02', token=TOKEN)
+        # Heartbeats with a bad token are rejected and do not count as seen
+        send_udp_heartbeat('127.0.0.1', udp_port, host='glacio03', token='wrong')
+        with pytest.raises(HTTPError) as exc_info:
+            send_http_heartbeat(url, host='glacio03', token='wrong')
+        assert exc_info.value.code == 403
+        with pytest.raises(HTTPError):
+            send_http_heartbeat(url, host='glacio03')
+        # Datagrams are handled in order, so the rejected one has been handled once a later one is recorded
+        send_udp_heartbeat('127.0.0.1', udp_port, host='glacio04', token=TOKEN)
+        wait_for(lambda: 'glacio04' in heartbeat_registry.get_last_seen())
+    finally:
+        receiver.close()
+
+    assert set(heartbeat_registry.get_last_seen()) == {'glacio01', 'glacio02', 'glacio04'}
+    stale_hosts = check_heartbeats(
+        heartbeat_registry,
+        current_time=datetime.now(tz=timezone.utc),
+        max_age=timedelta(minutes=30),
+        hosts=['glacio01', 'glacio02', 'glacio03'],
+    )
+    assert list(stale_hosts) == ['glacio03']
+    age, seen = stale_hosts['glacio03']
+    assert not seen and age >= timedelta(hours=1)
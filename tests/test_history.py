@@ -0,0 +1,102 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from alert_processing.check_runner import Alert, CheckResult
+from alert_processing.history import FreshnessHistory, main
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_results(hour: int):
+    return [
+        CheckResult(name='bufr_out', data_ages={None: 600. * (hour % 10)}, upper_bound_ages={None}),
+        CheckResult(
+            name='l3_tx_stations',
+            alert=Alert(subject_text='ALERT', body_text='') if hour % 4 == 0 else None,
+            data_ages={None: 7200., 'KAN_U': 3600., 'QAS_L': 7200.},
+        ),
+        CheckResult(name='l0_tx', error=OSError()),
+        CheckResult(name='dmi_ftp', skipped=True),
+    ]
+
+
+def append_hours(history: FreshnessHistory, hours: range):
+    for hour in hours:
+        history.append_results(make_results(hour), time=START + timedelta(hours=hour))
+
+
+def test_append_and_read_back(tmp_path):
+    history = FreshnessHistory(tmp_path / 'history')
+    append_hours(history, range(3))
+    records = history.read()
+    assert [history.keys[key] for key in records['key'][:5]] == [
+        'bufr_out', 'l3_tx_stations', 'l3_tx_stations/KAN_U', 'l3_tx_stations/QAS_L', 'l0_tx',
+    ]
+    assert list(records['time'][:5]) == [START.timestamp()] * 5
+    assert list(records['alert'][:5]) == [0, 1, 1, 1, 2]
+    assert list(records['upper_bound'][:5]) == [True, False, False, False, False]
+    assert math.isnan(records['age'][4])
+
+    window = history.read(since=START + timedelta(hours=1), until=START + timedelta(hours=2), key='bufr_out')
+    assert list(window['age']) == [600.]
+    assert history.read(key='unknown')['age'].size == 0
+
+
+def test_compact_keeps_records_and_merges_new_journal(tmp_path):
+    history = FreshnessHistory(tmp_path / 'history', compact_threshold=None)
+    append_hours(history, range(24))
+    expected = history.read()
+    history.compact()
+    assert not (tmp_path / 'history' / 'journal.bin').exists()
+    compacted = history.read()
+    for column, values in expected.items():
+        np.testing.assert_array_equal(compacted[column], values)
+
+    # Records appended after the compaction are read from the journal, in another process as well
+    append_hours(history, range(24, 26))
+    assert len(FreshnessHistory(tmp_path / 'history').read(key='bufr_out')['age']) == 26
+    history.compact(retention=timedelta(days=1))
+    assert len(history.read()['time']) == 0
+
+
+def test_quantile_of_exact_ages(tmp_path):
+    history = FreshnessHistory(tmp_path / 'history')
+    append_hours(history, range(10))
+    assert history.quantile('bufr_out', 0.5) == timedelta(seconds=2700)
+    assert history.quantile('bufr_out', 1) == timedelta(hours=1.5)
+    # Only upper bounds are recorded for bufr_out
+    assert history.quantile('bufr_out', 0.5, exact_only=True) is None
+    assert history.quantile('l3_tx_stations/KAN_U', 0.95, exact_only=True) == timedelta(hours=1)
+    assert history.quantile('l0_tx', 0.5) is None
+
+    summary = history.summary()
+    assert summary.loc['bufr_out', 'upper_bound_fraction'] == 1
+    assert summary.loc['l3_tx_stations', 'alert_fraction'] == pytest.approx(0.3)
+
+
+def test_partial_record_is_dropped_before_appending(tmp_path, caplog):
+    history = FreshnessHistory(tmp_path / 'history', compact_threshold=None)
+    append_hours(history, range(2))
+    # A run killed while writing leaves a partial record
+    with open(tmp_path / 'history' / 'journal.bin', 'ab') as f:
+        f.write(b'\x00' * 7)
+    append_hours(history, range(2, 4))
+    assert 'Dropping a partially written record of 7 bytes' in caplog.text
+    assert list(history.read(key='bufr_out')['age']) == [0., 600., 1200., 1800.]
+
+    with open(tmp_path / 'history' / 'journal.bin', 'ab') as f:
+        f.write(b'\x00' * 3)
+    history.compact()
+    assert list(history.read(key='bufr_out')['age']) == [0., 600., 1200., 1800.]
+
+
+def test_quantile_command(tmp_path, capsys):
+    history = FreshnessHistory(tmp_path / 'history')
+    history.append_results(make_results(1), time=datetime.now(tz=timezone.utc))
+    main([str(tmp_path / 'history'), 'quantile', 'bufr_out', '--q', '0.5'])
+    assert 'p50 age of bufr_out in the last 30 days: 0:10:00' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'history'), 'quantile', 'bufr_out', '--exact-only'])
@@ -0,0 +1,13 @@
+import os
+from pathlib import Path
+
+from alert_processing.import_budget import check_import_budget
+
+SOURCE_PATH = Path(__file__).parents[1] / 'src'
+
+
+def test_check_alerts_meets_import_budget(monkeypatch):
+    # The module is imported in new interpreters
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([os.fspath(SOURCE_PATH), os.environ.get('PYTHONPATH', '')]))
+    # Same budget as `python -m alert_processing.import_budget` in the README
+    assert check_import_budget('alert_processing.check_alerts', budget_ms=300) == []
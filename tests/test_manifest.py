@@ -0,0 +1,133 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from alert_processing.manifest import (
+    ManifestStore,
+    check_manifest_changes,
+    diff_manifests,
+    hash_paths,
+    manifest_dtype,
+    scan_manifest,
+)
+
+HOUR = 3600
+
+
+def make_tree(root, ages_hours):
+    """Files `ages_hours` old, keyed by their path relative to `root`"""
+    now = time.time()
+    for name, age in ages_hours.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('time,t_u\n')
+        os.utime(path, (now - age * HOUR, now - age * HOUR))
+
+
+def test_hash_does_not_depend_on_the_other_paths():
+    paths = ['/data/l3/KAN_U/KAN_U_hour.csv', '/data/l3/QAS_L/QAS_L_hour.csv', '/data/l3/KAN_U/KAN_U_day.csv']
+    hashes = hash_paths(paths)
+    assert len(set(hashes.tolist())) == 3
+    assert hash_paths(paths[:1])[0] == hashes[0]
+    assert hash_paths(['/data/l3/KAN_U/KAN_U_hour.csv', '/data/l3/a/very/long/path/' * 8])[0] == hashes[0]
+    assert hash_paths([]).dtype == np.uint64
+
+
+def test_store_round_trip(tmp_path):
+    make_tree(tmp_path / 'l3', {'KAN_U/KAN_U_hour.csv': 1, 'QAS_L/QAS_L_hour.csv': 2})
+    store = ManifestStore(tmp_path / 'manifests')
+    assert store.load(tmp_path / 'l3') is None
+    assert store.get_time(tmp_path / 'l3') is None
+
+    snapshot = scan_manifest(tmp_path / 'l3')
+    store.save(tmp_path / 'l3', snapshot.entries)
+    # A new store of the next run reads the manifest memory mapped
+    loaded = ManifestStore(tmp_path / 'manifests').load(tmp_path / 'l3')
+    assert isinstance(loaded, np.memmap)
+    assert loaded.dtype == manifest_dtype()
+    np.testing.assert_array_equal(loaded, snapshot.entries)
+    assert abs(store.get_time(tmp_path / 'l3') - datetime.now(tz=timezone.utc)) < timedelta(minutes=1)
+    assert sorted(os.listdir(tmp_path / 'manifests')) == [store.get_manifest_path(tmp_path / 'l3').name]
+
+
+def test_store_round_trip_of_empty_tree(tmp_path):
+    (tmp_path / 'empty').mkdir()
+    store = ManifestStore(tmp_path / 'manifests')
+    store.save(tmp_path / 'empty', scan_manifest(tmp_path / 'empty').entries)
+    loaded = store.load(tmp_path / 'empty')
+    assert loaded is not None and len(loaded) == 0
+
+
+def test_invalid_manifest_is_ignored(tmp_path, caplog):
+    store = ManifestStore(tmp_path / 'manifests')
+    np.save(store.get_manifest_path(tmp_path / 'l3'), np.zeros(3, dtype=np.int64))
+    store.get_manifest_path(tmp_path / 'l3_raw').write_bytes(b'not a manifest')
+    with caplog.at_level(logging.WARNING, logger='alert_processing.manifest'):
+        assert store.load(tmp_path / 'l3') is None
+        assert store.load(tmp_path / 'l3_raw') is None
+    assert 'with dtype int64' in caplog.text
+    assert 'Ignoring invalid manifest' in caplog.text
+
+
+def test_diff_classifies_every_file(tmp_path):
+    make_tree(tmp_path, {'KAN_U/hour.csv': 1, 'KAN_U/day.csv': 5, 'QAS_L/hour.csv': 2, 'QAS_L/day.csv': 6})
+    previous = scan_manifest(tmp_path)
+
+    (tmp_path / 'KAN_U' / 'day.csv').unlink()
+    with open(tmp_path / 'QAS_L' / 'hour.csv', 'a') as f:
+        f.write('2024-01-17,1.0\n')
+    make_tree(tmp_path, {'NUK_K/hour.csv': 1})
+    current = scan_manifest(tmp_path)
+
+    diff = diff_manifests(previous.entries, current.entries)
+    assert diff.counts() == dict(vanished=1, unchanged=2, modified=1, new=1)
+    assert previous.get_paths(diff.vanished) == [os.fspath(tmp_path / 'KAN_U' / 'day.csv')]
+    assert current.get_paths(diff.modified) == [os.fspath(tmp_path / 'QAS_L' / 'hour.csv')]
+    assert current.get_paths(diff.new) == [os.fspath(tmp_path / 'NUK_K' / 'hour.csv')]
+    assert sorted(current.get_paths(diff.unchanged)) == [
+        os.fspath(tmp_path / 'KAN_U' / 'hour.csv'), os.fspath(tmp_path / 'QAS_L' / 'day.csv'),
+    ]
+
+
+def test_diff_against_empty_manifest():
+    current = np.zeros(2, dtype=manifest_dtype())
+    current['path_hash'] = np.sort(hash_paths(['a', 'b']))
+    diff = diff_manifests(np.zeros(0, dtype=manifest_dtype()), current)
+    assert diff.counts() == dict(vanished=0, unchanged=0, modified=0, new=2)
+    diff = diff_manifests(current, np.zeros(0, dtype=manifest_dtype()))
+    assert diff.counts() == dict(vanished=2, unchanged=0, modified=0, new=0)
+
+
+def test_watched_files_which_stopped_updating(tmp_path):
+    make_tree(tmp_path / 'l3', {
+        'KAN_U/KAN_U_hour.csv': 1,
+        'QAS_L/QAS_L_hour.csv': 30,
+        'NUK_K/NUK_K_hour.csv': 10,
+        'NUK_K/NUK_K_month.csv': 50,
+    })
+    store = ManifestStore(tmp_path / 'manifests')
+    current_time = datetime.now(tz=timezone.utc)
+
+    first = check_manifest_changes(tmp_path / 'l3', store, current_time, timedelta(hours=6), pattern='*_hour.csv')
+    assert first.previous_time is None
+    assert first.counts == dict(vanished=0, unchanged=0, modified=0, new=4)
+    assert first.stopped_paths == []
+
+    # KAN_U keeps updating, QAS_L and NUK_K stopped; monthly files are not watched
+    make_tree(tmp_path / 'l3', {'KAN_U/KAN_U_hour.csv': 0})
+    second = check_manifest_changes(tmp_path / 'l3', store, current_time, timedelta(hours=6), pattern='*_hour.csv')
+    assert second.previous_time is not None
+    assert second.counts == dict(vanished=0, unchanged=3, modified=1, new=0)
+    assert second.stopped_paths == [
+        os.fspath(tmp_path / 'l3' / 'QAS_L' / 'QAS_L_hour.csv'),
+        os.fspath(tmp_path / 'l3' / 'NUK_K' / 'NUK_K_hour.csv'),
+    ]
+
+    # Without a pattern no file is watched, and a vanished file is only counted
+    (tmp_path / 'l3' / 'QAS_L' / 'QAS_L_hour.csv').unlink()
+    third = check_manifest_changes(tmp_path / 'l3', store, current_time, timedelta(hours=6))
+    assert third.counts == dict(vanished=1, unchanged=3, modified=0, new=0)
+    assert third.stopped_paths == []
@@ -0,0 +1,71 @@
+import os
+import stat
+import urllib.error
+import urllib.request
+
+import pytest
+
+from alert_processing.metrics import MetricsRegistry, start_http_server, write_textfile
+
+
+def make_registry() -> MetricsRegistry:
+    metrics_registry = MetricsRegistry()
+    metrics_registry.set_gauge('aws_monitor_data_age_seconds', 90, help='Age of the newest data', path='/data/l3')
+    metrics_registry.inc('aws_monitor_alerts_total', check='l3_tx')
+    metrics_registry.inc('aws_monitor_alerts_total', 2, check='l3_tx')
+    metrics_registry.observe('aws_monitor_check_seconds', 0.2, buckets=(1., 0.1), check='l3_tx')
+    metrics_registry.observe('aws_monitor_check_seconds', 5, buckets=(1., 0.1), check='l3_tx')
+    return metrics_registry
+
+
+def test_render_text_exposition_format():
+    assert make_registry().render() == '\n'.join([
+        '# TYPE aws_monitor_alerts_total counter',
+        'aws_monitor_alerts_total{check="l3_tx"} 3.0',
+        '# TYPE aws_monitor_check_seconds histogram',
+        'aws_monitor_check_seconds_bucket{check="l3_tx",le="0.1"} 0',
+        'aws_monitor_check_seconds_bucket{check="l3_tx",le="1.0"} 1',
+        'aws_monitor_check_seconds_bucket{check="l3_tx",le="+Inf"} 2',
+        'aws_monitor_check_seconds_sum{check="l3_tx"} 5.2',
+        'aws_monitor_check_seconds_count{check="l3_tx"} 2',
+        '# HELP aws_monitor_data_age_seconds Age of the newest data',
+        '# TYPE aws_monitor_data_age_seconds gauge',
+        'aws_monitor_data_age_seconds{path="/data/l3"} 90.0',
+    ]) + '\n'
+
+
+def test_label_values_are_escaped_and_kinds_are_fixed():
+    metrics_registry = MetricsRegistry()
+    metrics_registry.set_gauge('aws_monitor_up', 1, path='C:\\data\n"l3"')
+    assert 'aws_monitor_up{path="C:\\\\data\\n\\"l3\\""} 1.0\n' in metrics_registry.render()
+    with pytest.raises(ValueError):
+        metrics_registry.inc('aws_monitor_up')
+
+
+def test_write_textfile_replaces_the_file(tmp_path):
+    path = tmp_path / 'textfile' / 'aws_monitor.prom'
+    write_textfile(path, MetricsRegistry())
+    assert path.read_text() == '\n'
+
+    metrics_registry = make_registry()
+    write_textfile(path, metrics_registry)
+    assert path.read_text() == metrics_registry.render()
+    # Readable by the node-exporter and no temporary files are left for the collector to pick up
+    assert stat.S_IMODE(path.stat().st_mode) == 0o644
+    assert os.listdir(path.parent) == ['aws_monitor.prom']
+
+
+def test_http_server_serves_metrics():
+    metrics_registry = make_registry()
+    server = start_http_server(0, host='127.0.0.1', metrics_registry=metrics_registry)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(f'{url}/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert response.read().decode() == metrics_registry.render()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'{url}/other', timeout=5)
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
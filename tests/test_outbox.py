@@ -0,0 +1,40 @@
+import json
+from datetime import timedelta
+
+from alert_processing.email_notification import EmailNotificationClient
+from alert_processing.outbox import Outbox, OutboxDeliveryWorker
+from benchmarks.fixtures import smtp_server
+
+
+def make_worker(outbox_path, client_settings) -> OutboxDeliveryWorker:
+    return OutboxDeliveryWorker(
+        Outbox(outbox_path),
+        EmailNotificationClient(timeout=5, **client_settings),
+        min_retry_delay=timedelta(0),
+    )
+
+
+def test_message_survives_smtp_outage_and_restart(tmp_path):
+    outbox_path = tmp_path / 'outbox.jsonl'
+    with smtp_server() as stopped_smtp:
+        pass
+
+    # The SMTP server is down: the attempt is recorded and the message stays pending
+    worker = make_worker(outbox_path, stopped_smtp['client_settings'])
+    message_id, = worker.outbox.put([('ALERT: l3_tx', 'Files are not updating')])
+    worker.deliver_pending()
+    events = [json.loads(line) for line in outbox_path.read_text().splitlines()]
+    assert [(event['event'], event['id']) for event in events] == [('add', message_id), ('retry', message_id)]
+    assert stopped_smtp['received'] == []
+
+    # A restarted process replays the journal
+    pending, = Outbox(outbox_path).get_pending()
+    assert pending.id == message_id and pending.attempts == 1
+
+    with smtp_server() as smtp:
+        worker = make_worker(outbox_path, smtp['client_settings'])
+        worker.deliver_pending()
+        worker.deliver_pending()
+        assert len(smtp['received']) == 1
+        assert b'Subject: ALERT: l3_tx' in smtp['received'][0]
+    assert Outbox(outbox_path).get_pending() == []
@@ -0,0 +1,77 @@
+import logging
+import pstats
+import threading
+
+import pytest
+
+from alert_processing import profiling
+
+
+@pytest.fixture
+def spans(caplog):
+    """Records of the finished spans while profiling is enabled"""
+    level = profiling.logger.level
+    caplog.set_level(logging.INFO, logger=profiling.logger.name)
+    yield lambda: [record.span for record in caplog.records if hasattr(record, 'span')]
+    profiling.disable()
+    profiling.logger.setLevel(level)
+
+
+def test_disabled_span_is_a_shared_no_op(spans):
+    assert not profiling.is_enabled()
+    with profiling.span('scan', path='/data/l3') as span:
+        span.set(files=3)
+    assert span is profiling.span('other')
+    assert spans() == []
+
+
+def test_nested_spans_are_logged_with_their_parent(spans):
+    profiling.enable()
+    with profiling.span('check', check='l3_tx'):
+        with profiling.span('scan', path='/data/l3') as span:
+            span.set(files=3)
+        with pytest.raises(OSError):
+            with profiling.span('git_log'):
+                raise OSError('git not found')
+
+    scan, git_log, check = spans()
+    assert scan['span'] == 'scan' and scan['parent'] == 'check'
+    assert scan['path'] == '/data/l3' and scan['files'] == 3
+    assert git_log['error'] == 'OSError' and 'error' not in scan
+    assert check['parent'] is None and check['check'] == 'l3_tx'
+    assert check['duration_ms'] >= scan['duration_ms'] >= 0
+
+
+def test_spans_of_other_threads_have_no_parent(spans):
+    profiling.enable()
+
+    def run_span():
+        with profiling.span('scan'):
+            pass
+
+    with profiling.span('check'):
+        thread = threading.Thread(target=run_span, name='check-l3_tx')
+        thread.start()
+        thread.join()
+    scan, check = spans()
+    assert scan['parent'] is None and scan['thread'] == 'check-l3_tx'
+    assert check['thread'] == threading.current_thread().name
+
+
+def test_thread_profiles_are_merged(spans, tmp_path):
+    profiling.enable(profile_directory=tmp_path)
+
+    def profiled():
+        with profiling.profile_thread():
+            sum(range(1000))
+
+    threads = [threading.Thread(target=profiled) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    path = profiling.dump_stats()
+    assert path is not None and path.parent == tmp_path
+    assert pstats.Stats(str(path)).total_calls > 0
+    # The collection is reset
+    assert profiling.dump_stats() is None
@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+SOURCE_PATH = Path(__file__).parents[1] / 'src'
+TOKEN = 's3cret'
+AGGREGATOR_SCRIPT = '''
+import sys
+from alert_processing.remote_agent import SummaryReceiver, SummaryStore
+
+receiver = SummaryReceiver(SummaryStore(sys.argv[1]), port=0, bind='127.0.0.1', token=sys.argv[2])
+receiver.start()
+print(receiver.address[1], flush=True)
+# Serve until the test closes stdin
+sys.stdin.read()
+receiver.close()
+'''
+
+
+def run_python(*arguments, **kwargs):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.fspath(SOURCE_PATH), os.environ.get('PYTHONPATH', '')]))
+    return subprocess.Popen([sys.executable, *arguments], env=env, text=True, **kwargs)
+
+
+def run_agent(config_path: Path) -> subprocess.CompletedProcess:
+    process = run_python(
+        '-m', 'alert_processing.check_alerts', '-c', os.fspath(config_path), '--agent',
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = process.communicate(timeout=60)
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+
+def test_agent_sends_summary_to_aggregator_process(tmp_path):
+    (tmp_path / 'l3' / 'KAN_U').mkdir(parents=True)
+    (tmp_path / 'l3' / 'KAN_U' / 'KAN_U_hour.csv').write_text('time,t_u\n')
+    summaries_path = tmp_path / 'summaries.json'
+    aggregator = run_python(
+        '-c', AGGREGATOR_SCRIPT, os.fspath(summaries_path), TOKEN,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        port = int(aggregator.stdout.readline())
+        config_path = tmp_path / 'agent.ini'
+        config_path.write_text(f'''
+[local]
+l3-tx-path : {tmp_path / 'l3'}
+[logging]
+log_path : {tmp_path / 'agent.log'}
+[agent]
+name : glacio01
+aggregator-url : http://127.0.0.1:{port}
+token : {TOKEN}
+timeout : 10
+''')
+        result = run_agent(config_path)
+        assert result.returncode == 0, result.stderr
+    finally:
+        aggregator.communicate(input='', timeout=10)
+
+    summary = json.loads(summaries_path.read_text())['summaries']['glacio01']
+    assert summary['paths']['l3_tx']['count'] == 1
+    assert list(summary['paths']['l3_tx']['stations']) == ['KAN_U']
+
+    # The aggregator has stopped, the agent reports the error and exits with a failure status
+    result = run_agent(config_path)
+    assert result.returncode == 1
+    assert 'Traceback' not in result.stderr
+    assert f'Unable to send the summary to http://127.0.0.1:{port}' in result.stdout
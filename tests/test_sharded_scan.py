@@ -0,0 +1,87 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+from alert_processing import sharded_scan
+from alert_processing.file_system_status import get_latest_modified_time, get_station_modified_time
+from alert_processing.sharded_scan import ShardedScanner
+
+
+def make_tree(root, ages_hours):
+    now = time.time()
+    for station, ages in ages_hours.items():
+        (root / station / 'raw').mkdir(parents=True)
+        for i, age in enumerate(ages):
+            path = root / station / ('raw' if i % 2 else '') / f'{station}_{i}.csv'
+            path.write_text('time,t_u\n')
+            os.utime(path, (now - age * 3600, now - age * 3600))
+        os.utime(root / station / 'raw', (now - 48 * 3600, now - 48 * 3600))
+        os.utime(root / station, (now - 48 * 3600, now - 48 * 3600))
+    (root / '.git').mkdir()
+    os.utime(root, (now - 48 * 3600, now - 48 * 3600))
+
+
+@pytest.fixture(params=[False, True], ids=['threads', 'processes'])
+def scanner(request):
+    sharded_scanner = ShardedScanner(max_workers=2, use_processes=request.param)
+    yield sharded_scanner
+    sharded_scanner.close()
+
+
+def test_matches_serial_scan(tmp_path, scanner):
+    make_tree(tmp_path, dict(KAN_U=[5, 3, 7], QAS_L=[10, 2.5], NUK_K=[], THU_U=[30]))
+    (tmp_path / 'README.txt').write_text('')
+    os.utime(tmp_path / 'README.txt', (time.time() - 3600, time.time() - 3600))
+
+    for skip_dir in (False, True):
+        assert scanner.get_latest_modified_time(tmp_path, skip_dir=skip_dir) == get_latest_modified_time(
+            tmp_path, skip_dir=skip_dir,
+        )
+    pd.testing.assert_frame_equal(
+        scanner.get_station_modified_time(tmp_path),
+        get_station_modified_time(tmp_path).sort_index(),
+        check_index_type=False,
+    )
+
+
+def test_fresh_shard_cancels_remaining_shards(tmp_path, monkeypatch):
+    make_tree(tmp_path, {f'S{i:02d}': [1] for i in range(10)})
+    scanned = []
+    scan_shard = sharded_scan._scan_shard
+
+    def recording_scan_shard(shard_path, *args):
+        scanned.append(shard_path)
+        # A slow filesystem, the shards are not all finished before the first result is handled
+        time.sleep(0.05)
+        return scan_shard(shard_path, *args)
+
+    monkeypatch.setattr(sharded_scan, '_scan_shard', recording_scan_shard)
+    scanner = ShardedScanner(max_workers=1)
+    newer_than = datetime.now(tz=timezone.utc) - timedelta(hours=6)
+    try:
+        assert scanner.get_latest_modified_time(tmp_path, newer_than=newer_than) >= newer_than
+        # The worker may have started the next shard before the others were cancelled
+        assert 1 <= len(scanned) <= 2
+
+        scanned.clear()
+        summaries, _ = scanner.scan_shards(tmp_path)
+        assert len(scanned) == len(summaries) == 10
+    finally:
+        scanner.close()
+
+
+def test_fresh_entry_in_root_skips_the_shards(tmp_path, monkeypatch):
+    make_tree(tmp_path, dict(KAN_U=[5], QAS_L=[10]))
+    (tmp_path / 'README.txt').write_text('')
+    monkeypatch.setattr(sharded_scan, '_scan_shard', None)
+    scanner = ShardedScanner(max_workers=1)
+    newer_than = datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    try:
+        summaries, root_mtime = scanner.scan_shards(tmp_path, newer_than=newer_than)
+        assert summaries == dict() and root_mtime >= newer_than.timestamp()
+        assert scanner.scan_shards(tmp_path / 'missing') == (dict(), None)
+    finally:
+        scanner.close()
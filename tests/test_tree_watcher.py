@@ -0,0 +1,140 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from alert_processing import tree_watcher as tree_watcher_module
+from alert_processing.file_system_status import (
+    check_update_time,
+    get_latest_modified_time,
+    get_station_modified_time,
+)
+from alert_processing.tree_watcher import TreeWatcher, _Inotify
+
+
+def make_tree(root, now):
+    for station, ages in dict(KAN_U=[5, 3], QAS_L=[10], NUK_K=[]).items():
+        (root / station).mkdir(parents=True)
+        for i, age in enumerate(ages):
+            path = root / station / f'{station}_{i}.csv'
+            path.write_text('time,t_u\n')
+            os.utime(path, (now - age * 3600, now - age * 3600))
+        os.utime(root / station, (now - 48 * 3600, now - 48 * 3600))
+    os.utime(root, (now - 48 * 3600, now - 48 * 3600))
+
+
+@pytest.fixture
+def watcher():
+    """Watcher driven from the test thread by calling `_sync_trees` and `_process_events`"""
+    tree_watcher = TreeWatcher()
+    try:
+        tree_watcher._inotify = _Inotify()
+    except OSError as e:
+        pytest.skip(f"inotify is not available: {e}")
+    yield tree_watcher
+    tree_watcher._inotify.close()
+
+
+def process_events(tree_watcher: TreeWatcher):
+    # Events are queued by the kernel when the changes are made
+    tree_watcher._process_events()
+    tree_watcher._sync_trees()
+
+
+def test_watched_times_match_scan(tmp_path, watcher):
+    make_tree(tmp_path / 'l3', time.time())
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (False, None)
+    watcher.watch(tmp_path / 'l3')
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (False, None)
+    watcher._sync_trees()
+
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (True, get_latest_modified_time(tmp_path / 'l3'))
+    watched, station_times = watcher.get_station_modified_times(tmp_path / 'l3')
+    expected = get_station_modified_time(tmp_path / 'l3')['modified_datetime']
+    assert watched and sorted(station_times) == ['KAN_U', 'NUK_K', 'QAS_L']
+    assert station_times['NUK_K'] is None
+    for station in ('KAN_U', 'QAS_L'):
+        assert station_times[station].timestamp() == pytest.approx(expected[station].timestamp(), abs=1e-5)
+
+
+def test_changes_are_applied_from_events(tmp_path, watcher):
+    make_tree(tmp_path / 'l3', time.time() - 3600)
+    watcher.watch(tmp_path / 'l3')
+    watcher._sync_trees()
+
+    (tmp_path / 'l3' / 'QAS_L' / 'QAS_L_0.csv').write_text('time,t_u\n2024-01-01,1.0\n')
+    (tmp_path / 'l3' / 'THU_U' / 'raw').mkdir(parents=True)
+    (tmp_path / 'l3' / 'THU_U' / 'raw' / 'THU_U_raw.txt').write_text('')
+    # Hidden entries are ignored
+    (tmp_path / 'l3' / 'KAN_U' / '.KAN_U_0.csv.swp').write_text('')
+    process_events(watcher)
+
+    watched, station_times = watcher.get_station_modified_times(tmp_path / 'l3')
+    assert watched
+    assert station_times['QAS_L'].timestamp() == pytest.approx(
+        (tmp_path / 'l3' / 'QAS_L' / 'QAS_L_0.csv').stat().st_mtime, abs=1e-5,
+    )
+    assert station_times['THU_U'].timestamp() == pytest.approx(
+        (tmp_path / 'l3' / 'THU_U' / 'raw' / 'THU_U_raw.txt').stat().st_mtime, abs=1e-5,
+    )
+    assert station_times['KAN_U'] < datetime.now(tz=timezone.utc) - timedelta(hours=1)
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (True, get_latest_modified_time(tmp_path / 'l3'))
+
+
+def test_overflow_rescans_the_tree(tmp_path, watcher, monkeypatch):
+    make_tree(tmp_path / 'l3', time.time() - 3600)
+    watcher.watch(tmp_path / 'l3')
+    watcher._sync_trees()
+
+    read_events = watcher._inotify.read_events
+    monkeypatch.setattr(watcher._inotify, 'read_events', lambda: [(-1, tree_watcher_module._IN_Q_OVERFLOW, '')])
+    watcher._process_events()
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (False, None)
+
+    monkeypatch.setattr(watcher._inotify, 'read_events', read_events)
+    (tmp_path / 'l3' / 'KAN_U' / 'KAN_U_0.csv').write_text('time,t_u\n')
+    process_events(watcher)
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (True, get_latest_modified_time(tmp_path / 'l3'))
+
+
+def test_remote_filesystem_falls_back_to_scanning(tmp_path, watcher, monkeypatch, caplog):
+    make_tree(tmp_path / 'l3', time.time())
+    monkeypatch.setattr(watcher._inotify, 'filesystem_type', lambda path: 0x6969)
+    watcher.watch(tmp_path / 'l3')
+    watcher._sync_trees()
+    assert 'is on a nfs filesystem, which is not watched' in caplog.text
+    assert watcher.get_latest_modified_time(tmp_path / 'l3') == (False, None)
+    assert watcher.get_station_modified_times(tmp_path / 'l3') == (False, dict())
+
+    # The checks scan the tree instead
+    current_time = datetime.now(tz=timezone.utc)
+    assert not check_update_time(tmp_path / 'l3', current_time, timedelta(hours=4), tree_watcher=watcher)
+    assert check_update_time(tmp_path / 'l3', current_time, timedelta(hours=2), tree_watcher=watcher)
+
+
+def test_background_thread_follows_changes(tmp_path):
+    make_tree(tmp_path / 'l3', time.time() - 3600)
+    tree_watcher = TreeWatcher()
+    try:
+        tree_watcher.start()
+    except OSError as e:
+        pytest.skip(f"inotify is not available: {e}")
+    try:
+        tree_watcher.watch(tmp_path / 'l3')
+        wait_for(lambda: tree_watcher.get_latest_modified_time(tmp_path / 'l3')[0])
+        new_path = tmp_path / 'l3' / 'NUK_K' / 'NUK_K_0.csv'
+        new_path.write_text('time,t_u\n')
+        wait_for(lambda: tree_watcher.get_station_modified_times(tmp_path / 'l3')[1]['NUK_K'] is not None)
+        assert tree_watcher.get_latest_modified_time(tmp_path / 'l3') == (
+            True, get_latest_modified_time(tmp_path / 'l3'),
+        )
+    finally:
+        tree_watcher.close()
+
+
+def wait_for(condition, timeout: float = 5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Condition not met'
+        time.sleep(0.01)